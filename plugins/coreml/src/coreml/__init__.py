@@ -200,7 +200,7 @@ class CoreMLPlugin(
                 "choices": availableModels,
                 "value": model,
             },
-        ]
+        ] + self.getPipelineSettings()
 
     async def putSetting(self, key: str, value: SettingValue):
         self.storage.setItem(key, value)
@@ -214,6 +214,9 @@ class CoreMLPlugin(
     def get_input_size(self) -> Tuple[float, float]:
         return (self.inputwidth, self.inputheight)
 
+    def get_max_batch_size(self) -> int:
+        return 8
+
     async def detect_batch(self, inputs: List[Any]) -> List[Any]:
         out_dicts = await asyncio.get_event_loop().run_in_executor(
             predictExecutor, lambda: self.model.predict(inputs)
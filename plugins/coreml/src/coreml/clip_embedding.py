@@ -63,14 +63,15 @@ class CoreMLClipEmbedding(ClipEmbedding):
         return ret
 
     async def getTextEmbedding(self, input):
-        def predict():
-            inputs = self.processor(text=input, return_tensors="np", padding="max_length", truncation=True)
-            text_model, _ = self.model
-            text_predictions = text_model.predict({'input_ids_1': inputs['input_ids'].astype(np.float32), 'attention_mask_1': inputs['attention_mask'].astype(np.float32)})
-            text_embeds = text_predictions['var_1050']
-            return bytearray(text_embeds.astype(np.float32).tobytes())
+        async with self.use_models():
+            def predict():
+                inputs = self.processor(text=input, return_tensors="np", padding="max_length", truncation=True)
+                text_model, _ = self.model
+                text_predictions = text_model.predict({'input_ids_1': inputs['input_ids'].astype(np.float32), 'attention_mask_1': inputs['attention_mask'].astype(np.float32)})
+                text_embeds = text_predictions['var_1050']
+                return bytearray(text_embeds.astype(np.float32).tobytes())
 
-        ret = await asyncio.get_event_loop().run_in_executor(
-            self.predictExecutor, lambda: predict()
-        )
-        return ret
+            ret = await asyncio.get_event_loop().run_in_executor(
+                self.predictExecutor, lambda: predict()
+            )
+            return ret
@@ -64,6 +64,24 @@ class CoreMLFaceRecognition(FaceRecognizeDetection):
         )
         return results
 
+    async def predictFaceBatch(self, input: np.ndarray):
+        # the model has a fixed batch size, but a batch prediction
+        # still runs every face in a single call.
+        def predict():
+            model, inputName = self.faceModel
+            out_dicts = model.predict(
+                [{inputName: input[i : i + 1]} for i in range(len(input))]
+            )
+            results = np.stack(
+                [np.asarray(list(o.values())[0][0]).reshape(-1) for o in out_dicts]
+            )
+            return results
+
+        results = await asyncio.get_event_loop().run_in_executor(
+            self.recogExecutor, lambda: predict()
+        )
+        return results
+
     # def predictVision(self, input: Image.Image) -> asyncio.Future[list[Prediction]]:
     #     buffer = input.tobytes()
     #     myData = NSData.alloc().initWithBytes_length_(buffer, len(buffer))
@@ -47,3 +47,16 @@ class CoreMLTextRecognition(TextRecognition):
             self.recogExecutor, lambda: predict()
         )
         return preds
+
+    async def predictTextBatch(self, input: np.ndarray):
+        # the model has a fixed batch size, but a batch prediction
+        # still runs every line in a single call.
+        def predict():
+            model, inputName = self.textModel
+            out_dicts = model.predict([{inputName: input[i : i + 1]} for i in range(len(input))])
+            preds = np.concatenate([out_dict["linear_2"] for out_dict in out_dicts])
+            return preds
+        preds = await asyncio.get_event_loop().run_in_executor(
+            self.recogExecutor, lambda: predict()
+        )
+        return preds
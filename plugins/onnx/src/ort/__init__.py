@@ -20,6 +20,7 @@ from scrypted_sdk.types import Setting
 
 from .custom_detection import ONNXCustomDetection
 import common.yolo as yolo
+from common.preprocess import TensorWriter
 from predict import PredictPlugin
 
 from .face_recognition import ONNXFaceRecognition
@@ -91,6 +92,8 @@ class ONNXPlugin(
         compiled_models: list[onnxruntime.InferenceSession] = []
         self.compiled_models: dict[str, onnxruntime.InferenceSession] = {}
         self.provider = "Unknown"
+        self.max_batch_size = 1
+        self.input_writer: TensorWriter = None
 
         try:
             for deviceId in deviceIds:
@@ -115,6 +118,9 @@ class ONNXPlugin(
 
                 input = compiled_model.get_inputs()[0]
                 self.model_dim = input.shape[2]
+                # models exported with a dynamic batch dimension can run
+                # frames from multiple cameras in a single inference.
+                self.max_batch_size = 1 if isinstance(input.shape[0], int) else 16
                 self.input_name = input.name
                 self.labels = parse_labels(
                     compiled_model.get_modelmeta().custom_metadata_map["names"]
@@ -268,7 +274,7 @@ class ONNXPlugin(
                 "readonly": True,
                 "value": self.provider,
             },
-        ]
+        ] + self.getPipelineSettings()
 
     async def putSetting(self, key: str, value: SettingValue):
         if key == "deviceIds":
@@ -284,36 +290,58 @@ class ONNXPlugin(
     def get_input_size(self) -> Tuple[int, int]:
         return [self.model_dim, self.model_dim]
 
-    async def detect_once(self, input: Image.Image, settings: Any, src_size, cvss):
-        def prepare():
-            im = np.array(input)
-            im = np.expand_dims(input, axis=0)
-            im = im.transpose((0, 3, 1, 2))  # BHWC to BCHW, (n, 3, h, w)
-            im = im.astype(np.float32) / 255.0
-            im = np.ascontiguousarray(im)  # contiguous
-            return im
-
-        def predict(input_tensor):
-            compiled_model = self.compiled_models[threading.current_thread().name]
-            output_tensors = compiled_model.run(None, {self.input_name: input_tensor})
+    def get_max_batch_size(self) -> int:
+        return self.max_batch_size
+
+    def get_batch_concurrency(self) -> int:
+        return len(self.deviceIds)
+
+    def predict(self, input_tensor: np.ndarray):
+        compiled_model = self.compiled_models[threading.current_thread().name]
+        output_tensors = compiled_model.run(None, {self.input_name: input_tensor})
+        ret = []
+        for i in range(input_tensor.shape[0]):
             if self.scrypted_yolov10:
-                return yolo.parse_yolov10(output_tensors[0][0])
-            if self.scrypted_yolo_nas:
-                return yolo.parse_yolo_nas([output_tensors[1], output_tensors[0]])
-            return yolo.parse_yolov9(output_tensors[0][0])
+                ret.append(yolo.parse_yolov10(output_tensors[0][i]))
+            elif self.scrypted_yolo_nas:
+                ret.append(
+                    yolo.parse_yolo_nas(
+                        [output_tensors[1][i : i + 1], output_tensors[0][i : i + 1]]
+                    )
+                )
+            else:
+                ret.append(yolo.parse_yolov9(output_tensors[0][i]))
+        return ret
 
+    async def detect_batch(self, inputs: list[np.ndarray]) -> list[Any]:
+        input_tensor = np.concatenate(inputs)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, lambda: self.predict(input_tensor)
+        )
+
+    async def detect_once(self, input: Image.Image, settings: Any, src_size, cvss):
+        if not self.input_writer:
+            self.input_writer = TensorWriter(self.get_input_size())
+
+        input_tensor = None
         try:
             input_tensor = await asyncio.get_event_loop().run_in_executor(
-                self.prepareExecutor, lambda: prepare()
-            )
-            objs = await asyncio.get_event_loop().run_in_executor(
-                self.executor, lambda: predict(input_tensor)
+                self.prepareExecutor, lambda: self.input_writer.prepare(input)
             )
+            if self.get_batch_size() > 1:
+                objs = await self.queue_batch(input_tensor)
+            else:
+                objs = await asyncio.get_event_loop().run_in_executor(
+                    self.executor, lambda: self.predict(input_tensor)[0]
+                )
 
         except:
 
             traceback.print_exc()
             raise
+        finally:
+            if input_tensor is not None:
+                self.input_writer.release(input_tensor)
 
         ret = self.create_detection_result(objs, src_size, cvss)
         return ret
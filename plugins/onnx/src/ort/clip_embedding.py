@@ -92,20 +92,21 @@ class ONNXClipEmbedding(ClipEmbedding):
         return objs
 
     async def getTextEmbedding(self, input):
-        compiled_models, executor = self.model
-        def predict():
-            inputs = self.processor(text=input, return_tensors="np", padding="max_length", truncation=True)
-            compiled_model = compiled_models[threading.current_thread().name]
-            text_session, _ = compiled_model
-            text_inputs = {
-                text_session.get_inputs()[0].name: inputs['input_ids'],
-                text_session.get_inputs()[1].name: inputs['attention_mask']
-            }
-            text_predictions = text_session.run(None, text_inputs)
-            text_embeds = text_predictions[0]
-            return bytearray(text_embeds.astype(np.float32).tobytes())
-
-        objs = await asyncio.get_event_loop().run_in_executor(
-            executor, predict
-        )
-        return objs
\ No newline at end of file
+        async with self.use_models():
+            compiled_models, executor = self.model
+            def predict():
+                inputs = self.processor(text=input, return_tensors="np", padding="max_length", truncation=True)
+                compiled_model = compiled_models[threading.current_thread().name]
+                text_session, _ = compiled_model
+                text_inputs = {
+                    text_session.get_inputs()[0].name: inputs['input_ids'],
+                    text_session.get_inputs()[1].name: inputs['attention_mask']
+                }
+                text_predictions = text_session.run(None, text_inputs)
+                text_embeds = text_predictions[0]
+                return bytearray(text_embeds.astype(np.float32).tobytes())
+
+            objs = await asyncio.get_event_loop().run_in_executor(
+                executor, predict
+            )
+            return objs
\ No newline at end of file
@@ -15,6 +15,9 @@ from predict.face_recognize import FaceRecognizeDetection
 
 
 class ONNXFaceRecognition(FaceRecognizeDetection):
+    # cleared if the face model was exported with a fixed batch size.
+    faceBatch = True
+
     def downloadModel(self, model: str):
         model_path = self.downloadHuggingFaceModelLocalFallback(model)
         onnxfile = os.path.join(model_path, f"{model}.onnx")
@@ -102,3 +105,15 @@ class ONNXFaceRecognition(FaceRecognizeDetection):
         )
 
         return objs[0]
+
+    async def predictFaceBatch(self, input: np.ndarray):
+        if not self.faceBatch or len(input) == 1:
+            return await super().predictFaceBatch(input)
+
+        try:
+            output = await self.predictFaceModel(np.ascontiguousarray(input))
+            return output.reshape(len(input), -1)
+        except Exception as e:
+            print("batched face embedding unsupported, embedding faces individually", e)
+            self.faceBatch = False
+            return await super().predictFaceBatch(input)
@@ -11,10 +11,13 @@ import numpy as np
 import onnxruntime
 from PIL import Image
 
+from common.text import TEXT_WIDTH_BUCKETS
 from predict.text_recognize import TextRecognition
 
 
 class ONNXTextRecognition(TextRecognition):
+    textInputShape = None
+
     def downloadModel(self, model: str):
         model_path = self.downloadHuggingFaceModelLocalFallback(model)
         onnxfile = os.path.join(model_path, f"{model}.onnx")
@@ -44,6 +47,8 @@ class ONNXTextRecognition(TextRecognition):
 
             input = compiled_model.get_inputs()[0]
             input_name = input.name
+            # dynamic dimensions are named rather than sized.
+            self.textInputShape = input.shape
 
         def executor_initializer():
             thread_name = threading.current_thread().name
@@ -92,3 +97,15 @@ class ONNXTextRecognition(TextRecognition):
         )
 
         return objs[0]
+
+    def get_text_width_buckets(self):
+        shape = self.textInputShape
+        if shape and isinstance(shape[3], int):
+            return [shape[3]]
+        return TEXT_WIDTH_BUCKETS
+
+    async def predictTextBatch(self, input: np.ndarray):
+        shape = self.textInputShape
+        if not shape or isinstance(shape[0], int):
+            return await super().predictTextBatch(input)
+        return await self.predictTextModel(input)
@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.request
+from typing import Any, List, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNK_SIZE = 8 * 1024 * 1024
+PARALLEL_CHUNKS = 4
+READ_SIZE = 1024 * 1024
+RETRIES = 3
+TIMEOUT = 60
+
+
+def get_model_cache_dir() -> str:
+    # the scrypted volume is shared by every plugin, so models downloaded by
+    # one detector plugin are reused by the others.
+    volume = os.environ.get("SCRYPTED_VOLUME")
+    if volume:
+        return os.path.join(volume, "model-cache")
+    return os.path.join(os.environ["SCRYPTED_PLUGIN_VOLUME"], "files", "model-cache")
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def link_file(src: str, dest: str):
+    # hard links keep the plugin's copy valid even if the cache is cleared,
+    # falling back to a copy across file systems.
+    tmp = dest + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+class ModelCache:
+    """
+    Content addressed download cache. Files are stored by their sha256 and
+    urls map to the hash of the file they served, so the same model is only
+    stored once, regardless of which plugin, or which url, downloaded it.
+
+    Downloads are written to a partial file and fetched in parallel chunks
+    when the server supports range requests. The completed chunks are
+    recorded as they finish, so an interrupted download resumes where it
+    left off. The file is verified against the expected hash, if one is
+    provided, before it is added to the cache.
+    """
+
+    def __init__(self, root: str, chunk_size: int = CHUNK_SIZE, parallel: int = PARALLEL_CHUNKS):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.parallel = parallel
+        self.objects = os.path.join(root, "sha256")
+        self.urls = os.path.join(root, "urls")
+        self.partial = os.path.join(root, "partial")
+        for d in [self.objects, self.urls, self.partial]:
+            os.makedirs(d, exist_ok=True)
+
+    def get_object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects, sha256)
+
+    def get_url_key(self, url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def read_json(self, path: str) -> Any:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def write_json(self, path: str, value: Any):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+
+    def lookup(self, url: str, sha256: str = None) -> str:
+        if sha256:
+            path = self.get_object_path(sha256)
+            return path if os.path.isfile(path) else None
+        index = self.read_json(os.path.join(self.urls, self.get_url_key(url) + ".json"))
+        if not index:
+            return None
+        path = self.get_object_path(index["sha256"])
+        return path if os.path.isfile(path) else None
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        # plugins run in separate processes, so concurrent downloads of the
+        # same url are serialized with a file lock.
+        if not fcntl:
+            yield
+            return
+        with open(os.path.join(self.partial, key + ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fetch(self, url: str, sha256: str = None) -> str:
+        sha256 = sha256 and sha256.lower()
+        found = self.lookup(url, sha256)
+        if found:
+            return found
+        key = self.get_url_key(url)
+        with self.lock(key):
+            # another process may have finished the download while waiting.
+            found = self.lookup(url, sha256)
+            if found:
+                return found
+            return self.download(url, key, sha256)
+
+    def open(self, url: str, start: int = None, end: int = None):
+        request = urllib.request.Request(url)
+        if start is not None:
+            request.add_header(
+                "Range", "bytes=%s-%s" % (start, "" if end is None else end)
+            )
+        response = urllib.request.urlopen(request, timeout=TIMEOUT)
+        if response.getcode() < 200 or response.getcode() >= 300:
+            raise Exception(f"non-2xx response code")
+        return response
+
+    def probe(self, url: str) -> Tuple[str, int, str, bool]:
+        # a single byte range request reveals the size and range support
+        # and follows any redirects to the final url.
+        with self.open(url, 0, 0) as response:
+            etag = response.headers.get("ETag")
+            final_url = response.geturl()
+            if response.getcode() == 206:
+                match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+                if match:
+                    return final_url, int(match.group(1)), etag, True
+            length = response.headers.get("Content-Length")
+            return final_url, int(length) if length else None, etag, False
+
+    def download(self, url: str, key: str, sha256: str = None) -> str:
+        part = os.path.join(self.partial, key + ".part")
+        state_path = part + ".json"
+
+        print("Downloading", url)
+        final_url, size, etag, ranges = self.probe(url)
+        state = self.read_json(state_path)
+        # a partial download is only resumed from the same version of the file.
+        if (
+            not state
+            or state.get("url") != url
+            or state.get("size") != size
+            or state.get("etag") != etag
+            or not os.path.isfile(part)
+        ):
+            state = {"url": url, "size": size, "etag": etag, "chunks": []}
+            with open(part, "wb") as f:
+                if size:
+                    f.truncate(size)
+            self.write_json(state_path, state)
+        elif state["chunks"]:
+            print("Resuming download", url, len(state["chunks"]), "chunks complete")
+
+        if ranges and size:
+            self.download_chunks(final_url, part, state, state_path)
+        else:
+            self.download_stream(final_url, part, size)
+
+        digest = sha256_file(part)
+        if sha256 and digest != sha256:
+            os.remove(part)
+            os.remove(state_path)
+            raise Exception(f"hash mismatch for {url}: expected {sha256}, got {digest}")
+
+        path = self.get_object_path(digest)
+        os.replace(part, path)
+        os.remove(state_path)
+        self.write_json(
+            os.path.join(self.urls, key + ".json"),
+            {"url": url, "sha256": digest, "size": os.path.getsize(path), "etag": etag},
+        )
+        print("Downloaded", url, os.path.getsize(path), "bytes", digest)
+        return path
+
+    def download_chunks(self, url: str, part: str, state: Any, state_path: str):
+        size = state["size"]
+        done = set(state["chunks"])
+        chunks = [
+            (i, start, min(size, start + self.chunk_size) - 1)
+            for i, start in enumerate(range(0, size, self.chunk_size))
+            if i not in done
+        ]
+        state_lock = threading.Lock()
+
+        def fetch_chunk(chunk: Tuple[int, int, int]):
+            index, start, end = chunk
+            for attempt in range(RETRIES):
+                try:
+                    with self.open(url, start, end) as response, open(part, "r+b") as f:
+                        if response.getcode() != 206:
+                            raise Exception("server ignored range request")
+                        f.seek(start)
+                        read = 0
+                        while True:
+                            data = response.read(READ_SIZE)
+                            if not data:
+                                break
+                            f.write(data)
+                            read += len(data)
+                    if read != end - start + 1:
+                        raise Exception(f"short read {read} of {end - start + 1} bytes")
+                    break
+                except Exception:
+                    if attempt == RETRIES - 1:
+                        raise
+                    time.sleep(2**attempt)
+
+            with state_lock:
+                state["chunks"].append(index)
+                self.write_json(state_path, state)
+
+        with concurrent.futures.ThreadPoolExecutor(self.parallel) as executor:
+            # consume the results to surface any chunk that failed.
+            list(executor.map(fetch_chunk, chunks))
+
+    def download_stream(self, url: str, part: str, size: int):
+        # servers without range support are fetched in a single request,
+        # and a failed download starts over.
+        with self.open(url) as response, open(part, "wb") as f:
+            read = 0
+            while True:
+                data = response.read(READ_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                read += len(data)
+        if size is not None and read != size:
+            raise Exception(f"short read {read} of {size} bytes")
+
+
+model_cache: ModelCache = None
+
+
+def get_model_cache() -> ModelCache:
+    global model_cache
+    if not model_cache:
+        model_cache = ModelCache(get_model_cache_dir())
+    return model_cache
+
+
+if __name__ == "__main__":
+    # exercises the cache against a local http server: python -m common.model_cache
+    # the server fails some requests midway to exercise retries and resume.
+    import http.server
+    import tempfile
+
+    payload = os.urandom(5 * CHUNK_SIZE // 2 + 12345)
+    payload_sha256 = hashlib.sha256(payload).hexdigest()
+    requests: List[str] = []
+    flaky = {"fail": 0, "after": 0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            ranges = self.path != "/noranges"
+            header = self.headers.get("Range")
+            requests.append(header)
+            match = ranges and header and re.match(r"bytes=(\d+)-(\d*)", header)
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else len(payload) - 1
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, len(payload)))
+            else:
+                start, end = 0, len(payload) - 1
+                self.send_response(200)
+            body = payload[start : end + 1]
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", '"%s"' % payload_sha256[:16])
+            self.end_headers()
+            if flaky["fail"] and len(body) > 1 and not flaky["after"]:
+                # drop the connection halfway through the body.
+                flaky["fail"] -= 1
+                self.wfile.write(body[: len(body) // 2])
+                self.close_connection = True
+                return
+            if len(body) > 1 and flaky["after"]:
+                flaky["after"] -= 1
+            self.wfile.write(body)
+
+    class Server(http.server.ThreadingHTTPServer):
+        def handle_error(self, request, client_address):
+            # the probe and the dropped connections reset sockets.
+            pass
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%s" % server.server_address[1]
+
+    with tempfile.TemporaryDirectory() as root:
+        cache = ModelCache(root)
+
+        path = cache.fetch(base + "/model.bin", payload_sha256)
+        assert open(path, "rb").read() == payload
+        print("parallel chunks:", len(requests) - 1, "range requests")
+
+        # a different url serving the same content is stored once.
+        requests.clear()
+        assert cache.fetch(base + "/model.bin", payload_sha256) == path
+        assert not requests
+        assert cache.fetch(base + "/mirror.bin") == path
+        assert len(os.listdir(cache.objects)) == 1
+        print("deduplicated:", len(os.listdir(cache.objects)), "stored file")
+
+        # an interrupted download resumes with the chunks that completed.
+        os.remove(path)
+        cache.parallel = 1
+        flaky["fail"] = 1
+        flaky["after"] = 2
+        original = RETRIES
+        RETRIES = 1
+        try:
+            cache.fetch(base + "/resume.bin")
+            raise Exception("expected failure")
+        except Exception as e:
+            print("interrupted:", e)
+        RETRIES = original
+        requests.clear()
+        assert open(cache.fetch(base + "/resume.bin"), "rb").read() == payload
+        print("resumed with", len(requests) - 1, "range requests")
+
+        # flaky chunks are retried.
+        os.remove(path)
+        flaky["fail"] = 2
+        cache.parallel = PARALLEL_CHUNKS
+        assert open(cache.fetch(base + "/flaky.bin"), "rb").read() == payload
+        print("retried flaky chunks")
+
+        # servers without range support.
+        os.remove(path)
+        assert open(cache.fetch(base + "/noranges"), "rb").read() == payload
+        print("downloaded without ranges")
+
+        # hash mismatches are rejected.
+        try:
+            cache.fetch(base + "/bad.bin", "0" * 64)
+            raise Exception("expected hash mismatch")
+        except Exception as e:
+            assert "hash mismatch" in str(e)
+            print("rejected:", e)
+
+    server.shutdown()
@@ -0,0 +1,230 @@
+from typing import Any, List
+
+import numpy as np
+
+NMS_BLOCK_SIZE = 64
+
+
+def box_area(boxes: np.ndarray) -> np.ndarray:
+    return np.clip(boxes[..., 2] - boxes[..., 0], 0, None) * np.clip(
+        boxes[..., 3] - boxes[..., 1], 0, None
+    )
+
+
+def box_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """
+    Pairwise intersection over union of two sets of boxes in
+    (xmin, ymin, xmax, ymax) format. Returns an (n, m) matrix.
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float32).reshape(-1, 4)
+    # per coordinate broadcasts are considerably faster than broadcasting
+    # (n, m, 2) corner arrays.
+    w = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    w -= np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    np.maximum(w, 0, out=w)
+    h = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    h -= np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    np.maximum(h, 0, out=h)
+    inter = w
+    inter *= h
+    union = box_area(boxes1)[:, None] + box_area(boxes2)[None, :]
+    union -= inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = inter / union
+    iou[~(union > 0)] = 0
+    return iou
+
+
+def nms(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    iou_threshold: float,
+    classes: np.ndarray = None,
+    max_detections: int = None,
+) -> np.ndarray:
+    """
+    Greedy non max suppression. Boxes are (xmin, ymin, xmax, ymax).
+    When classes are provided, boxes only suppress boxes of the same class.
+    Returns the indices of the kept boxes, highest score first.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores)
+    if not len(boxes):
+        return np.zeros((0,), dtype=np.int64)
+
+    if classes is not None:
+        # offset each class into its own coordinate space so boxes of
+        # different classes never overlap. the span, not the max, since
+        # shifted or transformed boxes may have negative coordinates.
+        offset = boxes.max() - boxes.min() + 1
+        boxes = boxes + (np.asarray(classes, dtype=np.float32) * offset)[:, None]
+
+    order = np.argsort(-scores, kind="stable")
+    boxes = boxes[order]
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    # the iou matrix is computed a block of rows at a time, which bounds
+    # memory while leaving only a cheap boolean update per kept box.
+    for start in range(0, len(boxes), NMS_BLOCK_SIZE):
+        end = min(len(boxes), start + NMS_BLOCK_SIZE)
+        # boxes suppressed by earlier blocks never need to be compared.
+        rows = start + np.flatnonzero(~suppressed[start:end])
+        columns = start + np.flatnonzero(~suppressed[start:])
+        overlaps = box_iou(boxes[rows], boxes[columns]) > iou_threshold
+        for row, i in enumerate(rows):
+            if suppressed[i]:
+                continue
+            keep.append(order[i])
+            if max_detections and len(keep) >= max_detections:
+                return np.array(keep, dtype=np.int64)
+            suppressed[columns[overlaps[row]]] = True
+    return np.array(keep, dtype=np.int64)
+
+
+def nms_detections(
+    detections: List[Any],
+    iou_threshold: float,
+    agnostic: bool = False,
+    max_detections: int = None,
+) -> List[Any]:
+    """
+    Non max suppression of ObjectDetectionResult dicts (boundingBox as
+    x, y, width, height). Unless agnostic, detections only suppress
+    detections of the same className. Returns the kept detections,
+    highest score first.
+    """
+    if len(detections) < 2:
+        return list(detections)
+    boxes = np.array([d["boundingBox"] for d in detections], dtype=np.float32)
+    boxes[:, 2:] += boxes[:, :2]
+    scores = np.array([d["score"] for d in detections], dtype=np.float32)
+    classes = None
+    if not agnostic:
+        classNames = {}
+        classes = np.array([classNames.setdefault(d["className"], len(classNames)) for d in detections])
+    keep = nms(boxes, scores, iou_threshold, classes, max_detections)
+    return [detections[i] for i in keep]
+
+
+if __name__ == "__main__":
+    # correctness and speed against the python loops it replaced: python -m common.nms
+    import time
+
+    def loop_box_iou(box1, box2):
+        # the previous common.yolov9_seg.box_iou.
+        area1 = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
+        area2 = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
+        iou = np.zeros((len(box1), len(box2)), dtype=np.float32)
+        for i in range(len(box1)):
+            for j in range(len(box2)):
+                inter_w = np.maximum(0, np.minimum(box1[i, 2], box2[j, 2]) - np.maximum(box1[i, 0], box2[j, 0]))
+                inter_h = np.maximum(0, np.minimum(box1[i, 3], box2[j, 3]) - np.maximum(box1[i, 1], box2[j, 1]))
+                inter_area = inter_w * inter_h
+                union = area1[i] + area2[j] - inter_area
+                iou[i, j] = inter_area / union if union > 0 else 0
+        return iou
+
+    def loop_nms(boxes, scores, iou_thres):
+        # the previous common.yolov9_seg.nms.
+        indices = np.argsort(-scores)
+        keep = []
+        while len(indices) > 0:
+            i = indices[0]
+            keep.append(i)
+            if len(indices) == 1:
+                break
+            iou_scores = loop_box_iou(boxes[indices[0:1]], boxes[indices[1:]])[0]
+            indices = indices[1:][iou_scores < iou_thres]
+        return np.array(keep, dtype=np.int32)
+
+    def loop_face_nms(detections, threshold):
+        # the previous pairwise suppression in FaceRecognizeDetection.
+        for i in range(len(detections)):
+            d1 = detections[i]
+            if d1["score"] < threshold:
+                continue
+            for j in range(i + 1, len(detections)):
+                d2 = detections[j]
+                if d2["score"] < threshold:
+                    continue
+                l1, t1, w1, h1 = d1["boundingBox"]
+                l2, t2, w2, h2 = d2["boundingBox"]
+                left = max(l1, l2)
+                top = max(t1, t2)
+                right = min(l1 + w1, l2 + w2)
+                bottom = min(t1 + h1, t2 + h2)
+                if left < right and top < bottom:
+                    intersect = (right - left) * (bottom - top)
+                    iou = intersect / (w1 * h1 + w2 * h2 - intersect)
+                    if iou > 0.5:
+                        if d1["score"] > d2["score"]:
+                            d2["score"] = 0
+                        else:
+                            d1["score"] = 0
+        return [d for d in detections if d["score"] >= threshold]
+
+    rng = np.random.default_rng(0)
+
+    def get_boxes(n: int):
+        # clusters of overlapping boxes, like raw detector output.
+        centers = rng.uniform(0, 640, (max(1, n // 8), 2))
+        xy = centers[rng.integers(0, len(centers), n)] + rng.normal(0, 8, (n, 2))
+        wh = rng.uniform(20, 80, (n, 2))
+        return np.concatenate([xy - wh / 2, xy + wh / 2], axis=1).astype(np.float32)
+
+    for n in [10, 100, 300]:
+        boxes = get_boxes(n)
+        scores = rng.uniform(0.25, 1, n).astype(np.float32)
+        assert np.allclose(box_iou(boxes, boxes), loop_box_iou(boxes, boxes), atol=1e-6)
+        expected = loop_nms(boxes, scores, 0.45)
+        assert np.array_equal(nms(boxes, scores, 0.45), expected)
+        assert np.array_equal(nms(boxes, scores, 0.45, max_detections=5), expected[:5])
+
+        start = time.perf_counter()
+        loop_nms(boxes, scores, 0.45)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        nms(boxes, scores, 0.45)
+        vector_time = time.perf_counter() - start
+        print("segmentation nms, %3d boxes: loop %7.2fms  vectorized %5.2fms" % (n, loop_time * 1000, vector_time * 1000))
+
+    # class aware suppression matches suppressing each class separately,
+    # including boxes with negative coordinates.
+    for shift in [0, -400, -2000]:
+        boxes = get_boxes(200) + shift
+        scores = rng.uniform(0.25, 1, 200).astype(np.float32)
+        classes = rng.integers(0, 3, 200)
+        keep = set(nms(boxes, scores, 0.45, classes).tolist())
+        expected = set()
+        for c in range(3):
+            indices = np.flatnonzero(classes == c)
+            expected.update(indices[loop_nms(boxes[indices], scores[indices], 0.45)].tolist())
+        assert keep == expected, shift
+    # with a max based offset, the second box lands exactly on the first.
+    boxes = np.array([[0, 0, 10, 10], [-11, -11, -1, -1]], dtype=np.float32)
+    assert nms(boxes, np.array([0.9, 0.8]), 0.45, np.array([0, 1])).tolist() == [0, 1]
+
+    # the face loop is order dependent: it matches greedy nms when the
+    # detections are in descending score order, which the detector produces.
+    differences = 0
+    for n in [2, 5, 20, 50]:
+        for _ in range(50):
+            boxes = get_boxes(n)
+            scores = np.sort(rng.uniform(0.3, 1, n))[::-1]
+            detections = [
+                {"className": "face", "score": float(s), "boundingBox": (b[0], b[1], b[2] - b[0], b[3] - b[1])}
+                for b, s in zip(boxes.tolist(), scores)
+            ]
+            kept = nms_detections([d for d in detections if d["score"] >= 0.5], 0.5)
+            expected = loop_face_nms([dict(d) for d in detections], 0.5)
+            assert [d["boundingBox"] for d in kept] == [d["boundingBox"] for d in expected]
+
+            # shuffled, the loop can drop a box whose only suppressor was
+            # itself suppressed.
+            order = rng.permutation(n)
+            shuffled = [dict(detections[i]) for i in order]
+            expected = loop_face_nms(shuffled, 0.5)
+            if sorted(d["boundingBox"] for d in kept) != sorted(d["boundingBox"] for d in expected):
+                differences += 1
+    print("face nms matches the previous loop, %s of 200 shuffled scenes differ" % differences)
@@ -0,0 +1,167 @@
+import threading
+from typing import List, Mapping, Tuple
+
+import numpy as np
+
+
+class TensorWriter:
+    """
+    Writes uint8 HWC images (PIL images or numpy arrays) directly into
+    preallocated model input tensors, converting layout and type in a single
+    pass instead of allocating intermediate arrays for each step.
+
+    Tensors are pooled per thread: acquire returns a free tensor owned by the
+    calling thread (allocating one only if they are all in use), and release
+    returns it to that thread's pool once inference no longer needs it.
+    """
+
+    def __init__(
+        self,
+        size: Tuple[int, int],
+        layout: str = "nchw",
+        dtype=np.float32,
+        quantization: Tuple[float, int] = None,
+        channels: int = 3,
+        batch: int = 1,
+    ):
+        self.width, self.height = size
+        self.layout = layout
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        if layout == "nchw":
+            self.shape = (batch, channels, self.height, self.width)
+        else:
+            self.shape = (batch, self.height, self.width, channels)
+
+        self.scale = None
+        self.zero_point = 0
+        if self.dtype.kind == "f":
+            self.scale = 1 / 255.0
+        elif self.dtype == np.int8:
+            scale, self.zero_point = quantization or (1 / 255.0, -128)
+            # the exported scrypted models are quantized at (roughly) 1/255
+            # with zero point -128, which is a plain offset of the uint8
+            # value, ie, flipping the sign bit.
+            offset = scale == 0.003986024297773838 or abs(scale * 255 - 1) < 1e-6
+            if not offset or self.zero_point != -128:
+                self.scale = 1 / (255.0 * scale)
+
+        self.pools: Mapping[str, List[np.ndarray]] = {}
+        self.owners: Mapping[int, List[np.ndarray]] = {}
+        self.local = threading.local()
+
+    def acquire(self) -> np.ndarray:
+        pool = self.pools.get(threading.current_thread().name)
+        if pool is None:
+            pool = self.pools[threading.current_thread().name] = []
+        if pool:
+            return pool.pop()
+        tensor = np.empty(self.shape, dtype=self.dtype)
+        self.owners[id(tensor)] = pool
+        return tensor
+
+    def release(self, tensor: np.ndarray):
+        pool = self.owners.get(id(tensor))
+        if pool is not None:
+            pool.append(tensor)
+
+    def get_scratch(self, name: str, dtype) -> np.ndarray:
+        scratch = getattr(self.local, name, None)
+        if scratch is None:
+            scratch = np.empty(self.shape[1:], dtype=dtype)
+            setattr(self.local, name, scratch)
+        return scratch
+
+    def write(self, image, tensor: np.ndarray, index: int = 0) -> np.ndarray:
+        src = np.asarray(image)
+        if src.shape != (self.height, self.width, self.channels):
+            raise Exception(
+                "unexpected input shape %s, expected %s"
+                % (src.shape, (self.height, self.width, self.channels))
+            )
+
+        if self.layout == "nchw":
+            # transposing the uint8 data into planes first is cheaper than
+            # converting through a strided view of either side.
+            planar = self.get_scratch("planar", np.uint8)
+            np.copyto(planar, src.transpose((2, 0, 1)))
+            src = planar
+
+        out = tensor[index]
+        if self.dtype.kind == "f":
+            np.multiply(src, self.scale, out=out, dtype=self.dtype, casting="unsafe")
+        elif self.dtype == np.int8 and self.scale is None:
+            np.bitwise_xor(src, 0x80, out=out.view(np.uint8))
+        elif self.dtype == np.int8:
+            # float scratch space for the general quantization path.
+            scaled = self.get_scratch("scaled", np.float32)
+            np.multiply(src, self.scale, out=scaled, dtype=np.float32)
+            scaled += self.zero_point
+            np.copyto(out, scaled, casting="unsafe")
+        else:
+            np.copyto(out, src, casting="unsafe")
+        return tensor
+
+    def prepare(self, image) -> np.ndarray:
+        return self.write(image, self.acquire())
+
+
+if __name__ == "__main__":
+    # compares the per frame allocations previously used by the backends
+    # with writing into a reused tensor.
+    import time
+
+    def benchmark(name: str, f, iterations: int = 200):
+        f()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            f()
+        elapsed = time.perf_counter() - start
+        print("%-32s %8.3f ms" % (name, elapsed / iterations * 1000))
+
+    for size in [320, 640]:
+        image = np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+        print("%sx%s" % (size, size))
+
+        def openvino_current():
+            im = np.expand_dims(image, axis=0)
+            im = im.transpose((0, 3, 1, 2))
+            im = im.astype(np.float32) / 255.0
+            return np.ascontiguousarray(im)
+
+        def tflite_current():
+            im = np.stack([image])
+            scale, zero_point = 0.0039215, -10
+            im = im.astype(np.float32) / (255.0 * scale)
+            return (im + zero_point).astype(np.int8)
+
+        def tflite_fast_current():
+            im = np.stack([image])
+            im = im.view(np.int8)
+            # the backend used im -= 128, which numpy 2 rejects for int8.
+            im += np.int8(-128)
+            return im
+
+        nchw = TensorWriter((size, size))
+        nhwc = TensorWriter((size, size), layout="nhwc")
+        int8 = TensorWriter((size, size), "nhwc", np.int8, (0.0039215, -10))
+        int8_fast = TensorWriter((size, size), "nhwc", np.int8, (0.003986024297773838, -128))
+
+        def writer(w: TensorWriter):
+            def run():
+                w.release(w.prepare(image))
+
+            return run
+
+        assert np.allclose(openvino_current(), writer_out := nchw.prepare(image))
+        nchw.release(writer_out)
+        assert np.array_equal(tflite_current(), int8.prepare(image))
+        assert np.array_equal(tflite_fast_current(), int8_fast.prepare(image))
+
+        benchmark("float nchw (current)", openvino_current)
+        benchmark("float nchw (writer)", writer(nchw))
+        benchmark("float nhwc (writer)", writer(nhwc))
+        benchmark("int8 nhwc (current)", tflite_current)
+        benchmark("int8 nhwc (writer)", writer(int8))
+        benchmark("int8 1/255 nhwc (current)", tflite_fast_current)
+        benchmark("int8 1/255 nhwc (writer)", writer(int8_fast))
@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import time
+from typing import Any, List, Mapping, Tuple
+
+import numpy as np
+
+from common.nms import box_iou
+
+# relative noise of the constant velocity kalman filter, as in sort/bytetrack.
+STD_WEIGHT_POSITION = 1 / 20
+STD_WEIGHT_VELOCITY = 1 / 160
+
+
+class Track:
+    def __init__(self, id: str, className: str, now: float):
+        self.id = id
+        self.className = className
+        # epoch milliseconds, like ObjectDetectionHistory.
+        self.first_seen = now
+        self.last_seen = now
+        self.hits = 1
+        self.misses = 0
+        # when (epoch milliseconds) second stage models last processed this
+        # track, by model.
+        self.processed: Mapping[str, float] = {}
+
+    @property
+    def age(self) -> float:
+        # seconds the object has been tracked.
+        return (self.last_seen - self.first_seen) / 1000
+
+
+class Tracker:
+    """
+    Multi object tracker in the style of SORT and ByteTrack: each track has a
+    constant velocity kalman filter over its box center and size. Every frame,
+    the tracks are predicted forward and matched to the detections of the
+    same class by IoU, first the confident detections, then the low scoring
+    ones against the tracks that are still unmatched, which keeps an object
+    tracked through partial occlusion. The kalman state of all tracks is kept
+    in arrays so predict and update are vectorized across tracks.
+
+    Detections matched to a track are assigned its id and history, and
+    unmatched confident detections start new tracks. Tracks that are not seen
+    for max_age seconds are removed.
+    """
+
+    def __init__(
+        self,
+        iou_threshold: float = 0.3,
+        low_iou_threshold: float = 0.5,
+        high_score: float = 0.5,
+        max_age: float = 3,
+        size: Tuple[int, int] = None,
+    ):
+        # the frame size the boxes are in.
+        self.size = size
+        self.iou_threshold = iou_threshold
+        self.low_iou_threshold = low_iou_threshold
+        self.high_score = high_score
+        self.max_age = max_age
+        self.next_id = 1
+        self.tracks: List[Track] = []
+        self.mean = np.zeros((0, 8), dtype=np.float64)
+        self.covariance = np.zeros((0, 8, 8), dtype=np.float64)
+        self.last_update: float = None
+
+        self.motion = np.eye(8)
+        self.motion[:4, 4:] = np.eye(4)
+        self.project = np.eye(4, 8)
+
+    def get_track(self, id: str) -> Track:
+        for track in self.tracks:
+            if track.id == id:
+                return track
+        return None
+
+    def predict(self):
+        if not self.tracks:
+            return
+        wh = self.mean[:, [2, 3, 2, 3]]
+        std = np.concatenate([wh * STD_WEIGHT_POSITION, wh * STD_WEIGHT_VELOCITY], axis=1)
+        self.mean = self.mean @ self.motion.T
+        self.covariance = self.motion @ self.covariance @ self.motion.T
+        self.covariance += np.einsum("ni,ij->nij", std**2, np.eye(8))
+
+    def correct(self, indices: np.ndarray, measurements: np.ndarray):
+        mean = self.mean[indices]
+        covariance = self.covariance[indices]
+        wh = measurements[:, [2, 3, 2, 3]]
+        r = np.einsum("ni,ij->nij", (wh * STD_WEIGHT_POSITION) ** 2, np.eye(4))
+        s = self.project @ covariance @ self.project.T + r
+        # kalman gain: P H^T S^-1, solved rather than inverted.
+        pht = covariance @ self.project.T
+        gain = np.linalg.solve(s, pht.transpose(0, 2, 1)).transpose(0, 2, 1)
+        innovation = measurements - mean[:, :4]
+        self.mean[indices] = mean + np.einsum("nij,nj->ni", gain, innovation)
+        self.covariance[indices] = covariance - gain @ s @ gain.transpose(0, 2, 1)
+
+    def initiate(self, measurements: np.ndarray):
+        wh = measurements[:, [2, 3, 2, 3]]
+        std = np.concatenate(
+            [2 * STD_WEIGHT_POSITION * wh, 10 * STD_WEIGHT_VELOCITY * wh], axis=1
+        )
+        mean = np.concatenate([measurements, np.zeros_like(measurements)], axis=1)
+        self.mean = np.concatenate([self.mean, mean])
+        self.covariance = np.concatenate(
+            [self.covariance, np.einsum("ni,ij->nij", std**2, np.eye(8))]
+        )
+
+    def get_track_boxes(self) -> np.ndarray:
+        # xmin, ymin, xmax, ymax of the predicted tracks.
+        c = self.mean[:, :2]
+        half = np.abs(self.mean[:, 2:4]) / 2
+        return np.concatenate([c - half, c + half], axis=1)
+
+    def match(
+        self,
+        detections: np.ndarray,
+        tracks: np.ndarray,
+        boxes: np.ndarray,
+        track_boxes: np.ndarray,
+        same_class: np.ndarray,
+        threshold: float,
+        matches: List[Any],
+    ):
+        # greedy assignment by descending IoU, which is close to the optimal
+        # assignment at the object densities of a camera scene.
+        if not len(detections) or not len(tracks):
+            return detections, tracks
+        iou = box_iou(boxes[detections], track_boxes[tracks])
+        iou[~same_class[np.ix_(detections, tracks)]] = 0
+        rows, columns = np.nonzero(iou >= threshold)
+        order = np.argsort(-iou[rows, columns], kind="stable")
+        used_detections = set()
+        used_tracks = set()
+        for row, column in zip(rows[order], columns[order]):
+            if row in used_detections or column in used_tracks:
+                continue
+            used_detections.add(row)
+            used_tracks.add(column)
+            matches.append((detections[row], tracks[column]))
+        unmatched_detections = np.array(
+            [d for i, d in enumerate(detections) if i not in used_detections], dtype=np.int64
+        )
+        unmatched_tracks = np.array(
+            [t for i, t in enumerate(tracks) if i not in used_tracks], dtype=np.int64
+        )
+        return unmatched_detections, unmatched_tracks
+
+    def update(self, detections: List[Any], now: float = None) -> List[Any]:
+        """
+        Assigns track ids and history to the detections (ObjectDetectionResult
+        dicts with boundingBox as x, y, width, height), in place.
+        """
+        now = now if now is not None else time.time() * 1000
+        self.last_update = now
+        self.predict()
+
+        # motion and other pseudo detections are not tracked.
+        indices = [i for i, d in enumerate(detections) if d["className"] != "motion"]
+        xywh = np.array(
+            [detections[i]["boundingBox"] for i in indices], dtype=np.float64
+        ).reshape(-1, 4)
+        boxes = np.concatenate([xywh[:, :2], xywh[:, :2] + xywh[:, 2:]], axis=1)
+        measurements = np.concatenate([xywh[:, :2] + xywh[:, 2:] / 2, xywh[:, 2:]], axis=1)
+        scores = np.array([detections[i]["score"] for i in indices], dtype=np.float64)
+        classes = [detections[i]["className"] for i in indices]
+        same_class = np.array(
+            [[c == t.className for t in self.tracks] for c in classes], dtype=bool
+        ).reshape(len(classes), len(self.tracks))
+
+        track_boxes = self.get_track_boxes()
+        all_tracks = np.arange(len(self.tracks))
+        matches: List[Any] = []
+        high = np.flatnonzero(scores >= self.high_score)
+        low = np.flatnonzero(scores < self.high_score)
+        unmatched_high, unmatched_tracks = self.match(
+            high, all_tracks, boxes, track_boxes, same_class, self.iou_threshold, matches
+        )
+        # low scoring detections only continue tracks that were seen last frame.
+        recent = np.array(
+            [t for t in unmatched_tracks if not self.tracks[t].misses], dtype=np.int64
+        )
+        self.match(
+            low, recent, boxes, track_boxes, same_class, self.low_iou_threshold, matches
+        )
+
+        matched_tracks = set()
+        if matches:
+            detection_indices = np.array([m[0] for m in matches])
+            track_indices = np.array([m[1] for m in matches])
+            self.correct(track_indices, measurements[detection_indices])
+            for d, t in matches:
+                track = self.tracks[t]
+                track.last_seen = now
+                track.hits += 1
+                track.misses = 0
+                matched_tracks.add(t)
+                self.assign(detections[indices[d]], track)
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+
+        # drop the tracks that have not been seen in a while.
+        keep = [
+            t
+            for t, track in enumerate(self.tracks)
+            if now - track.last_seen <= self.max_age * 1000
+        ]
+        if len(keep) != len(self.tracks):
+            self.tracks = [self.tracks[t] for t in keep]
+            self.mean = self.mean[keep]
+            self.covariance = self.covariance[keep]
+
+        if len(unmatched_high):
+            self.initiate(measurements[unmatched_high])
+            for d in unmatched_high:
+                track = Track(str(self.next_id), classes[d], now)
+                self.next_id += 1
+                self.tracks.append(track)
+                self.assign(detections[indices[d]], track)
+
+        return detections
+
+    def assign(self, detection: Any, track: Track):
+        detection["id"] = track.id
+        detection["history"] = {
+            "firstSeen": track.first_seen,
+            "lastSeen": track.last_seen,
+        }
+
+    def should_process(self, id: str, key: str, interval: float, now: float = None) -> bool:
+        """
+        Whether a second stage model (key) should process the tracked object,
+        ie, it has not processed it within interval seconds. Untracked
+        detections are always processed.
+        """
+        track = id and self.get_track(id)
+        if not track:
+            return True
+        now = now if now is not None else time.time() * 1000
+        last = track.processed.get(key)
+        if last is not None and now - last < interval * 1000:
+            return False
+        track.processed[key] = now
+        return True
+
+
+if __name__ == "__main__":
+    # synthetic scene: python -m common.tracker
+    # objects cross paths with noisy boxes, missed detections and low scores,
+    # and the ids must stay stable. also times an update with many objects.
+    rng = np.random.default_rng(0)
+
+    def scene(objects: int, frames: int, miss: float = 0.1):
+        starts = rng.uniform(0, 1500, (objects, 2))
+        velocity = rng.uniform(-15, 15, (objects, 2))
+        sizes = rng.uniform(60, 200, (objects, 2))
+        for f in range(frames):
+            detections = []
+            for o in range(objects):
+                if rng.uniform() < miss:
+                    continue
+                x, y = starts[o] + velocity[o] * f + rng.normal(0, 2, 2)
+                w, h = sizes[o] + rng.normal(0, 2, 2)
+                detections.append(
+                    {
+                        "className": "person" if o % 2 else "vehicle",
+                        "score": float(rng.uniform(0.3, 0.95)),
+                        "boundingBox": (x, y, w, h),
+                        "object": o,
+                    }
+                )
+            yield f, detections
+
+    tracker = Tracker()
+    objects = 12
+    ids: Mapping[int, set] = {}
+    for f, detections in scene(objects, 200):
+        tracker.update(detections, f * 100)
+        for d in detections:
+            if "id" in d:
+                ids.setdefault(d["object"], set()).add(d["id"])
+    switches = sum(len(v) - 1 for v in ids.values())
+    print("%s objects, 200 frames: %s tracks, %s id switches" % (objects, tracker.next_id - 1, switches))
+
+    for objects in [10, 50, 200]:
+        tracker = Tracker()
+        frames = list(scene(objects, 50, 0))
+        start = time.perf_counter()
+        for f, detections in frames:
+            tracker.update(detections, f * 100)
+        elapsed = (time.perf_counter() - start) / len(frames)
+        print("%4s objects: %.3f ms per update" % (objects, elapsed * 1000))
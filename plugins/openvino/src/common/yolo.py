@@ -1,94 +1,69 @@
 from math import exp
 import numpy as np
 
-from predict import Prediction
+from common.nms import nms
+from predict import Prediction, Predictions
 from predict.rectangle import Rectangle
 
 defaultThreshold = .2
 
-def parse_yolov10(results, threshold = defaultThreshold, scale = None, confidence_scale  = None, threshold_scale = None):
-    objs: list[Prediction] = []
+def select_candidates(results, keep, classes):
+    # one candidate per (class, anchor) kept, ordered by class then anchor.
+    class_ids, indices = np.nonzero(keep)
+    if classes is not None:
+        allowed = np.isin(class_ids, classes)
+        class_ids = class_ids[allowed]
+        indices = indices[allowed]
+    confidences = results[class_ids + 4, indices].astype(np.float32)
+    coords = results[:4, indices].astype(np.float32)
+    return class_ids, confidences, coords
+
+def finish_candidates(boxes, scores, class_ids, confidence_scale, iou_threshold, max_detections):
+    if confidence_scale:
+        scores = confidence_scale(scores)
+    if iou_threshold is not None:
+        keep = nms(boxes, scores, iou_threshold, class_ids, max_detections)
+        boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+    elif max_detections:
+        keep = np.argsort(-scores, kind="stable")[:max_detections]
+        boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+    return Predictions(boxes, scores, class_ids)
+
+def parse_yolov10(results, threshold = defaultThreshold, scale = None, confidence_scale  = None, threshold_scale = None, classes = None, iou_threshold = None, max_detections = None):
+    # yolov10 models output (left, top, right, bottom, class scores...) per anchor.
     if not threshold_scale:
-        keep = np.argwhere(results[4:] > threshold)
+        keep = results[4:] > threshold
     else:
-        keep = np.argwhere(results[4:] > threshold_scale(results[4:]))
-    for indices in keep:
-        class_id = indices[0]
-        index = indices[1]
-        confidence = results[class_id + 4, index]
-        l = results[0][index]
-        t = results[1][index]
-        r = results[2][index]
-        b = results[3][index]
-        if scale:
-            l = scale(l)
-            t = scale(t)
-            r = scale(r)
-            b = scale(b)
-        if confidence_scale:
-            confidence = confidence_scale(confidence)
-        obj = Prediction(
-            int(class_id),
-            confidence,
-            Rectangle(
-                l,
-                t,
-                r,
-                b,
-            ),
-        )
-        objs.append(obj)
-
-    return objs
+        keep = results[4:] > threshold_scale(results[4:].astype(np.float32))
+    class_ids, confidences, coords = select_candidates(results, keep, classes)
+    if scale:
+        coords = scale(coords)
+    boxes = coords.T
+    return finish_candidates(boxes, confidences, class_ids, confidence_scale, iou_threshold, max_detections)
 
 def parse_yolo_nas(predictions):
-    objs = []
+    boxes, scores, class_ids = [], [], []
     for pred_scores, pred_bboxes in zip(*predictions):
         i, j = np.nonzero(pred_scores > .5)
-        pred_bboxes = pred_bboxes[i]
-        pred_cls_conf = pred_scores[i, j]
-        pred_cls_label = j[:]
-        for box, conf, label in zip(pred_bboxes, pred_cls_conf, pred_cls_label):
-            obj = Prediction(
-                int(label), conf, Rectangle(box[0], box[1], box[2], box[3])
-            )
-            objs.append(obj)
-    return objs
-
-def parse_yolov9(results, threshold = defaultThreshold, scale = None, confidence_scale  = None, threshold_scale = None):
-    objs: list[Prediction] = []
+        boxes.append(pred_bboxes[i].astype(np.float32))
+        scores.append(pred_scores[i, j].astype(np.float32))
+        class_ids.append(j)
+    if not boxes:
+        return Predictions(np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.int64))
+    return Predictions(np.concatenate(boxes), np.concatenate(scores), np.concatenate(class_ids))
+
+def parse_yolov9(results, threshold = defaultThreshold, scale = None, confidence_scale  = None, threshold_scale = None, classes = None, iou_threshold = None, max_detections = None):
+    # yolov9 models output (center x, center y, width, height, class scores...) per anchor.
     if not threshold_scale:
-        keep = np.argwhere(results[4:] > threshold)
+        keep = results[4:] > threshold
     else:
-        keep = np.argwhere(threshold_scale(results[4:]) > threshold)
-    for indices in keep:
-        class_id = indices[0]
-        index = indices[1]
-        confidence = results[class_id + 4, index]
-        x = results[0][index]
-        y = results[1][index]
-        w = results[2][index]
-        h = results[3][index]
-        if scale:
-            x = scale(x)
-            y = scale(y)
-            w = scale(w)
-            h = scale(h)
-        if confidence_scale:
-            confidence = confidence_scale(confidence)
-        obj = Prediction(
-            int(class_id),
-            confidence,
-            Rectangle(
-                x - w / 2,
-                y - h / 2,
-                x + w / 2,
-                y + h / 2,
-            ),
-        )
-        objs.append(obj)
-
-    return objs
+        keep = threshold_scale(results[4:].astype(np.float32)) > threshold
+    class_ids, confidences, coords = select_candidates(results, keep, classes)
+    if scale:
+        coords = scale(coords)
+    x, y, w, h = coords
+    boxes = np.stack((x - w / 2, y - h / 2, x + w / 2, y + h / 2), axis=1)
+    return finish_candidates(boxes, confidences, class_ids, confidence_scale, iou_threshold, max_detections)
 
 def sig(x):
     return 1/(1 + np.exp(-x))
@@ -218,3 +193,65 @@ def parse_yolo_region(blob, original_im_shape, anchors, sigmoid = True):
 
     objects = list(filter(lambda o: o['confidence'] > 0, objects))
     return objects
+
+if __name__ == "__main__":
+    # dense scene benchmark: python -m common.yolo
+    # compares the previous per candidate python decode with the vectorized one.
+    import time
+
+    from predict import PredictPlugin
+
+    class Plugin:
+        labels = {}
+        create_detection_result = PredictPlugin.create_detection_result
+        create_detection_result_arrays = PredictPlugin.create_detection_result_arrays
+
+    def parse_yolov9_loop(results, threshold = defaultThreshold):
+        objs = []
+        keep = np.argwhere(results[4:] > threshold)
+        for indices in keep:
+            class_id = indices[0]
+            index = indices[1]
+            confidence = results[class_id + 4, index]
+            x = results[0][index]
+            y = results[1][index]
+            w = results[2][index]
+            h = results[3][index]
+            objs.append(Prediction(int(class_id), confidence, Rectangle(x - w / 2, y - h / 2, x + w / 2, y + h / 2)))
+        return objs
+
+    def benchmark(name, f, iterations = 20):
+        f()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            ret = f()
+        print("%-36s %8.3f ms" % (name, (time.perf_counter() - start) / iterations * 1000))
+        return ret
+
+    plugin = Plugin()
+    rng = np.random.default_rng(0)
+    for candidates in [100, 1000, 5000]:
+        # crowded scene: objects each detected by ~20 neighboring anchors.
+        results = np.zeros((84, 8400), dtype=np.float32)
+        objects = candidates // 20
+        centers = rng.uniform(0, 640, (objects, 2))
+        sizes = rng.uniform(20, 120, (objects, 2))
+        classes = rng.integers(0, 80, objects)
+        anchors = rng.choice(8400, candidates, replace=False)
+        owner = rng.integers(0, objects, candidates)
+        results[0:2, anchors] = (centers[owner] + rng.normal(0, 3, (candidates, 2))).T
+        results[2:4, anchors] = (sizes[owner] * rng.uniform(0.9, 1.1, (candidates, 2))).T
+        results[4 + classes[owner], anchors] = rng.uniform(0.25, 1, candidates)
+        print("%s candidates" % candidates)
+
+        legacy = benchmark("python loop", lambda: parse_yolov9_loop(results))
+        vectorized = benchmark("vectorized", lambda: parse_yolov9(results))
+        assert len(legacy) == len(vectorized)
+        for a, b in zip(legacy, vectorized):
+            assert a.id == b.id and abs(a.score - b.score) < 1e-6
+            assert np.allclose([a.bbox.xmin, a.bbox.ymin, a.bbox.xmax, a.bbox.ymax], [b.bbox.xmin, b.bbox.ymin, b.bbox.xmax, b.bbox.ymax], atol=1e-3)
+
+        benchmark("python loop + detection result", lambda: plugin.create_detection_result(parse_yolov9_loop(results), (640, 640)))
+        benchmark("vectorized + detection result", lambda: plugin.create_detection_result(parse_yolov9(results), (640, 640)))
+        nms_result = benchmark("vectorized + nms", lambda: parse_yolov9(results, iou_threshold=0.5))
+        print("%36s %8d" % ("kept after nms", len(nms_result)))
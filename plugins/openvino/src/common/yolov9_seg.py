@@ -9,6 +9,8 @@ import numpy as np
 import cv2
 import time
 
+from common.nms import box_iou, nms
+
 def crop_mask_numpy(masks, boxes):
     """
     Crop predicted masks by zeroing out everything not in the predicted bbox.
@@ -211,52 +213,6 @@ def xywh2xyxy(x):
     return y
 
 
-def box_iou(box1, box2):
-    """Calculate IoU between two sets of boxes"""
-    area1 = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
-    area2 = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
-
-    iou = np.zeros((len(box1), len(box2)), dtype=np.float32)
-
-    for i in range(len(box1)):
-        for j in range(len(box2)):
-            inter_x1 = np.maximum(box1[i, 0], box2[j, 0])
-            inter_y1 = np.maximum(box1[i, 1], box2[j, 1])
-            inter_x2 = np.minimum(box1[i, 2], box2[j, 2])
-            inter_y2 = np.minimum(box1[i, 3], box2[j, 3])
-
-            inter_w = np.maximum(0, inter_x2 - inter_x1)
-            inter_h = np.maximum(0, inter_y2 - inter_y1)
-            inter_area = inter_w * inter_h
-
-            union = area1[i] + area2[j] - inter_area
-            iou[i, j] = inter_area / union if union > 0 else 0
-
-    return iou
-
-
-def nms(boxes, scores, iou_thres):
-    """Non-Maximum Suppression implementation in NumPy"""
-    if len(boxes) == 0:
-        return np.array([], dtype=np.int32)
-
-    indices = np.argsort(-scores)
-
-    keep = []
-    while len(indices) > 0:
-        i = indices[0]
-        keep.append(i)
-
-        if len(indices) == 1:
-            break
-
-        iou_scores = box_iou(boxes[indices[0:1]], boxes[indices[1:]])[0]
-
-        indices = indices[1:][iou_scores < iou_thres]
-
-    return np.array(keep, dtype=np.int32)
-
-
 def non_max_suppression(
         prediction,
         conf_thres=0.25,
@@ -336,9 +292,7 @@ def non_max_suppression(
 
         c = x[:, 5:6] * (0 if agnostic else max_wh)
         boxes, scores = x[:, :4] + c, x[:, 4]
-        i = nms(boxes, scores, iou_thres)
-        if i.shape[0] > max_det:
-            i = i[:max_det]
+        i = nms(boxes, scores, iou_thres, max_detections=max_det)
         if merge and (1 < n < 3E3):
             iou = box_iou(boxes[i], boxes) > iou_thres
             weights = iou * scores[None]
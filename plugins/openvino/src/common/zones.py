@@ -0,0 +1,103 @@
+from typing import Any, List, Tuple
+
+# zone geometry, ported from plugins/objectdetector/src/polygon.ts so
+# detections are matched to zones the same way the object detector does.
+# zone paths are normalized (0 to 1) points, boxes are (x, y, w, h).
+
+
+def fix_legacy_clip_path(clip_path: List[Tuple[float, float]]):
+    if not clip_path:
+        return clip_path
+    # older zones were stored as percentages.
+    if any(abs(c) >= 2 for p in clip_path for c in p):
+        return [(p[0] / 100, p[1] / 100) for p in clip_path]
+    return clip_path
+
+
+def line_intersects(p1, p2, p3, p4) -> bool:
+    x1, y1 = p1
+    x2, y2 = p2
+    x3, y3 = p3
+    x4, y4 = p4
+    denom = (y4 - y3) * (x2 - x1) - (x4 - x3) * (y2 - y1)
+    if denom == 0:
+        return False
+    ua = ((x4 - x3) * (y1 - y3) - (y4 - y3) * (x1 - x3)) / denom
+    ub = ((x2 - x1) * (y1 - y3) - (y2 - y1) * (x1 - x3)) / denom
+    return 0 <= ua <= 1 and 0 <= ub <= 1
+
+
+def point_in_polygon(point, polygon) -> bool:
+    x, y = point
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        xi, yi = polygon[i]
+        xj, yj = polygon[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def bounding_box_to_points(box):
+    x, y, w, h = box
+    return [(x, y), (x + w, y), (x + w, y + h), (x, y + h)]
+
+
+def polygon_intersects_bounding_box(polygon, box) -> bool:
+    box_points = bounding_box_to_points(box)
+    for i in range(len(polygon)):
+        p1 = polygon[i]
+        p2 = polygon[(i + 1) % len(polygon)]
+        for j in range(len(box_points)):
+            if line_intersects(p1, p2, box_points[j], box_points[(j + 1) % len(box_points)]):
+                return True
+    return point_in_polygon(polygon[0], box_points) or point_in_polygon(box_points[0], polygon)
+
+
+def polygon_contains_bounding_box(polygon, box) -> bool:
+    return all(point_in_polygon(p, polygon) for p in bounding_box_to_points(box))
+
+
+def get_inclusion_zones(zones: List[Any]) -> List[Any]:
+    ret = []
+    for zone in zones or []:
+        path = fix_legacy_clip_path(zone.get("path"))
+        if zone.get("exclusion") or not path or len(path) < 3:
+            continue
+        ret.append({**zone, "path": path})
+    return ret
+
+
+def get_zones_bounds(zones: List[Any]) -> Tuple[float, float, float, float]:
+    # normalized (left, top, right, bottom) covering every zone.
+    xs = [min(1, max(0, p[0])) for zone in zones for p in zone["path"]]
+    ys = [min(1, max(0, p[1])) for zone in zones for p in zone["path"]]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def detection_in_zone(
+    detection: Any, zone: Any, size: Tuple[float, float], model_classes: List[str] = None
+) -> bool:
+    # zones without classes match the detection model's classes.
+    classes = zone.get("classes") or model_classes
+    if classes and detection["className"] not in classes:
+        return False
+    x, y, w, h = detection["boundingBox"]
+    box = (x / size[0], y / size[1], w / size[0], h / size[1])
+    if zone.get("type") == "Contain":
+        return polygon_contains_bounding_box(zone["path"], box)
+    return polygon_intersects_bounding_box(zone["path"], box)
+
+
+def filter_zone_detections(
+    detections: List[Any], zones: List[Any], size: Tuple[float, float], model_classes: List[str] = None
+) -> List[Any]:
+    # keep only the detections the object detector would match to an inclusion zone.
+    return [
+        d
+        for d in detections
+        if d["className"] == "motion"
+        or any(detection_in_zone(d, zone, size, model_classes) for zone in zones)
+    ]
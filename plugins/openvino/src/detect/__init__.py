@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import time
 from typing import Any, Tuple
 
 import scrypted_sdk
@@ -16,6 +17,30 @@ from scrypted_sdk.types import (
 )
 
 
+class PrefetchedImage:
+    """
+    Wraps an Image whose input buffer was already fetched by the prefetch
+    stage. Requests for the same buffer options are served from memory, anything
+    else (crops for second stage models, etc) is passed through to the image.
+    """
+
+    def __init__(self, image: scrypted_sdk.Image, options: Any, buffer: bytes):
+        self.image = image
+        self.options = options
+        self.buffer = buffer
+
+    async def toBuffer(self, options: Any = None):
+        if self.buffer is not None and options == self.options:
+            return self.buffer
+        return await self.image.toBuffer(options)
+
+    async def toImage(self, options: Any = None):
+        return await self.image.toImage(options)
+
+    def __getattr__(self, name: str):
+        return getattr(self.image, name)
+
+
 class DetectPlugin(
     scrypted_sdk.ScryptedDeviceBase,
     ObjectDetection,
@@ -24,6 +49,8 @@ class DetectPlugin(
         super().__init__(nativeId=nativeId)
         self.loop = asyncio.get_event_loop()
         self.modelName = self.pluginId
+        # prefetched frames dropped for exceeding the max age.
+        self.prefetch_dropped = 0
 
     def getClasses(self) -> list[str]:
         pass
@@ -62,9 +89,77 @@ class DetectPlugin(
     ) -> ObjectsDetected:
         pass
 
+    # fetch (and optionally convert) the image while the previous frame is
+    # in inference. the returned image is passed to run_detection_image.
+    async def prefetch_detection_image(
+        self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
+    ) -> scrypted_sdk.Image:
+        return image
+
+    # the number of frames fetched ahead of the frame being detected.
+    # 0 disables pipelining. this is opt in because some frame generators
+    # (python-codecs) reuse or close the previous frame's image when they
+    # advance, which would pull the image out from under a detection that
+    # is still cropping it.
+    def get_prefetch_depth(self) -> int:
+        try:
+            prefetch_depth = self.storage.getItem("prefetch_depth")
+            if prefetch_depth is None or prefetch_depth == "":
+                return 0
+            return int(prefetch_depth)
+        except:
+            return 0
+
+    # prefetched frames older than this (in seconds) are dropped rather
+    # than detected, to bound latency when detection can't keep up.
+    def get_prefetch_max_stale(self) -> float:
+        try:
+            return float(self.storage.getItem("prefetch_max_stale") or 1000) / 1000
+        except:
+            return 1
+
+    def getPrefetchSettings(self) -> list[Setting]:
+        return [
+            {
+                "key": "prefetch_depth",
+                "title": "Frame Prefetch",
+                "description": "The number of video frames fetched and prepared while the previous frame is being detected. Only enable this for frame sources that keep each frame valid after the next one is fetched. Set to 0 to disable.",
+                "type": "number",
+                "value": self.get_prefetch_depth(),
+                "range": [0, 4],
+            },
+            {
+                "key": "prefetch_max_stale",
+                "title": "Frame Prefetch Max Age",
+                "description": "Prefetched frames older than this (in milliseconds) are dropped instead of detected when detection is falling behind.",
+                "type": "number",
+                "value": int(self.get_prefetch_max_stale() * 1000),
+            },
+            {
+                "key": "prefetch_dropped",
+                "title": "Frame Prefetch Dropped Frames",
+                "description": "The number of prefetched frames dropped for exceeding the max age since the plugin started.",
+                "value": self.prefetch_dropped,
+                "readonly": True,
+            },
+        ]
+
+    def getPrefetchStats(self):
+        return {
+            "dropped": self.prefetch_dropped,
+        }
+
     async def generateObjectDetections(
         self, videoFrames: Any, session: ObjectDetectionGeneratorSession = None
     ) -> Any:
+        prefetch_depth = self.get_prefetch_depth()
+        if prefetch_depth > 0:
+            async for detected in self.generateObjectDetectionsPipelined(
+                videoFrames, session, prefetch_depth
+            ):
+                yield detected
+            return
+
         try:
             videoFrames = await scrypted_sdk.sdk.connectRPCObject(videoFrames)
             videoFrame: scrypted_sdk.VideoFrame
@@ -82,6 +177,58 @@ class DetectPlugin(
             except:
                 pass
 
+    async def generateObjectDetectionsPipelined(
+        self,
+        videoFrames: Any,
+        session: ObjectDetectionGeneratorSession,
+        prefetch_depth: int,
+    ) -> Any:
+        max_stale = self.get_prefetch_max_stale()
+        # the prefetch stage blocks when the queue is full, so frames are
+        # never pulled from the source faster than they are detected.
+        queue: asyncio.Queue = asyncio.Queue(prefetch_depth)
+        done = object()
+
+        async def prefetch():
+            try:
+                async for videoFrame in videoFrames:
+                    # the frame's age includes the time spent waiting for room
+                    # in the queue, which is how a slow consumer shows up.
+                    fetched = time.monotonic()
+                    image = await scrypted_sdk.sdk.connectRPCObject(videoFrame["image"])
+                    image = await self.prefetch_detection_image(image, session)
+                    await queue.put((videoFrame, image, fetched))
+                await queue.put((done, None, None))
+            except Exception as e:
+                await queue.put((done, e, None))
+
+        prefetchTask = None
+        try:
+            videoFrames = await scrypted_sdk.sdk.connectRPCObject(videoFrames)
+            prefetchTask = asyncio.ensure_future(prefetch())
+            while True:
+                videoFrame, image, fetched = await queue.get()
+                if videoFrame is done:
+                    if image:
+                        raise image
+                    return
+                if time.monotonic() - fetched > max_stale:
+                    self.prefetch_dropped += 1
+                    continue
+                detected = await self.run_detection_image(image, session)
+                yield {
+                    "__json_copy_serialize_children": True,
+                    "detected": detected,
+                    "videoFrame": videoFrame,
+                }
+        finally:
+            if prefetchTask:
+                prefetchTask.cancel()
+            try:
+                await videoFrames.aclose()
+            except:
+                pass
+
     async def detectObjects(
         self, mediaObject: MediaObject, session: ObjectDetectionSession = None
     ) -> ObjectsDetected:
@@ -16,6 +16,7 @@ from scrypted_sdk.other import SettingValue
 from scrypted_sdk.types import Setting
 
 import common.yolo as yolo
+from common.preprocess import TensorWriter
 import openvino as ov
 from predict import PredictPlugin
 
@@ -196,7 +197,7 @@ class OpenVINOPlugin(
         self.infer_queue = ov.AsyncInferQueue(self.compiled_model)
 
         def predict(output):
-            return yolo.parse_yolov9(output[0])
+            return [yolo.parse_yolov9(o) for o in output]
 
         def callback(infer_request, future: asyncio.Future):
             try:
@@ -214,7 +215,12 @@ class OpenVINOPlugin(
         )
         print(f"model/mode: {model}/{mode}")
 
-        self.model_dim = self.compiled_model.inputs[0].shape[2]
+        input_shape = self.compiled_model.inputs[0].get_partial_shape()
+        self.model_dim = input_shape[2].get_length()
+        # models exported with a dynamic batch dimension can run
+        # frames from multiple cameras in a single inference.
+        self.max_batch_size = 16 if input_shape[0].is_dynamic else 1
+        self.input_writer: TensorWriter = None
 
         self.labels = {
             0: 'person',
@@ -261,7 +267,7 @@ class OpenVINOPlugin(
                 "value": mode,
                 "combobox": True,
             },
-        ]
+        ] + self.getPipelineSettings()
 
     async def putSetting(self, key: str, value: SettingValue):
         self.storage.setItem(key, value)
@@ -278,24 +284,38 @@ class OpenVINOPlugin(
     def get_input_format(self):
         return super().get_input_format()
 
+    def get_max_batch_size(self) -> int:
+        return self.max_batch_size
+
+    def get_batch_concurrency(self) -> int:
+        return len(self.infer_queue)
+
+    async def detect_batch(self, inputs: list[np.ndarray]) -> list[Any]:
+        f = asyncio.Future(loop=self.loop)
+        self.infer_queue.start_async(np.concatenate(inputs), f)
+        return await f
+
     async def detect_once(self, input: Image.Image, settings: Any, src_size, cvss):
-        def prepare():
-            im = np.expand_dims(input, axis=0)
-            im = im.transpose((0, 3, 1, 2))  # BHWC to BCHW, (n, 3, h, w)
-            im = im.astype(np.float32) / 255.0
-            im = np.ascontiguousarray(im)  # contiguous
-            return im
+        if not self.input_writer:
+            self.input_writer = TensorWriter(self.get_input_size())
 
+        input_tensor = None
         try:
             input_tensor = await asyncio.get_event_loop().run_in_executor(
-                prepareExecutor, lambda: prepare()
+                prepareExecutor, lambda: self.input_writer.prepare(input)
             )
-            f = asyncio.Future(loop=self.loop)
-            self.infer_queue.start_async(input_tensor, f)
-            objs = await f
+            if self.get_batch_size() > 1:
+                objs = await self.queue_batch(input_tensor)
+            else:
+                f = asyncio.Future(loop=self.loop)
+                self.infer_queue.start_async(input_tensor, f)
+                objs = (await f)[0]
         except:
             traceback.print_exc()
             raise
+        finally:
+            if input_tensor is not None:
+                self.input_writer.release(input_tensor)
 
         ret = self.create_detection_result(objs, src_size, cvss)
         return ret
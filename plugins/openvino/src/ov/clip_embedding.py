@@ -70,14 +70,15 @@ class OpenVINOClipEmbedding(ClipEmbedding):
         return ret
 
     async def getTextEmbedding(self, input):
-        def predict():
-            inputs = self.processor(text=input, return_tensors="np", padding="max_length", truncation=True)
-            text_model, _ = self.model
-            text_predictions = text_model((inputs.data['input_ids'], inputs.data['attention_mask']))
-            text_embeds = text_predictions[0]
-            return bytearray(text_embeds.astype(np.float32).tobytes())
+        async with self.use_models():
+            def predict():
+                inputs = self.processor(text=input, return_tensors="np", padding="max_length", truncation=True)
+                text_model, _ = self.model
+                text_predictions = text_model((inputs.data['input_ids'], inputs.data['attention_mask']))
+                text_embeds = text_predictions[0]
+                return bytearray(text_embeds.astype(np.float32).tobytes())
 
-        ret = await asyncio.get_event_loop().run_in_executor(
-            clipPredict, lambda: predict()
-        )
-        return ret
+            ret = await asyncio.get_event_loop().run_in_executor(
+                clipPredict, lambda: predict()
+            )
+            return ret
@@ -8,7 +8,7 @@ from PIL import Image
 
 import openvino as ov
 from common import async_infer
-from predict.face_recognize import FaceRecognizeDetection
+from predict.face_recognize import FACE_SIZE, MAX_FACE_BATCH, FaceRecognizeDetection
 
 faceDetectPrepare, faceDetectPredict = async_infer.create_executors("FaceDetect")
 faceRecognizePrepare, faceRecognizePredict = async_infer.create_executors(
@@ -29,7 +29,19 @@ class OpenVINOFaceRecognition(FaceRecognizeDetection):
         xmlFile = os.path.join(model_path, f"{ovmodel}.xml")
         if inception:
             model = self.plugin.core.read_model(xmlFile)
-            model.reshape([1, 3, 160, 160])
+            # a dynamic batch embeds all the faces of a frame in one inference,
+            # but not every device supports dynamic shapes.
+            try:
+                model.reshape(
+                    ov.PartialShape(
+                        [ov.Dimension(1, MAX_FACE_BATCH), 3, FACE_SIZE, FACE_SIZE]
+                    )
+                )
+                return self.plugin.core.compile_model(model, self.plugin.mode)
+            except Exception as e:
+                print("dynamic face batch unsupported, using batch size 1", e)
+            model = self.plugin.core.read_model(xmlFile)
+            model.reshape([1, 3, FACE_SIZE, FACE_SIZE])
             return self.plugin.core.compile_model(model, self.plugin.mode)
         else:
             return self.plugin.core.compile_model(xmlFile, self.plugin.mode)
@@ -66,3 +78,20 @@ class OpenVINOFaceRecognition(FaceRecognizeDetection):
             faceRecognizePredict, lambda: predict()
         )
         return ret
+
+    async def predictFaceBatch(self, input: np.ndarray):
+        if not self.faceModel.input(0).get_partial_shape()[0].is_dynamic:
+            return await super().predictFaceBatch(input)
+
+        def predict():
+            im = ov.Tensor(array=np.ascontiguousarray(input))
+            infer_request = self.faceModel.create_infer_request()
+            infer_request.set_input_tensor(im)
+            output_tensors = infer_request.infer()
+            ret = output_tensors[0]
+            return ret
+
+        ret = await asyncio.get_event_loop().run_in_executor(
+            faceRecognizePredict, lambda: predict()
+        )
+        return ret
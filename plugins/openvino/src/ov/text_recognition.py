@@ -7,6 +7,7 @@ import numpy as np
 
 import openvino as ov
 from common import async_infer
+from common.text import TEXT_WIDTH_BUCKETS
 from predict.text_recognize import TextRecognition
 
 textDetectPrepare, textDetectPredict = async_infer.create_executors("TextDetect")
@@ -60,3 +61,15 @@ class OpenVINOTextRecognition(TextRecognition):
             textDetectPredict, lambda: predict()
         )
         return ret
+
+    def get_text_width_buckets(self):
+        width = self.textModel.input(0).get_partial_shape()[3]
+        if width.is_dynamic:
+            return TEXT_WIDTH_BUCKETS
+        return [width.get_length()]
+
+    async def predictTextBatch(self, input: np.ndarray):
+        # the npu model is reshaped to a single line.
+        if not self.textModel.input(0).get_partial_shape()[0].is_dynamic:
+            return await super().predictTextBatch(input)
+        return await self.predictTextModel(input)
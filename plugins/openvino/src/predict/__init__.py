@@ -4,21 +4,48 @@ import json
 import random
 import re
 import asyncio
+import concurrent.futures
+import contextlib
+import gc
 import math
 import os
 import socket
+import time
 import traceback
 import urllib.request
 from typing import Any, List, Mapping, Tuple
 
+import numpy as np
 import scrypted_sdk
 from PIL import Image
-from scrypted_sdk.types import (ObjectDetectionResult, ObjectDetectionSession,
+from scrypted_sdk.types import (ObjectDetectionGeneratorSession,
+                                ObjectDetectionResult, ObjectDetectionSession,
                                 ObjectsDetected, Setting)
 
 import common.colors
-from detect import DetectPlugin
+from common.model_cache import get_model_cache, get_model_cache_dir, link_file
+from common.nms import nms_detections
+from common.tracker import Tracker
+from common.zones import filter_zone_detections, get_inclusion_zones, get_zones_bounds
+from detect import DetectPlugin, PrefetchedImage
+from predict.admission import AdmissionController, get_priority
+from predict.batcher import DynamicBatcher
+from predict.dispatch import ForkDispatcher
+from predict.embedding import DEFAULT_EMBEDDING_FORMAT, EMBEDDING_FORMATS
+from predict.health import (DRAIN_TIMEOUT, HEALTH_CHECK_INTERVAL, IDLE_WAIT,
+                            HealthMonitor, get_rss)
+from predict.recognition_cache import SIGNATURE_SIZE, RecognitionCache
 from predict.rectangle import Rectangle
+from predict.transform import SourceTransform
+
+# auxiliary models are unloaded after being idle this long (in seconds).
+MODEL_IDLE_UNLOAD = 30 * 60
+MODEL_IDLE_CHECK_INTERVAL = 60
+# trackers of sessions that stopped sending frames are discarded (in seconds).
+TRACKER_EXPIRY = 5 * 60
+# a tracked object that moved is recognized again at most this often (in
+# seconds), its previous result is carried over in between.
+TRACK_RECOGNITION_INTERVAL = 1
 
 cache_dir = os.path.join(os.environ["SCRYPTED_PLUGIN_VOLUME"], "files", "hf")
 # os.makedirs(cache_dir, exist_ok=True)
@@ -52,6 +79,41 @@ class Prediction:
         self.embedding = embedding
         self.clipPaths = clipPaths
 
+class Predictions:
+    """
+    Decoded detections as numpy arrays, kept out of python objects until
+    they are converted to detection results at the rpc boundary.
+    boxes are (n, 4) xmin, ymin, xmax, ymax in model input coordinates.
+    """
+    def __init__(self, boxes: np.ndarray, scores: np.ndarray, ids: np.ndarray):
+        self.boxes = boxes.reshape(-1, 4)
+        self.scores = scores
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        for box, score, id in zip(self.boxes, self.scores, self.ids):
+            yield Prediction(id, score, Rectangle(*box))
+
+# normalized margin around the zones when cropping.
+ZONE_CROP_MARGIN = 0.05
+# zone crops larger than this fraction of the frame are not worth the extra resize.
+ZONE_CROP_MAX_AREA = 0.75
+
+def merge_detection_results(
+    results: List[ObjectsDetected], size, iou_threshold: float = 0.5
+) -> ObjectsDetected:
+    # merge detections from overlapping regions of the same frame, suppressing
+    # duplicates of the same class found in more than one region.
+    detections = [d for r in results for d in r["detections"]]
+    detections = nms_detections(detections, iou_threshold)
+    return {
+        "detections": detections,
+        "inputDimensions": size,
+    }
+
 class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sdk.ScryptedSystemDevice, scrypted_sdk.DeviceCreator, scrypted_sdk.DeviceProvider):
     labels: dict
 
@@ -72,14 +134,31 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
         self.plugin = plugin
         # self.clusterIndex = 0
 
-        # periodic restart of main plugin because there seems to be leaks in tflite or coral API.
+        # the main plugin restarts when its health degrades, rather than
+        # periodically, because there seems to be leaks in tflite or coral API.
+        self.health: HealthMonitor = None
         if not nativeId:
+            self.health = HealthMonitor(
+                self.get_restart_memory_growth(), self.get_restart_latency_growth()
+            )
             loop = asyncio.get_event_loop()
-            loop.call_later(4 * 60 * 60, lambda: self.requestRestart())
-
-        self.batch: List[Tuple[Any, asyncio.Future]] = []
-        self.batching = 0
-        self.batch_flush = None
+            loop.call_later(HEALTH_CHECK_INTERVAL, self.check_health)
+
+        self.batcher: DynamicBatcher = None
+        self.admission: AdmissionController = None
+        self.dispatcher: ForkDispatcher = None
+
+        self.models_loaded = False
+        self.models_lock: asyncio.Lock = None
+        self.models_users = 0
+        self.models_last_used = 0
+        self.models_memory: int = None
+        self.model_names: List[str] = []
+        # model devices with lazily loaded models, by native id.
+        self.model_devices: Mapping[str, PredictPlugin] = {}
+        # object trackers by session source id.
+        self.trackers: Mapping[str, Tracker] = {}
+        self.recognition_cache: RecognitionCache = None
 
         self.forked = forked
         if not self.forked:
@@ -91,13 +170,20 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
     def downloadHuggingFaceModel(self, model: str, local_files_only: bool = False) -> str:
         from huggingface_hub import snapshot_download
         plugin_suffix = self.pluginId.split('/')[1]
-        local_dir = os.path.join(cache_dir, plugin_suffix, model)
-        local_path = snapshot_download(
-            repo_id="scrypted/plugin-models",
-            allow_patterns=f"{plugin_suffix}/{model}/*",
-            local_files_only=local_files_only,
-            local_dir=local_dir,
-        )
+        try:
+            # the hub cache is content addressed and shared by the plugins.
+            local_path = snapshot_download(
+                repo_id="scrypted/plugin-models",
+                allow_patterns=f"{plugin_suffix}/{model}/*",
+                local_files_only=local_files_only,
+                cache_dir=os.path.join(get_model_cache_dir(), "hf"),
+            )
+        except Exception:
+            # models downloaded before the shared cache are still usable offline.
+            local_dir = os.path.join(cache_dir, plugin_suffix, model)
+            if not local_files_only or not os.path.isdir(local_dir):
+                raise
+            local_path = local_dir
         local_path = os.path.join(local_path, plugin_suffix, model)
         return local_path
 
@@ -116,30 +202,18 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
         local_path = self.downloadHuggingFaceModel(model, local_files_only=True)
         return local_path
 
-    def downloadFile(self, url: str, filename: str):
+    def downloadFile(self, url: str, filename: str, sha256: str = None):
         try:
             filesPath = os.path.join(os.environ["SCRYPTED_PLUGIN_VOLUME"], "files")
             fullpath = os.path.join(filesPath, filename)
             if os.path.isfile(fullpath):
                 print("File already exists", fullpath)
                 return fullpath
-            tmp = fullpath + ".tmp"
-            print("Creating directory for", tmp)
+            print("Creating directory for", fullpath)
             os.makedirs(os.path.dirname(fullpath), exist_ok=True)
-            print("Downloading", url)
-            response = urllib.request.urlopen(url)
-            if response.getcode() < 200 or response.getcode() >= 300:
-                raise Exception(f"non-2xx response code")
-            read = 0
-            with open(tmp, "wb") as f:
-                while True:
-                    data = response.read(1024 * 1024)
-                    if not data:
-                        break
-                    read += len(data)
-                    f.write(data)
-            os.rename(tmp, fullpath)
-            print("Downloaded", fullpath, read, "bytes")
+            cached = get_model_cache().fetch(url, sha256)
+            link_file(cached, fullpath)
+            print("Downloaded", fullpath, os.path.getsize(fullpath), "bytes")
             return fullpath
         except:
             traceback.print_exc()
@@ -156,6 +230,208 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
         if self.periodic_restart:
             asyncio.ensure_future(scrypted_sdk.deviceManager.requestRestart())
 
+    # auxiliary model devices (face, text, clip, segmentation) set lazy_models
+    # and return their models from load_models. the models are loaded on first
+    # use and unloaded after they have been idle.
+    lazy_models = False
+
+    def load_models(self) -> Mapping[str, Any]:
+        return {}
+
+    def get_model_idle_unload(self) -> float:
+        storage = (self.plugin or self).storage
+        try:
+            idle = storage.getItem("model_idle_unload")
+            if idle is None or idle == "":
+                return MODEL_IDLE_UNLOAD
+            return float(idle) * 60
+        except:
+            return MODEL_IDLE_UNLOAD
+
+    def getModelMemorySettings(self) -> list[Setting]:
+        if self.nativeId:
+            return []
+        return [
+            {
+                "key": "model_idle_unload",
+                "title": "Unload Idle Models",
+                "description": "Face recognition, text recognition, CLIP and segmentation models are loaded when first used, and unloaded after being unused for this many minutes. Set to 0 to keep them loaded.",
+                "type": "number",
+                "value": self.get_model_idle_unload() / 60,
+            },
+        ]
+
+    def getModelMemoryStats(self):
+        return {
+            nativeId: {
+                "loaded": device.models_loaded,
+                "memory": device.models_memory,
+                "idle": time.monotonic() - device.models_last_used if device.models_loaded else None,
+            }
+            for nativeId, device in self.model_devices.items()
+        }
+
+    async def ensure_models(self):
+        if self.models_loaded:
+            return
+        if not self.models_lock:
+            self.models_lock = asyncio.Lock()
+        async with self.models_lock:
+            if self.models_loaded:
+                return
+            rss = get_rss()
+            start = time.monotonic()
+            models = await asyncio.get_event_loop().run_in_executor(None, self.load_models)
+            for name, model in models.items():
+                setattr(self, name, model)
+            self.model_names = list(models.keys())
+            # approximate, other work in the process may allocate concurrently.
+            self.models_memory = rss and max(0, get_rss() - rss)
+            self.models_loaded = True
+            (self.plugin or self).model_devices[self.nativeId] = self
+            health = self.get_health()
+            if health:
+                health.reset_memory_baseline()
+            print(
+                "loaded %s models in %.1fs (%sMB)"
+                % (
+                    self.nativeId,
+                    time.monotonic() - start,
+                    (self.models_memory or 0) // (1024 * 1024),
+                )
+            )
+            asyncio.get_event_loop().call_later(MODEL_IDLE_CHECK_INTERVAL, self.check_models_idle)
+
+    @contextlib.asynccontextmanager
+    async def use_models(self):
+        if not self.lazy_models:
+            yield
+            return
+        # in use models are never unloaded.
+        self.models_users += 1
+        try:
+            await self.ensure_models()
+            yield
+        finally:
+            self.models_users -= 1
+            self.models_last_used = time.monotonic()
+
+    def check_models_idle(self):
+        if not self.models_loaded:
+            return
+        idle = self.get_model_idle_unload()
+        if idle and not self.models_users and time.monotonic() - self.models_last_used >= idle:
+            self.unload_models()
+            return
+        asyncio.get_event_loop().call_later(MODEL_IDLE_CHECK_INTERVAL, self.check_models_idle)
+
+    def unload_models(self):
+        rss = get_rss()
+
+        def release(model: Any):
+            if isinstance(model, concurrent.futures.Executor):
+                model.shutdown(wait=False)
+            elif isinstance(model, (tuple, list)):
+                for m in model:
+                    release(m)
+
+        for name in self.model_names:
+            release(getattr(self, name, None))
+            setattr(self, name, None)
+        self.models_loaded = False
+        gc.collect()
+        freed = rss and max(0, rss - get_rss())
+        print("unloaded idle %s models (%sMB freed)" % (self.nativeId, (freed or 0) // (1024 * 1024)))
+
+    def get_health(self) -> HealthMonitor:
+        # model devices share the health of the plugin process they run in.
+        return (self.plugin or self).health
+
+    def get_restart_memory_growth(self) -> float:
+        try:
+            growth = self.storage.getItem("restart_memory_growth")
+            if growth is None or growth == "":
+                return 1
+            return float(growth) / 100
+        except:
+            return 1
+
+    def get_restart_latency_growth(self) -> float:
+        try:
+            growth = self.storage.getItem("restart_latency_growth")
+            if growth is None or growth == "":
+                return 4
+            return float(growth)
+        except:
+            return 4
+
+    def getHealthSettings(self) -> list[Setting]:
+        if self.nativeId:
+            return []
+        return [
+            {
+                "key": "restart_memory_growth",
+                "title": "Restart on Memory Growth",
+                "description": "Restart the plugin when its memory use grows by this percentage over its usage once the models are loaded. Set to 0 to disable.",
+                "type": "number",
+                "value": int(self.get_restart_memory_growth() * 100),
+            },
+            {
+                "key": "restart_latency_growth",
+                "title": "Restart on Latency Growth",
+                "description": "Restart the plugin when the inference time stays this many times slower than its recent median. Set to 0 to disable.",
+                "type": "number",
+                "value": self.get_restart_latency_growth(),
+            },
+        ]
+
+    def getHealthStats(self):
+        return self.get_health().getStats()
+
+    def check_health(self):
+        health = self.health
+        if health.restart_reasons:
+            return
+        reasons = health.check(get_rss())
+        if reasons:
+            self.schedule_restart(reasons)
+        if not health.restart_reasons:
+            asyncio.get_event_loop().call_later(HEALTH_CHECK_INTERVAL, self.check_health)
+
+    def schedule_restart(self, reasons: List[str], urgent: bool = False):
+        root = self.plugin or self
+        if not root.periodic_restart:
+            return
+        health = root.health
+        if not health:
+            self.requestRestart()
+            return
+        if health.restart_reasons:
+            if not urgent:
+                return
+            health.restart_reasons += reasons
+        else:
+            health.restart_reasons = reasons
+        print("restart scheduled:", ", ".join(reasons))
+        asyncio.ensure_future(root.restart_when_idle(urgent))
+
+    async def restart_when_idle(self, urgent: bool = False):
+        health = self.health
+        if health.draining:
+            return
+        # an unhealthy detector is restarted without waiting for an idle moment.
+        deadline = time.monotonic() + (0 if urgent else IDLE_WAIT)
+        while not health.is_idle() and time.monotonic() < deadline:
+            await asyncio.sleep(1)
+
+        # stop admitting frames, and let the ones in flight finish.
+        health.draining = True
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while health.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        print("restarting:", ", ".join(health.restart_reasons))
+        self.requestRestart()
+
     # width, height, channels
     def get_input_details(self) -> Tuple[int, int, int]:
         pass
@@ -169,11 +445,15 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
     def create_detection_result(
         self, objs: List[Prediction], size, convert_to_src_size=None
     ) -> ObjectsDetected:
+        if isinstance(objs, Predictions):
+            return self.create_detection_result_arrays(objs, size, convert_to_src_size)
+
         detections: List[ObjectDetectionResult] = []
         detection_result: ObjectsDetected = {}
         detection_result["detections"] = detections
         detection_result["inputDimensions"] = size
 
+        clipPaths: List[List[Any]] = []
         for obj in objs:
             className = self.labels.get(obj.id, obj.id)
             detection: ObjectDetectionResult = {}
@@ -191,35 +471,114 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
             detection["score"] = obj.score
             if hasattr(obj, "embedding") and obj.embedding is not None:
                 detection["embedding"] = obj.embedding
+            paths = None
             if hasattr(obj, "clipPaths") and obj.clipPaths is not None and len(obj.clipPaths) > 0:
-                detection["clipPaths"] = obj.clipPaths
+                paths = obj.clipPaths
+            clipPaths.append(paths)
             detections.append(detection)
 
-        if convert_to_src_size:
-            detections = detection_result["detections"]
-            detection_result["detections"] = []
-            for detection in detections:
-                bb = detection["boundingBox"]
-                x, y = convert_to_src_size((bb[0], bb[1]))
-                x2, y2 = convert_to_src_size((bb[0] + bb[2], bb[1] + bb[3]))
-                detection["boundingBox"] = (x, y, x2 - x + 1, y2 - y + 1)
-                if any(map(lambda x: not math.isfinite(x), detection["boundingBox"])):
-                    print("unexpected nan detected", obj.bbox)
-                    continue
-                # Transform clipPaths coordinates if present
-                if "clipPaths" in detection and detection["clipPaths"] is not None:
-                    clip_paths = detection["clipPaths"]
-                    # Convert each polygon (list of [x, y] tuples) to source size
-                    transformed = [[
-                        (convert_to_src_size((pt[0], pt[1]))[0], convert_to_src_size((pt[0], pt[1]))[1])
-                        for pt in polygon
-                    ] for polygon in clip_paths]
-                    detection["clipPaths"] = transformed
-                detection_result["detections"].append(detection)
+        if not convert_to_src_size:
+            for detection, paths in zip(detections, clipPaths):
+                if paths is not None:
+                    detection["clipPaths"] = [np.asarray(p).tolist() for p in paths]
+            return detection_result
+
+        if not isinstance(convert_to_src_size, SourceTransform):
+            return self.convert_detection_result(detection_result, clipPaths, convert_to_src_size)
+
+        # map every box corner and every clip path point to the source
+        # in a single transform.
+        boxes = np.array([d["boundingBox"] for d in detections], dtype=np.float64).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]
+        polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for paths in clipPaths if paths is not None for p in paths]
+        points = np.concatenate([boxes.reshape(-1, 2)] + polygons)
+        points = convert_to_src_size.apply(points)
+
+        boxes = points[: len(boxes) * 2].reshape(-1, 4)
+        boxes[:, 2:] += 1 - boxes[:, :2]
+        finite = np.isfinite(boxes).all(axis=1)
+        polygons = np.split(points[len(boxes) * 2 :], np.cumsum([len(p) for p in polygons])[:-1]) if polygons else []
+
+        detection_result["detections"] = []
+        polygon = 0
+        for detection, paths, box, ok in zip(detections, clipPaths, boxes.tolist(), finite.tolist()):
+            if paths is not None:
+                transformed = [p.tolist() for p in polygons[polygon : polygon + len(paths)]]
+                polygon += len(paths)
+            if not ok:
+                print("unexpected nan detected", box)
+                continue
+            detection["boundingBox"] = tuple(box)
+            if paths is not None:
+                detection["clipPaths"] = transformed
+            detection_result["detections"].append(detection)
 
         # print(detection_result)
         return detection_result
 
+    def convert_detection_result(
+        self, detection_result: ObjectsDetected, clipPaths: List[List[Any]], convert_to_src_size
+    ) -> ObjectsDetected:
+        # point by point conversion for callers that provide a plain function.
+        detections = detection_result["detections"]
+        detection_result["detections"] = []
+        for detection, paths in zip(detections, clipPaths):
+            bb = detection["boundingBox"]
+            x, y = convert_to_src_size((bb[0], bb[1]))
+            x2, y2 = convert_to_src_size((bb[0] + bb[2], bb[1] + bb[3]))
+            detection["boundingBox"] = (x, y, x2 - x + 1, y2 - y + 1)
+            if any(map(lambda x: not math.isfinite(x), detection["boundingBox"])):
+                print("unexpected nan detected", detection["boundingBox"])
+                continue
+            if paths is not None:
+                detection["clipPaths"] = [
+                    [convert_to_src_size((pt[0], pt[1])) for pt in polygon]
+                    for polygon in paths
+                ]
+            detection_result["detections"].append(detection)
+        return detection_result
+
+    def create_detection_result_arrays(
+        self, predictions: Predictions, size, convert_to_src_size=None
+    ) -> ObjectsDetected:
+        boxes = predictions.boxes.astype(np.float64)
+        finite = np.isfinite(boxes).all(axis=1)
+        if isinstance(convert_to_src_size, SourceTransform):
+            boxes = convert_to_src_size.apply_boxes(boxes)
+            # source boxes are inclusive of the far edge.
+            boxes[:, 2:] += 1
+            finite &= np.isfinite(boxes).all(axis=1)
+            convert_to_src_size = None
+        if not finite.all():
+            print("unexpected nan detected", boxes[~finite][0])
+        boxes = boxes[finite]
+        scores = predictions.scores[finite].tolist()
+        ids = predictions.ids[finite].tolist()
+
+        detections: List[ObjectDetectionResult] = []
+        for (l, t, r, b), score, id in zip(boxes.tolist(), scores, ids):
+            if convert_to_src_size:
+                x, y = convert_to_src_size((l, t))
+                x2, y2 = convert_to_src_size((r, b))
+                boundingBox = (x, y, x2 - x + 1, y2 - y + 1)
+                if any(map(lambda x: not math.isfinite(x), boundingBox)):
+                    print("unexpected nan detected", boundingBox)
+                    continue
+            else:
+                boundingBox = (l, t, r - l, b - t)
+            detections.append(
+                {
+                    "boundingBox": boundingBox,
+                    "className": self.labels.get(id, id),
+                    "score": score,
+                }
+            )
+
+        return {
+            "detections": detections,
+            "inputDimensions": size,
+        }
+
     def get_detection_input_size(self, src_size):
         # signals to pipeline that any input size is fine
         # previous code used to resize to correct size and run detection that way.
@@ -238,79 +597,156 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
     async def detect_batch(self, inputs: List[Any]) -> List[Any]:
         pass
 
-    async def run_batch(self):
-        batch = self.batch
-        self.batch = []
-        self.batching = 0
+    # the largest batch the model can run in a single inference.
+    def get_max_batch_size(self) -> int:
+        return 1
 
-        if len(batch):
-            inputs = [x[0] for x in batch]
-            try:
-                results = await self.detect_batch(inputs)
-                for i, result in enumerate(results):
-                    batch[i][1].set_result(result)
-            except Exception as e:
-                for input in batch:
-                    input[1].set_exception(e)
-
-    async def flush_batch(self):
-        self.batch_flush = None
-        await self.run_batch()
-
-    async def queue_batch(self, input: Any) -> List[Any]:
-        future = asyncio.Future(loop=asyncio.get_event_loop())
-        self.batch.append((input, future))
-        if self.batching:
-            self.batching = self.batching - 1
-            if self.batching:
-                # if there is any sort of error or backlog, .
-                if not self.batch_flush:
-                    self.batch_flush = self.loop.call_later(
-                        0.5, lambda: asyncio.ensure_future(self.flush_batch())
-                    )
-                return await future
-        await self.run_batch()
-        return await future
+    # the number of batches the model can run in parallel.
+    def get_batch_concurrency(self) -> int:
+        return 1
+
+    def get_batch_size(self) -> int:
+        max_batch_size = self.get_max_batch_size()
+        try:
+            batch_size = int(self.storage.getItem("batch_size") or min(8, max_batch_size))
+        except:
+            batch_size = 1
+        return max(1, min(batch_size, max_batch_size))
+
+    def get_batch_wait(self) -> float:
+        try:
+            return float(self.storage.getItem("batch_wait") or 10) / 1000
+        except:
+            return 0.01
+
+    def getBatchSettings(self) -> list[Setting]:
+        max_batch_size = self.get_max_batch_size()
+        if max_batch_size <= 1:
+            return []
+        return [
+            {
+                "key": "batch_size",
+                "title": "Batch Size",
+                "description": "The maximum number of frames, from any camera, that will be combined into a single inference. Larger batches increase throughput when many cameras are active. Set to 1 to disable batching.",
+                "type": "number",
+                "value": self.get_batch_size(),
+                "range": [1, max_batch_size],
+            },
+            {
+                "key": "batch_wait",
+                "title": "Batch Wait",
+                "description": "The maximum time in milliseconds a frame will wait for a batch to fill while the detector is busy.",
+                "type": "number",
+                "value": int(self.get_batch_wait() * 1000),
+            },
+        ]
+
+    def get_batcher(self) -> DynamicBatcher:
+        if not self.batcher:
+            self.batcher = DynamicBatcher(
+                self.detect_batch,
+                self.get_batch_size(),
+                self.get_batch_wait(),
+                concurrency=self.get_batch_concurrency(),
+                loop=self.loop,
+            )
+        else:
+            # the batch settings may change at any time, and apply to the
+            # next batch without losing the requests already queued.
+            self.batcher.max_batch_size = self.get_batch_size()
+            self.batcher.max_wait = self.get_batch_wait()
+        return self.batcher
+
+    async def queue_batch(self, input: Any) -> Any:
+        return await self.get_batcher().submit(input)
+
+    def get_latency_target(self) -> float:
+        try:
+            latency_target = self.storage.getItem("latency_target")
+            if latency_target is None or latency_target == "":
+                return 2
+            return float(latency_target) / 1000
+        except:
+            return 2
+
+    def getAdmissionSettings(self) -> list[Setting]:
+        return [
+            {
+                "key": "latency_target",
+                "title": "Latency Target",
+                "description": "When the detector is overloaded, frames that are estimated to take longer than this (in milliseconds) are skipped. Cameras with a higher detection priority setting tolerate proportionally more latency. Set to 0 to disable.",
+                "type": "number",
+                "value": int(self.get_latency_target() * 1000),
+            },
+        ]
+
+    def get_admission(self) -> AdmissionController:
+        latency_target = self.get_latency_target()
+        capacity = self.get_batch_size() * self.get_batch_concurrency()
+        if not self.admission:
+            self.admission = AdmissionController(latency_target, capacity)
+        else:
+            # follow changes to the latency target and batch settings, keeping
+            # the measured service time and the requests in flight.
+            self.admission.latency_target = latency_target
+            self.admission.capacity = max(1, capacity)
+        return self.admission
+
+    def getAdmissionStats(self):
+        return self.get_admission().getStats()
 
     async def safe_detect_once(
         self, input: Image.Image, settings: Any, src_size, cvss
     ) -> ObjectsDetected:
+        health = self.get_health()
+        # the latency of the main detection model is what's monitored.
+        timed = health if not self.nativeId else None
+        started = timed and timed.inference_start()
+        success = False
         try:
             f = self.detect_once(input, settings, src_size, cvss)
-            return await asyncio.wait_for(f, 60)
+            ret = await asyncio.wait_for(f, 60)
+            success = True
+            if health:
+                health.success()
+            return ret
+        except asyncio.TimeoutError:
+            # a single slow detection may be a transient stall, a device that
+            # keeps timing out is hung.
+            print("detection timed out.")
+            if not health or health.timeout():
+                self.schedule_restart(["consecutive detection timeouts"], True)
+            raise
         except:
             traceback.print_exc()
             print("encountered an error while detecting. requesting plugin restart.")
-            self.requestRestart()
+            self.schedule_restart(["detection error"], True)
             raise
-
-    async def run_detection_image(
-        self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
-    ) -> ObjectsDetected:
-        settings = detection_session and detection_session.get("settings")
-        batch = (detection_session and detection_session.get("batch")) or 0
-        self.batching += batch
-
-        iw, ih = image.width, image.height
-        w, h = self.get_input_size()
-
-        if w is None or h is None:
-            resize = None
-            w = image.width
-            h = image.height
-
-            def cvss(point):
-                return point
-
+        finally:
+            if timed:
+                timed.inference_done(started, success)
+
+    # the toBuffer options for the model input: resized (or scaled to fit when
+    # padding) in a format the model can consume.
+    def get_input_buffer_options(self, image: scrypted_sdk.Image, settings: Any, crop: Any = None):
+        if crop:
+            iw, ih = crop["width"], crop["height"]
         else:
-            resize = None
-            xs = w / iw
-            ys = h / ih
-
-            def cvss(point):
-                return point[0] / xs, point[1] / ys
+            iw, ih = image.width, image.height
+        w, h = self.get_input_size()
 
-            if iw != w or ih != h:
+        resize = None
+        if w is not None and h is not None:
+            if settings and settings.get("pad", False):
+                if iw / w > ih / h:
+                    scale = w / iw
+                else:
+                    scale = h / ih
+                resize = {
+                    "width": int(iw * scale),
+                    "height": int(ih * scale),
+                }
+            elif iw != w or ih != h:
                 resize = {
                     "width": w,
                     "height": h,
@@ -324,26 +760,381 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
             if image.ffmpegFormats != True:
                 format = image.format or "rgb"
 
-        if settings and settings.get("pad", False):
-            if iw / w > ih / h:
-                scale = w / iw
-            else:
-                scale = h / ih
-            nw = int(iw * scale)
-            nh = int(ih * scale)
+        options = {
+            "resize": resize,
+            "format": format,
+        }
+        if crop:
+            options["crop"] = crop
+        return options
+
+    async def prefetch_detection_image(
+        self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
+    ) -> scrypted_sdk.Image:
+        # fetch the model input while the previous frame is in inference.
+        settings = detection_session and detection_session.get("settings")
+        crop = None
+        if not self.get_tile_grid():
+            crop = self.get_zone_crop(image, self.get_detection_zones(detection_session))
+        options = self.get_input_buffer_options(image, settings, crop)
+        buffer = await image.toBuffer(options)
+        return PrefetchedImage(image, options, buffer)
+
+    async def run_detection_image(
+        self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
+    ) -> ObjectsDetected:
+        async with self.use_models():
+            return await self.run_detection_image_models(image, detection_session)
+
+    async def run_detection_image_models(
+        self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
+    ) -> ObjectsDetected:
+        settings = detection_session and detection_session.get("settings")
+        health = self.get_health()
+        if health and health.draining:
+            return {
+                "detections": [],
+                "inputDimensions": (image.width, image.height),
+                "skipped": True,
+            }
 
-            resize = {
-                "width": nw,
-                "height": nh,
+        admission = self.get_admission()
+        if not admission.admit(
+            get_priority(settings),
+            detection_session and detection_session.get("sourceId"),
+        ):
+            # skipped frames are reported distinctly from frames with no detections.
+            return {
+                "detections": [],
+                "inputDimensions": (image.width, image.height),
+                "skipped": True,
             }
 
-            b = await image.toBuffer(
-                {
-                    "resize": resize,
-                    "format": format,
-                }
+        started = admission.start()
+        if health:
+            health.start()
+        try:
+            return await self.run_detection_image_admitted(image, detection_session)
+        finally:
+            admission.done(started)
+            if health:
+                health.done()
+
+    async def run_detection_image_admitted(
+        self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
+    ) -> ObjectsDetected:
+        settings = detection_session and detection_session.get("settings")
+        batch = (detection_session and detection_session.get("batch")) or 0
+        if batch:
+            self.get_batcher().expect(batch)
+
+        zones = self.get_detection_zones(detection_session)
+        tiles = self.get_detection_tiles(image)
+        if tiles:
+            ret = await self.run_tiled_detection(image, settings, tiles)
+        else:
+            crop = self.get_zone_crop(image, zones)
+            ret = await self.detect_region(image, settings, crop)
+
+        if zones:
+            ret["detections"] = filter_zone_detections(
+                ret["detections"], zones, (image.width, image.height), self.getClasses()
             )
 
+        ret["detections"] = self.filter_detections(ret["detections"])
+
+        # tracked after filtering, so discarded detections don't create tracks.
+        tracker = self.get_tracker(detection_session, image)
+        if tracker:
+            tracker.update(ret["detections"])
+        return ret
+
+    # model specific filtering of the detections (thresholds, nms), which
+    # runs before they are tracked.
+    def filter_detections(self, detections: List[ObjectDetectionResult]) -> List[ObjectDetectionResult]:
+        return detections
+
+    def get_tracking_enabled(self) -> bool:
+        return str((self.plugin or self).storage.getItem("object_tracking")).lower() == "true"
+
+    def getTrackingSettings(self) -> list[Setting]:
+        if self.nativeId:
+            return []
+        return [
+            {
+                "key": "object_tracking",
+                "title": "Object Tracking",
+                "description": "Track objects across the frames of each camera, assigning detections stable ids and history.",
+                "type": "boolean",
+                "value": self.get_tracking_enabled(),
+            },
+        ]
+
+    def get_recognition_cache_ttl(self) -> float:
+        try:
+            ttl = (self.plugin or self).storage.getItem("recognition_cache_ttl")
+            if ttl is None or ttl == "":
+                return 10
+            return float(ttl)
+        except:
+            return 10
+
+    def get_recognition_cache_signature(self) -> bool:
+        return str((self.plugin or self).storage.getItem("recognition_cache_signature")).lower() == "true"
+
+    def getRecognitionCacheSettings(self) -> list[Setting]:
+        if self.nativeId:
+            return []
+        return [
+            {
+                "key": "recognition_cache_ttl",
+                "title": "Recognition Cache Duration",
+                "description": "Face embeddings and text labels of objects that have not moved are reused for this many seconds, rather than being recognized again every frame. Set to 0 to disable.",
+                "type": "number",
+                "value": self.get_recognition_cache_ttl(),
+            },
+            {
+                "key": "recognition_cache_signature",
+                "title": "Recognition Cache Appearance Check",
+                "description": "Also compare the appearance of untracked objects before reusing their cached results, so a different object in the same place is recognized again. This fetches a small crop of every untracked object on every frame.",
+                "type": "boolean",
+                "value": self.get_recognition_cache_signature(),
+            },
+        ]
+
+    def get_recognition_cache(self) -> RecognitionCache:
+        ttl = self.get_recognition_cache_ttl()
+        if not ttl:
+            return None
+        if not self.recognition_cache:
+            self.recognition_cache = RecognitionCache(ttl)
+        self.recognition_cache.ttl = ttl
+        return self.recognition_cache
+
+    def getRecognitionCacheStats(self):
+        return self.recognition_cache and self.recognition_cache.getStats()
+
+    def get_face_match_threshold(self) -> float:
+        try:
+            threshold = (self.plugin or self).storage.getItem("face_match_threshold")
+            if threshold is None or threshold == "":
+                return 0.5
+            return float(threshold)
+        except:
+            return 0.5
+
+    def get_face_gallery_quantize(self) -> bool:
+        return str((self.plugin or self).storage.getItem("face_gallery_quantize")).lower() == "true"
+
+    def get_face_matched_embeddings(self) -> bool:
+        return str((self.plugin or self).storage.getItem("face_matched_embeddings")).lower() == "true"
+
+    def get_embedding_format(self, detection_session: ObjectDetectionSession = None) -> str:
+        # consumers may request a format for their session.
+        format = detection_session and (detection_session.get("settings") or {}).get("embeddingFormat")
+        if format not in EMBEDDING_FORMATS:
+            format = (self.plugin or self).storage.getItem("embedding_format")
+        return format if format in EMBEDDING_FORMATS else DEFAULT_EMBEDDING_FORMAT
+
+    def getEmbeddingSettings(self) -> list[Setting]:
+        if self.nativeId:
+            return []
+        return [
+            {
+                "key": "embedding_format",
+                "title": "Embedding Format",
+                "description": "How face and image embeddings are returned in detections. Base64 is compatible with all consumers. Buffer sends the raw float32 vector, and Float16 and Int8 quantize it to half and a quarter of the size.",
+                "choices": EMBEDDING_FORMATS,
+                "value": self.get_embedding_format(),
+            },
+        ]
+
+    def getFaceGallerySettings(self) -> list[Setting]:
+        if self.nativeId:
+            return []
+        return [
+            {
+                "key": "face_match_threshold",
+                "title": "Face Match Threshold",
+                "description": "The cosine similarity a face must have to an identity in the face gallery to be labeled with it.",
+                "type": "number",
+                "value": self.get_face_match_threshold(),
+            },
+            {
+                "key": "face_gallery_quantize",
+                "title": "Quantize Face Gallery",
+                "description": "Compress large face galleries in memory with product quantization. Matches are rescored against the full embeddings on disk.",
+                "type": "boolean",
+                "value": self.get_face_gallery_quantize(),
+            },
+            {
+                "key": "face_matched_embeddings",
+                "title": "Include Matched Face Embeddings",
+                "description": "Include the embedding of faces that were labeled from the face gallery. Unmatched faces always include their embedding.",
+                "type": "boolean",
+                "value": self.get_face_matched_embeddings(),
+            },
+        ]
+
+    async def get_appearance_signature(self, image: scrypted_sdk.Image, detection: ObjectDetectionResult) -> np.ndarray:
+        l, t, w, h = detection["boundingBox"]
+        buffer = await image.toBuffer(
+            {
+                "crop": {
+                    "left": l,
+                    "top": t,
+                    "width": w,
+                    "height": h,
+                },
+                "resize": {
+                    "width": SIGNATURE_SIZE,
+                    "height": SIGNATURE_SIZE,
+                },
+                "format": "gray",
+            }
+        )
+        return np.frombuffer(buffer, dtype=np.uint8).astype(np.float32)
+
+    async def recognize_cached(
+        self,
+        image: scrypted_sdk.Image,
+        detection_session: ObjectDetectionSession,
+        detections: List[ObjectDetectionResult],
+        fields: List[str],
+        recognize,
+    ):
+        # runs a second stage model on the detections, recognize(detections),
+        # skipping the detections whose result (fields) is cached.
+        cache = self.get_recognition_cache()
+        source = detection_session and detection_session.get("sourceId")
+        if not cache or not source:
+            return await recognize(detections)
+
+        # tracked objects are identified by their id, others by their box, and
+        # optionally by appearance, which costs a crop of every untracked detection.
+        use_signature = self.get_recognition_cache_signature()
+
+        async def get_signature(detection: ObjectDetectionResult):
+            if detection.get("id") or not use_signature:
+                return None
+            return await self.get_appearance_signature(image, detection)
+
+        signatures = await asyncio.gather(*[get_signature(d) for d in detections])
+        tracker = self.get_tracking_enabled() and self.trackers.get(source)
+        pending = []
+        for detection, signature in zip(detections, signatures):
+            cached = cache.lookup(source, detection, signature)
+            if not cached and tracker and detection.get("id"):
+                if not tracker.should_process(
+                    detection["id"], self.nativeId or "detection", TRACK_RECOGNITION_INTERVAL
+                ):
+                    cached = cache.peek(source, detection)
+            if cached:
+                detection.update(cached)
+            else:
+                pending.append((detection, signature))
+
+        if not pending:
+            return
+        await recognize([detection for detection, _ in pending])
+        for detection, signature in pending:
+            value = {field: detection[field] for field in fields if field in detection}
+            if value:
+                cache.store(source, detection, value, signature)
+
+    def get_tracker(
+        self, detection_session: ObjectDetectionSession, image: scrypted_sdk.Image = None
+    ) -> Tracker:
+        sourceId = detection_session and detection_session.get("sourceId")
+        if not sourceId or not self.get_tracking_enabled():
+            return None
+
+        now = time.time() * 1000
+        for id, tracker in list(self.trackers.items()):
+            if now - tracker.last_update > TRACKER_EXPIRY * 1000:
+                self.trackers.pop(id)
+
+        tracker = self.trackers.get(sourceId)
+        # a different stream resolution invalidates the tracked boxes.
+        size = image and (image.width, image.height)
+        if not tracker or (size and tracker.size != size):
+            tracker = self.trackers[sourceId] = Tracker(size=size)
+        tracker.last_update = now
+        return tracker
+
+    def get_zone_crop_enabled(self) -> bool:
+        return str(self.storage.getItem("zone_crop")).lower() == "true"
+
+    def get_detection_zones(self, detection_session: ObjectDetectionSession) -> List[Any]:
+        if not detection_session or not self.get_zone_crop_enabled():
+            return None
+        return get_inclusion_zones(detection_session.get("zones"))
+
+    def get_zone_crop(self, image: scrypted_sdk.Image, zones: List[Any]) -> Any:
+        # the region of the frame that contains every inclusion zone, with a margin
+        # for objects that extend past the zone edge.
+        if not zones:
+            return None
+        w, h = self.get_input_size()
+        if w is None or h is None:
+            return None
+
+        iw, ih = image.width, image.height
+        left, top, right, bottom = get_zones_bounds(zones)
+        left = max(0, left - ZONE_CROP_MARGIN) * iw
+        top = max(0, top - ZONE_CROP_MARGIN) * ih
+        right = min(1, right + ZONE_CROP_MARGIN) * iw
+        bottom = min(1, bottom + ZONE_CROP_MARGIN) * ih
+
+        # grow the region to the model aspect ratio so it is not stretched.
+        cw, ch = max(1, right - left), max(1, bottom - top)
+        aspect = w / h
+        if cw / ch < aspect:
+            cw = min(iw, ch * aspect)
+        else:
+            ch = min(ih, cw / aspect)
+        cx, cy = (left + right) / 2, (top + bottom) / 2
+        left = min(max(0, cx - cw / 2), iw - cw)
+        top = min(max(0, cy - ch / 2), ih - ch)
+
+        # not worth cropping when the zones cover most of the frame.
+        if cw * ch > iw * ih * ZONE_CROP_MAX_AREA:
+            return None
+
+        return {
+            "left": int(left),
+            "top": int(top),
+            "width": int(cw),
+            "height": int(ch),
+        }
+
+    async def detect_region(
+        self, image: scrypted_sdk.Image, settings: Any, crop: Any = None
+    ) -> ObjectsDetected:
+        # detect objects in the image, or a crop of it, with results in image coordinates.
+        if crop:
+            iw, ih = crop["width"], crop["height"]
+            origin = (crop["left"], crop["top"])
+        else:
+            iw, ih = image.width, image.height
+            origin = (0, 0)
+        w, h = self.get_input_size()
+
+        if w is None or h is None:
+            w = iw
+            h = ih
+            cvss = SourceTransform(origin=origin)
+        else:
+            cvss = SourceTransform((w / iw, h / ih), origin=origin)
+
+        options = self.get_input_buffer_options(image, settings, crop)
+        format = options["format"]
+        b = await image.toBuffer(options)
+
+        if settings and settings.get("pad", False):
+            nw = options["resize"]["width"]
+            nh = options["resize"]["height"]
+
             if self.get_input_format() == "rgb":
                 data = await common.colors.ensureRGBData(b, (nw, nh), format)
             elif self.get_input_format() == "rgba":
@@ -357,18 +1148,12 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
             new_image = Image.new(data.mode, (w, h))
             paste_x = (w - nw) // 2
             paste_y = (h - nh) // 2
+            cvss = SourceTransform((nw / iw, nh / ih), (paste_x, paste_y), origin)
             new_image.paste(data, (paste_x, paste_y))
             data.close()
             data = new_image
 
         else:
-            b = await image.toBuffer(
-                {
-                    "resize": resize,
-                    "format": format,
-                }
-            )
-
             if self.get_input_format() == "rgb":
                 data = await common.colors.ensureRGBData(b, (w, h), format)
             elif self.get_input_format() == "rgba":
@@ -379,11 +1164,119 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
                 raise Exception("unsupported format")
 
         try:
-            ret = await self.safe_detect_once(data, settings, (iw, ih), cvss)
+            ret = await self.safe_detect_once(data, settings, (image.width, image.height), cvss)
             return ret
         finally:
             data.close()
 
+    # settings shared by all detection backends that run through run_detection_image.
+    def getPipelineSettings(self) -> list[Setting]:
+        return (
+            self.getBatchSettings()
+            + self.getPrefetchSettings()
+            + self.getAdmissionSettings()
+            + self.getTileSettings()
+            + self.getZoneSettings()
+            + self.getHealthSettings()
+            + self.getModelMemorySettings()
+            + self.getTrackingSettings()
+            + self.getRecognitionCacheSettings()
+            + self.getFaceGallerySettings()
+            + self.getEmbeddingSettings()
+        )
+
+    def getZoneSettings(self) -> list[Setting]:
+        return [
+            {
+                "key": "zone_crop",
+                "title": "Crop To Zones",
+                "description": "When a camera has inclusion zones, only detect the region of the frame containing them and drop detections outside of the zones.",
+                "type": "boolean",
+                "value": self.get_zone_crop_enabled(),
+            },
+        ]
+
+    def get_tile_grid(self) -> Tuple[int, int]:
+        grid = self.storage.getItem("tile_grid") or "Disabled"
+        try:
+            columns, rows = grid.split("x")
+            return int(columns), int(rows)
+        except:
+            return None
+
+    def get_tile_overlap(self) -> float:
+        try:
+            overlap = self.storage.getItem("tile_overlap")
+            if overlap is None or overlap == "":
+                return 0.2
+            return min(50, max(0, float(overlap))) / 100
+        except:
+            return 0.2
+
+    def getTileSettings(self) -> list[Setting]:
+        w, h = self.get_input_size() or (None, None)
+        if w is None or h is None:
+            return []
+        return [
+            {
+                "key": "tile_grid",
+                "title": "Tiled Detection",
+                "description": "Split high resolution frames into overlapping tiles (columns x rows) that are detected together with the full frame. Improves recall of small or distant objects at the cost of running the model once per tile.",
+                "choices": ["Disabled", "2x1", "2x2", "3x2", "3x3", "4x3"],
+                "value": self.storage.getItem("tile_grid") or "Disabled",
+            },
+            {
+                "key": "tile_overlap",
+                "title": "Tile Overlap",
+                "description": "The percentage that adjacent tiles overlap, so objects on a tile boundary are fully contained in at least one tile.",
+                "type": "number",
+                "value": int(self.get_tile_overlap() * 100),
+                "range": [0, 50],
+            },
+        ]
+
+    def get_detection_tiles(self, image: scrypted_sdk.Image) -> List[Any]:
+        grid = self.get_tile_grid()
+        if not grid:
+            return None
+        w, h = self.get_input_size()
+        if w is None or h is None:
+            return None
+
+        columns, rows = grid
+        overlap = self.get_tile_overlap()
+        iw, ih = image.width, image.height
+        # tiles of equal size that span the frame, each overlapping its neighbors.
+        tw = iw / (columns - (columns - 1) * overlap)
+        th = ih / (rows - (rows - 1) * overlap)
+        tiles = []
+        for row in range(rows):
+            for column in range(columns):
+                left = int(round(column * tw * (1 - overlap)))
+                top = int(round(row * th * (1 - overlap)))
+                tiles.append(
+                    {
+                        "left": left,
+                        "top": top,
+                        "width": min(int(round(tw)), iw - left),
+                        "height": min(int(round(th)), ih - top),
+                    }
+                )
+        return tiles
+
+    async def run_tiled_detection(
+        self, image: scrypted_sdk.Image, settings: Any, tiles: List[Any]
+    ) -> ObjectsDetected:
+        # the full frame is detected along with the tiles to find objects
+        # that are larger than a tile.
+        crops = [None] + tiles
+        if self.get_batch_size() > 1:
+            self.get_batcher().expect(len(crops))
+        results = await asyncio.gather(
+            *[self.detect_region(image, settings, crop) for crop in crops]
+        )
+        return merge_detection_results(results, (image.width, image.height))
+
     async def forkInterfaceInternal(self, options: dict):
         if self.plugin:
             return await self.plugin.forkInterfaceInternal(options)
@@ -416,6 +1309,9 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
             raise Exception("unsupported fork interface")
 
         result = await self.forkInterfaceInternal(options)
+        return await self.get_fork_detector(result)
+
+    async def get_fork_detector(self, result: Fork) -> PredictPlugin:
         if not self.nativeId:
             ret = await result.getPlugin()
         elif self.nativeId == "textrecognition":
@@ -430,6 +1326,113 @@ class PredictPlugin(DetectPlugin, scrypted_sdk.ClusterForkInterface, scrypted_sd
             ret = await result.getCustomDetection(self.nativeId)
         return ret
 
+    def get_dispatch_forks(self) -> Mapping[str, scrypted_sdk.PluginFork]:
+        root = self.plugin or self
+        if root.forked:
+            return {}
+        # workers that are still starting can't take sessions yet.
+        return {
+            id: fork
+            for id, fork in root.forks.items()
+            if fork.result.done() and not fork.result.cancelled() and not fork.result.exception()
+        }
+
+    def get_dispatcher(self) -> ForkDispatcher:
+        if not self.dispatcher:
+            self.dispatcher = ForkDispatcher()
+        # workers joining or leaving the cluster rebalance the sessions,
+        # as do changes in their measured latencies.
+        if self.dispatcher.sync(self.get_dispatch_forks().keys()):
+            print("cluster dispatch", self.dispatcher.getStats())
+        else:
+            self.dispatcher.maybe_rebalance()
+        return self.dispatcher
+
+    def getDispatchStats(self):
+        return self.get_dispatcher().getStats()
+
+    async def generateObjectDetections(
+        self, videoFrames: Any, session: ObjectDetectionGeneratorSession = None
+    ) -> Any:
+        if len(self.get_dispatch_forks()) < 2:
+            async for detected in super().generateObjectDetections(videoFrames, session):
+                yield detected
+            return
+
+        async for detected in self.generateObjectDetectionsDispatched(videoFrames, session):
+            yield detected
+
+    async def generateObjectDetectionsDispatched(
+        self, videoFrames: Any, session: ObjectDetectionGeneratorSession
+    ) -> Any:
+        # the session is pinned to the least loaded cluster fork, and
+        # each frame is forwarded there. the frame image is passed through
+        # unconnected so the fork fetches it directly from its source.
+        sessionId = object()
+        try:
+            videoFrames = await scrypted_sdk.sdk.connectRPCObject(videoFrames)
+            videoFrame: scrypted_sdk.VideoFrame
+            async for videoFrame in videoFrames:
+                detected = await self.dispatch_detection_frame(
+                    sessionId, videoFrame["image"], session
+                )
+                yield {
+                    "__json_copy_serialize_children": True,
+                    "detected": detected,
+                    "videoFrame": videoFrame,
+                }
+        finally:
+            self.get_dispatcher().release(sessionId)
+            try:
+                await videoFrames.aclose()
+            except:
+                pass
+
+    async def dispatch_detection_frame(
+        self, sessionId: Any, image: scrypted_sdk.Image, session: ObjectDetectionSession
+    ) -> ObjectsDetected:
+        # a frame that fails on a remote fork is retried once elsewhere,
+        # the worker may have just left the cluster.
+        for attempt in range(2):
+            dispatcher = self.get_dispatcher()
+            clusterWorkerId = dispatcher.assign(sessionId)
+            forks = self.get_dispatch_forks()
+            fork = forks.get(clusterWorkerId)
+            if not fork:
+                # the assigned worker is no longer usable.
+                clusterWorkerId = dispatcher.reassign(sessionId)
+                fork = forks.get(clusterWorkerId)
+            if not fork:
+                # no usable workers are left, not even this one. that is not
+                # a failure of the frame, so detect it here.
+                dispatcher.release(sessionId)
+                image = await scrypted_sdk.sdk.connectRPCObject(image)
+                return await self.run_detection_image(image, session)
+            started = dispatcher.start(clusterWorkerId)
+            local = False
+            try:
+                detector = await self.get_fork_detector(fork.result.result())
+                if detector is self:
+                    local = True
+                    image = await scrypted_sdk.sdk.connectRPCObject(image)
+                    detected = await self.run_detection_image(image, session)
+                else:
+                    detected = await detector.detectClusterFrame(image, session)
+            except Exception:
+                dispatcher.done(started, True)
+                if attempt or local:
+                    raise
+                dispatcher.reassign(sessionId)
+                continue
+            dispatcher.done(started)
+            return detected
+
+    async def detectClusterFrame(
+        self, image: scrypted_sdk.Image, session: ObjectDetectionSession = None
+    ) -> ObjectsDetected:
+        image = await scrypted_sdk.sdk.connectRPCObject(image)
+        return await self.run_detection_image(image, session)
+
     async def startCluster(self):
         try:
             clusterManager = scrypted_sdk.clusterManager
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Mapping
+
+# exponential moving average weight of the most recent sample.
+LATENCY_ALPHA = 0.2
+# per priority step, the latency a frame will tolerate doubles (or halves).
+MIN_PRIORITY = -2
+MAX_PRIORITY = 2
+REPORT_INTERVAL = 60
+
+
+def get_priority(settings: Any) -> int:
+    try:
+        priority = int((settings and settings.get("priority")) or 0)
+    except:
+        return 0
+    return max(MIN_PRIORITY, min(MAX_PRIORITY, priority))
+
+
+class AdmissionController:
+    """
+    Sheds frames when a model is saturated. The time a new frame would wait is
+    estimated from the number of requests in flight and the recent service
+    time of the model. Frames that would exceed the latency target are skipped
+    immediately instead of piling up in the backend executors until the
+    detection timeout forces a restart.
+
+    Sessions may set a priority (-2 to 2) in their settings. Each step doubles
+    (or halves) the latency a frame will tolerate, so a doorbell at priority 1
+    keeps being detected after a backyard camera at -1 has started shedding.
+    """
+
+    def __init__(self, latency_target: float, capacity: int = 1):
+        self.latency_target = latency_target
+        self.capacity = max(1, capacity)
+        self.inflight = 0
+        # latency of requests that did not have to queue, ie, the model itself.
+        self.service_time: float = None
+        # latency of all requests, including time spent queued.
+        self.latency: float = None
+        self.admitted = 0
+        self.skipped = 0
+        self.skipped_by_priority: Mapping[int, int] = {}
+        self.skipped_by_source: Mapping[str, int] = {}
+        # report the first skip immediately.
+        self.last_report = time.monotonic() - REPORT_INTERVAL
+        self.last_report_skipped = 0
+
+    def estimate(self) -> float:
+        if self.service_time is None:
+            return 0
+        # the requests ahead of this one are processed capacity at a time.
+        return self.service_time * (1 + self.inflight // self.capacity)
+
+    def admit(self, priority: int = 0, source_id: str = None) -> bool:
+        # an idle model is never shed, even if it is slower than the target.
+        if self.latency_target and self.inflight >= self.capacity:
+            allowed = self.latency_target * (2**priority)
+            if self.estimate() > allowed:
+                self.skip(priority, source_id)
+                return False
+        self.admitted += 1
+        self.inflight += 1
+        return True
+
+    def skip(self, priority: int, source_id: str):
+        self.skipped += 1
+        self.skipped_by_priority[priority] = self.skipped_by_priority.get(priority, 0) + 1
+        if source_id:
+            self.skipped_by_source[source_id] = self.skipped_by_source.get(source_id, 0) + 1
+        self.report()
+
+    def start(self):
+        return time.monotonic(), self.inflight - 1 < self.capacity
+
+    def done(self, started):
+        start, unqueued = started
+        self.inflight -= 1
+        elapsed = time.monotonic() - start
+        self.latency = self.ewma(self.latency, elapsed)
+        if unqueued:
+            self.service_time = self.ewma(self.service_time, elapsed)
+
+    def ewma(self, current: float, sample: float):
+        if current is None:
+            return sample
+        return current + LATENCY_ALPHA * (sample - current)
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.last_report < REPORT_INTERVAL:
+            return
+        skipped = self.skipped - self.last_report_skipped
+        print(
+            "detector overloaded: skipped %s frames (latency target %sms, estimated %sms, in flight %s)"
+            % (
+                skipped,
+                int(self.latency_target * 1000),
+                int(self.estimate() * 1000),
+                self.inflight,
+            )
+        )
+        self.last_report = now
+        self.last_report_skipped = self.skipped
+
+    def getStats(self):
+        return {
+            "latencyTarget": self.latency_target,
+            "capacity": self.capacity,
+            "inflight": self.inflight,
+            "serviceTime": self.service_time,
+            "latency": self.latency,
+            "estimate": self.estimate(),
+            "admitted": self.admitted,
+            "skipped": self.skipped,
+            "skippedByPriority": dict(self.skipped_by_priority),
+            "skippedBySource": dict(self.skipped_by_source),
+        }
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, List, Tuple
+
+
+class DynamicBatcher:
+    """
+    Gathers concurrent inference requests (typically from different cameras)
+    into a single batch. A batch is dispatched immediately when the model is
+    idle, when max_batch_size requests are queued, or when the oldest queued
+    request has waited max_wait seconds. While a batch is in flight, new
+    requests accumulate, so batch size grows with load without adding latency
+    when only a single camera is active.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int,
+        max_wait: float,
+        concurrency: int = 1,
+        loop: asyncio.AbstractEventLoop = None,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.concurrency = max(1, concurrency)
+        self.loop = loop or asyncio.get_event_loop()
+        self.pending: List[Tuple[Any, asyncio.Future]] = []
+        self.inflight = 0
+        self.expected = 0
+        self.timer: asyncio.TimerHandle = None
+        self.batches = 0
+        self.batched = 0
+
+    def expect(self, count: int):
+        # a session may hint that more requests are coming, ie, the first
+        # frame of a batch. hold the batch open for them (up to max_wait).
+        self.expected += count
+
+    async def submit(self, input: Any) -> Any:
+        future = self.loop.create_future()
+        self.pending.append((input, future))
+        if self.expected:
+            self.expected -= 1
+        self.maybe_flush()
+        return await future
+
+    def maybe_flush(self):
+        while self.pending:
+            full = len(self.pending) >= self.max_batch_size
+            idle = self.inflight < self.concurrency and not self.expected
+            if not full and not idle:
+                if not self.timer:
+                    self.timer = self.loop.call_later(self.max_wait, self.timeout)
+                return
+            self.flush()
+
+    def timeout(self):
+        self.timer = None
+        self.expected = 0
+        if self.pending:
+            self.flush()
+            self.maybe_flush()
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending[: self.max_batch_size]
+        self.pending = self.pending[self.max_batch_size :]
+        self.inflight += 1
+        self.batches += 1
+        self.batched += len(batch)
+        asyncio.ensure_future(self.run(batch), loop=self.loop)
+
+    async def run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.run_batch([input for input, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.inflight -= 1
+            self.maybe_flush()
+
+    def getStats(self):
+        return {
+            "batches": self.batches,
+            "batched": self.batched,
+            "averageBatchSize": self.batched / self.batches if self.batches else 0,
+            "pending": len(self.pending),
+            "inflight": self.inflight,
+        }
+
+
+if __name__ == "__main__":
+    # throughput benchmark against a stand-in model: a fixed per-call overhead
+    # plus a per-image cost, run on a single executor thread like a backend.
+    import concurrent.futures
+    import time
+
+    import numpy as np
+
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    weights = np.random.rand(3 * 64 * 64, 256).astype(np.float32)
+
+    def model(inputs: np.ndarray):
+        time.sleep(0.004)
+        return inputs.reshape(inputs.shape[0], -1) @ weights
+
+    async def benchmark(cameras: int, frames: int, max_batch_size: int):
+        loop = asyncio.get_event_loop()
+
+        async def run_batch(inputs: List[np.ndarray]):
+            output = await loop.run_in_executor(executor, model, np.stack(inputs))
+            return list(output)
+
+        batcher = DynamicBatcher(run_batch, max_batch_size, 0.01, loop=loop)
+
+        async def camera():
+            for _ in range(frames):
+                await batcher.submit(np.random.rand(3, 64, 64).astype(np.float32))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[camera() for _ in range(cameras)])
+        elapsed = time.perf_counter() - start
+        stats = batcher.getStats()
+        print(
+            "cameras %2d max batch %2d: %7.1f frames/s, average batch %.2f"
+            % (
+                cameras,
+                max_batch_size,
+                cameras * frames / elapsed,
+                stats["averageBatchSize"],
+            )
+        )
+
+    async def main():
+        for cameras in [1, 4, 8]:
+            for max_batch_size in [1, 4, 8]:
+                await benchmark(cameras, 100, max_batch_size)
+
+    asyncio.run(main())
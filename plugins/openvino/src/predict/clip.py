@@ -1,16 +1,19 @@
 from __future__ import annotations
 
 import asyncio
-import base64
 from typing import Tuple
 
+import numpy as np
 import scrypted_sdk
 from transformers import CLIPProcessor
 
 from predict import PredictPlugin
+from predict.embedding import encode_embedding
 
 
 class ClipEmbedding(PredictPlugin, scrypted_sdk.TextEmbedding, scrypted_sdk.ImageEmbedding):
+    lazy_models = True
+
     def __init__(self, plugin: PredictPlugin, nativeId: str):
         super().__init__(nativeId=nativeId, plugin=plugin)
 
@@ -23,11 +26,7 @@ class ClipEmbedding(PredictPlugin, scrypted_sdk.TextEmbedding, scrypted_sdk.Imag
         self.loop = asyncio.get_event_loop()
         self.minThreshold = 0.5
 
-        try:
-           self.model = self.initModel()
-        except Exception as e:
-            self.print("Error initializing CLIP model:", e)
-            raise
+        self.model = None
 
         self.processor = None
         self.print("Loading CLIP processor from local cache.")
@@ -54,6 +53,13 @@ class ClipEmbedding(PredictPlugin, scrypted_sdk.TextEmbedding, scrypted_sdk.Imag
         except Exception:
             self.print("CLIP processor cache refresh failed.")
 
+    def load_models(self):
+        try:
+            return {"model": self.initModel()}
+        except Exception as e:
+            self.print("Error initializing CLIP model:", e)
+            raise
+
     def initModel(self):
         pass
 
@@ -67,8 +73,13 @@ class ClipEmbedding(PredictPlugin, scrypted_sdk.TextEmbedding, scrypted_sdk.Imag
     
     async def detectObjects(self, mediaObject, session = None):
         ret = await super().detectObjects(mediaObject, session)
-        embedding = ret["detections"][0]['embedding']
-        ret["detections"][0]['embedding'] = base64.b64encode(embedding).decode("utf-8")
+        detection = ret["detections"][0]
+        embedding = np.frombuffer(detection["embedding"], dtype=np.float32)
+        detection["embedding"], embeddingFormat = encode_embedding(
+            embedding, self.get_embedding_format(session)
+        )
+        if embeddingFormat:
+            detection["embeddingFormat"] = embeddingFormat
         return ret
 
     # width, height, channels
@@ -37,31 +37,27 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text,
     text_score_comb = np.clip(text_score + link_score, 0, 1)
     nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score_comb.astype(np.uint8), connectivity=4)
 
+    # link area, removed from every component.
+    link_area = np.logical_and(link_score==1, text_score==0)
+
+    # each component is processed within its bounding box, grown by the
+    # dilation, rather than in a frame sized map. the map is empty outside
+    # of that region, so the result is the same.
     det = []
     scores = []
     mapper = []
-    for k in range(1,nLabels):
-        # size filtering
+    bounds = []
+    for k in np.flatnonzero(stats[:, cv2.CC_STAT_AREA] >= 10):
+        if k == 0: continue
         size = stats[k, cv2.CC_STAT_AREA]
-        if size < 10: continue
+        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
 
         # thresholding
-        score = np.max(textmap[labels==k])
+        component = labels[y:y+h, x:x+w]==k
+        score = np.max(textmap[y:y+h, x:x+w][component])
         if score < text_threshold: continue
 
-        # make segmentation map
-        segmap = np.zeros(textmap.shape, dtype=np.uint8)
-        segmap[labels==k] = 255
-        if estimate_num_chars:
-            from scipy.ndimage import label
-            _, character_locs = cv2.threshold((textmap - linkmap) * segmap /255., text_threshold, 1, 0)
-            _, n_chars = label(character_locs)
-            mapper.append(n_chars)
-        else:
-            mapper.append(k)
-        segmap[np.logical_and(link_score==1, text_score==0)] = 0   # remove link area
-        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
-        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
         niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
         sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
         # boundary check
@@ -69,31 +65,49 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text,
         if sy < 0 : sy = 0
         if ex >= img_w: ex = img_w
         if ey >= img_h: ey = img_h
+
+        # make segmentation map
+        segmap = np.zeros((ey - sy, ex - sx), dtype=np.uint8)
+        segmap[labels[sy:ey, sx:ex]==k] = 255
+        if estimate_num_chars:
+            from scipy.ndimage import label
+            _, character_locs = cv2.threshold((textmap[sy:ey, sx:ex] - linkmap[sy:ey, sx:ex]) * segmap /255., text_threshold, 1, 0)
+            _, n_chars = label(character_locs)
+            mapper.append(n_chars)
+        else:
+            mapper.append(int(k))
+        segmap[link_area[sy:ey, sx:ex]] = 0   # remove link area
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(1 + niter, 1 + niter))
-        segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
+        segmap = cv2.dilate(segmap, kernel)
 
         # make box
-        np_contours = np.roll(np.array(np.where(segmap!=0)),1,axis=0).transpose().reshape(-1,2)
+        ys, xs = np.where(segmap!=0)
+        np_contours = np.stack([xs + sx, ys + sy], axis=1)
         rectangle = cv2.minAreaRect(np_contours)
-        box = cv2.boxPoints(rectangle)
-
-        # align diamond-shape
-        w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
-        box_ratio = max(w, h) / (min(w, h) + 1e-5)
-        if abs(1 - box_ratio) <= 0.1:
-            l, r = min(np_contours[:,0]), max(np_contours[:,0])
-            t, b = min(np_contours[:,1]), max(np_contours[:,1])
-            box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
-
-        # make clock-wise order
-        startidx = box.sum(axis=1).argmin()
-        box = np.roll(box, 4-startidx, 0)
-        box = np.array(box)
-
-        det.append(box)
+        det.append(cv2.boxPoints(rectangle))
+        bounds.append((np_contours[:,0].min(), np_contours[:,1].min(), np_contours[:,0].max(), np_contours[:,1].max()))
         scores.append(score)
 
-    return det, labels, mapper, scores
+    if not det:
+        return det, labels, mapper, scores
+
+    boxes = np.array(det)
+    bounds = np.array(bounds, dtype=np.float32)
+
+    # align diamond-shape
+    w = np.linalg.norm(boxes[:, 0] - boxes[:, 1], axis=1)
+    h = np.linalg.norm(boxes[:, 1] - boxes[:, 2], axis=1)
+    box_ratio = np.maximum(w, h) / (np.minimum(w, h) + 1e-5)
+    diamond = np.abs(1 - box_ratio) <= 0.1
+    l, t, r, b = bounds[diamond].T
+    boxes[diamond] = np.stack([np.stack([l, t], 1), np.stack([r, t], 1), np.stack([r, b], 1), np.stack([l, b], 1)], 1)
+
+    # make clock-wise order
+    startidx = boxes.sum(axis=2).argmin(axis=1)
+    order = (np.arange(4)[None, :] + startidx[:, None]) % 4
+    boxes = np.take_along_axis(boxes, order[:, :, None], axis=1)
+
+    return list(boxes), labels, mapper, scores
 
 def getPoly_core(boxes, labels, mapper, linkmap):
     # configs
@@ -260,3 +274,124 @@ def adjustResultCoordinates(polys, ratio_w, ratio_h, ratio_net = 2):
             if polys[k] is not None:
                 polys[k] *= (ratio_w * ratio_net, ratio_h * ratio_net)
     return polys
+
+
+if __name__ == "__main__":
+    # synthetic heatmaps: python -m predict.craft_utils
+    # checks getDetBoxes_core against the previous frame sized implementation.
+    import time
+
+    def previous_getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text, estimate_num_chars=False):
+        linkmap = linkmap.copy()
+        textmap = textmap.copy()
+        img_h, img_w = textmap.shape
+        ret, text_score = cv2.threshold(textmap, low_text, 1, 0)
+        ret, link_score = cv2.threshold(linkmap, link_threshold, 1, 0)
+        text_score_comb = np.clip(text_score + link_score, 0, 1)
+        nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score_comb.astype(np.uint8), connectivity=4)
+        det = []
+        scores = []
+        mapper = []
+        for k in range(1,nLabels):
+            size = stats[k, cv2.CC_STAT_AREA]
+            if size < 10: continue
+            score = np.max(textmap[labels==k])
+            if score < text_threshold: continue
+            segmap = np.zeros(textmap.shape, dtype=np.uint8)
+            segmap[labels==k] = 255
+            if estimate_num_chars:
+                from scipy.ndimage import label
+                _, character_locs = cv2.threshold((textmap - linkmap) * segmap /255., text_threshold, 1, 0)
+                _, n_chars = label(character_locs)
+                mapper.append(n_chars)
+            else:
+                mapper.append(k)
+            segmap[np.logical_and(link_score==1, text_score==0)] = 0
+            x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+            w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+            niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
+            sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
+            if sx < 0 : sx = 0
+            if sy < 0 : sy = 0
+            if ex >= img_w: ex = img_w
+            if ey >= img_h: ey = img_h
+            kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(1 + niter, 1 + niter))
+            segmap[sy:ey, sx:ex] = cv2.dilate(segmap[sy:ey, sx:ex], kernel)
+            np_contours = np.roll(np.array(np.where(segmap!=0)),1,axis=0).transpose().reshape(-1,2)
+            rectangle = cv2.minAreaRect(np_contours)
+            box = cv2.boxPoints(rectangle)
+            w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
+            box_ratio = max(w, h) / (min(w, h) + 1e-5)
+            if abs(1 - box_ratio) <= 0.1:
+                l, r = min(np_contours[:,0]), max(np_contours[:,0])
+                t, b = min(np_contours[:,1]), max(np_contours[:,1])
+                box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
+            startidx = box.sum(axis=1).argmin()
+            box = np.roll(box, 4-startidx, 0)
+            box = np.array(box)
+            det.append(box)
+            scores.append(score)
+        return det, labels, mapper, scores
+
+    rng = np.random.default_rng(0)
+
+    def heatmaps(lines: int, size: int = 320):
+        # lines of gaussian character blobs, with link blobs between them,
+        # at random positions, angles and scales, as craft predicts.
+        yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+        textmap = np.zeros((size, size), dtype=np.float32)
+        linkmap = np.zeros((size, size), dtype=np.float32)
+        for _ in range(lines):
+            chars = int(rng.integers(1, 10))
+            scale = rng.uniform(1.5, 6)
+            angle = rng.uniform(-0.5, 0.5)
+            cx, cy = rng.uniform(0, size, 2)
+            strength = rng.uniform(0.6, 1)
+            for c in range(chars + 1):
+                for link, offset in [(False, c), (True, c + 0.5)]:
+                    if link and c == chars:
+                        continue
+                    px = cx + np.cos(angle) * offset * scale * 2.2
+                    py = cy + np.sin(angle) * offset * scale * 2.2
+                    blob = strength * np.exp(-((xx - px) ** 2 + (yy - py) ** 2) / (2 * scale**2))
+                    target = linkmap if link else textmap
+                    np.maximum(target, blob, out=target)
+        noise = rng.normal(0, 0.02, (2, size, size)).astype(np.float32)
+        return np.clip(textmap + noise[0], 0, 1), np.clip(linkmap + noise[1], 0, 1)
+
+    # the thresholds the text detector uses.
+    args = (0.7, 0.9, 0.5)
+    corpus = [heatmaps(lines) for lines in [0, 1, 5, 20, 60, 120] for _ in range(5)]
+    estimate = [False]
+    try:
+        import scipy.ndimage
+        estimate.append(True)
+    except ImportError:
+        print("scipy is not installed, skipping estimate_num_chars")
+
+    components = 0
+    for textmap, linkmap in corpus:
+        for estimate_num_chars in estimate:
+            det, labels, mapper, scores = getDetBoxes_core(textmap, linkmap, *args, estimate_num_chars)
+            expected = previous_getDetBoxes_core(textmap, linkmap, *args, estimate_num_chars)
+            assert len(det) == len(expected[0])
+            for box, expected_box in zip(det, expected[0]):
+                assert box.dtype == expected_box.dtype and np.array_equal(box, expected_box)
+            assert np.array_equal(labels, expected[1])
+            assert mapper == expected[2]
+            assert scores == expected[3]
+            components += len(det)
+    print("%s heatmaps, %s boxes: identical" % (len(corpus), components))
+
+    for lines in [5, 20, 60, 120]:
+        textmap, linkmap = heatmaps(lines)
+        results = []
+        for f in [previous_getDetBoxes_core, getDetBoxes_core]:
+            start = time.perf_counter()
+            for _ in range(3):
+                det = f(textmap, linkmap, *args)[0]
+            results.append((time.perf_counter() - start) / 3)
+        print(
+            "%3d lines (%3d boxes): frame sized %7.1fms  roi %5.1fms"
+            % (lines, len(det), results[0] * 1000, results[1] * 1000)
+        )
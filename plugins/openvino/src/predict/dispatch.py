@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Iterable, Mapping, Set
+
+# exponential moving average weight of the most recent latency sample.
+LATENCY_ALPHA = 0.2
+# seconds between rebalances from the measured latencies.
+REBALANCE_INTERVAL = 10
+# a session is only moved if that lowers the peak load by this fraction,
+# so noisy latency measurements don't bounce sessions between forks.
+REBALANCE_GAIN = 0.1
+
+
+class ForkLoad:
+    def __init__(self, id: str):
+        self.id = id
+        self.sessions: Set[Any] = set()
+        self.inflight = 0
+        self.completed = 0
+        self.errors = 0
+        self.latency: float = None
+
+    def getStats(self):
+        return {
+            "sessions": len(self.sessions),
+            "inflight": self.inflight,
+            "completed": self.completed,
+            "errors": self.errors,
+            "latency": self.latency,
+        }
+
+
+class ForkDispatcher:
+    """
+    Assigns detection sessions to cluster forks. Each fork tracks its in-flight
+    frames and measured latency; a session is placed on the fork where it adds
+    the least load, weighting each fork by its throughput (the inverse of its
+    latency), so a fast worker takes proportionally more cameras.
+
+    Sessions stick to their fork so per-session state stays warm, but are
+    moved at frame boundaries when workers join or leave the cluster, and
+    periodically as the measured latencies change.
+    """
+
+    def __init__(self, rebalance_interval: float = REBALANCE_INTERVAL):
+        self.rebalance_interval = rebalance_interval
+        self.forks: Mapping[str, ForkLoad] = {}
+        self.assignments: Mapping[Any, ForkLoad] = {}
+        self.migrations = 0
+        self.rebalanced = time.monotonic()
+
+    def sync(self, ids: Iterable[str]):
+        ids = set(ids)
+        if ids == set(self.forks.keys()):
+            return False
+
+        for id in ids - set(self.forks.keys()):
+            self.forks[id] = ForkLoad(id)
+
+        for id in set(self.forks.keys()) - ids:
+            fork = self.forks.pop(id)
+            for session in fork.sessions:
+                self.assignments.pop(session, None)
+            # the orphaned sessions are reassigned on their next frame.
+
+        self.rebalance()
+        return True
+
+    def maybe_rebalance(self):
+        now = time.monotonic()
+        if now - self.rebalanced < self.rebalance_interval:
+            return False
+        self.rebalance()
+        return True
+
+    def get_latency(self, fork: ForkLoad) -> float:
+        if fork.latency is not None:
+            return fork.latency
+        # forks without measurements are assumed to be as fast as the fastest
+        # known fork so they are tried.
+        measured = [f.latency for f in self.forks.values() if f.latency is not None]
+        return min(measured) if measured else 1
+
+    def cost(self, fork: ForkLoad, sessions: int = None) -> float:
+        if sessions is None:
+            sessions = len(fork.sessions)
+        if (
+            fork.latency is None
+            and sessions > 1
+            and any(f.latency is not None for f in self.forks.values())
+        ):
+            # an unmeasured fork only takes a single session until its
+            # latency is known, it may be much slower than the others.
+            return float("inf")
+        # time to serve every session on the fork once, ie, its relative load.
+        return (sessions + fork.inflight / 2) * self.get_latency(fork)
+
+    def choose(self) -> ForkLoad:
+        return min(self.forks.values(), key=lambda f: self.cost(f, len(f.sessions) + 1))
+
+    def assign(self, session: Any) -> str:
+        fork = self.assignments.get(session)
+        if fork:
+            return fork.id
+        if not self.forks:
+            return None
+        fork = self.choose()
+        fork.sessions.add(session)
+        self.assignments[session] = fork
+        return fork.id
+
+    def release(self, session: Any):
+        fork = self.assignments.pop(session, None)
+        if fork:
+            fork.sessions.discard(session)
+
+    def reassign(self, session: Any):
+        # the fork failed, move the session elsewhere.
+        self.release(session)
+        return self.assign(session)
+
+    def rebalance(self):
+        # greedily move sessions from the most to the least loaded fork
+        # while doing so lowers the peak load.
+        self.rebalanced = time.monotonic()
+        if len(self.forks) < 2:
+            return
+        while True:
+            busiest = max(self.forks.values(), key=self.cost)
+            idlest = min(self.forks.values(), key=lambda f: self.cost(f, len(f.sessions) + 1))
+            if busiest is idlest or not busiest.sessions:
+                return
+            before = self.cost(busiest)
+            after = max(
+                self.cost(busiest, len(busiest.sessions) - 1),
+                self.cost(idlest, len(idlest.sessions) + 1),
+            )
+            if after >= before:
+                return
+            # a move to an unmeasured fork is always made, so it gets a
+            # session to measure.
+            if idlest.latency is not None and after >= before * (1 - REBALANCE_GAIN):
+                return
+            session = next(iter(busiest.sessions))
+            busiest.sessions.discard(session)
+            idlest.sessions.add(session)
+            self.assignments[session] = idlest
+            self.migrations += 1
+
+    def start(self, id: str):
+        fork = self.forks.get(id)
+        if fork:
+            fork.inflight += 1
+        return fork, time.monotonic()
+
+    def done(self, started, error: bool = False):
+        fork, start = started
+        if not fork:
+            return
+        fork.inflight -= 1
+        if error:
+            fork.errors += 1
+            return
+        fork.completed += 1
+        elapsed = time.monotonic() - start
+        if fork.latency is None:
+            fork.latency = elapsed
+        else:
+            fork.latency += LATENCY_ALPHA * (elapsed - fork.latency)
+
+    def getStats(self):
+        return {
+            "migrations": self.migrations,
+            "forks": {id: fork.getStats() for id, fork in self.forks.items()},
+        }
+
+
+if __name__ == "__main__":
+    # simulation with fake forks of different speeds: python -m predict.dispatch
+    # cameras run a frame loop through the dispatcher while workers join and leave.
+    import asyncio
+    import random
+
+    class FakeFork:
+        def __init__(self, id: str, latency: float):
+            self.id = id
+            self.latency = latency
+            self.busy = asyncio.Lock()
+            self.frames = 0
+
+        async def detect(self):
+            # a single inference at a time, like a worker with one device.
+            async with self.busy:
+                await asyncio.sleep(self.latency * random.uniform(0.9, 1.1))
+            self.frames += 1
+
+    async def simulate():
+        # rebalanced more often than the default, to fit the short run.
+        dispatcher = ForkDispatcher(1)
+        forks: Mapping[str, FakeFork] = {}
+
+        def join(fork: FakeFork):
+            forks[fork.id] = fork
+            dispatcher.sync(forks.keys())
+
+        def leave(id: str):
+            forks.pop(id)
+            dispatcher.sync(forks.keys())
+
+        async def camera(session: int, frames: int):
+            for _ in range(frames):
+                dispatcher.maybe_rebalance()
+                id = dispatcher.assign(session)
+                started = dispatcher.start(id)
+                try:
+                    await forks[id].detect()
+                    dispatcher.done(started)
+                except KeyError:
+                    dispatcher.done(started, True)
+                    dispatcher.reassign(session)
+                # cameras send frames at about 5 fps.
+                await asyncio.sleep(0.2)
+            dispatcher.release(session)
+
+        def report(label: str):
+            stats = dispatcher.getStats()
+            print(label)
+            for id, fork in sorted(stats["forks"].items()):
+                latency = fork["latency"]
+                print(
+                    "  %-8s sessions %2d  latency %s"
+                    % (id, fork["sessions"], "%.0fms" % (latency * 1000) if latency else "-")
+                )
+
+        join(FakeFork("fast", 0.01))
+        join(FakeFork("slow", 0.04))
+        cameras = [asyncio.ensure_future(camera(i, 60)) for i in range(12)]
+        await asyncio.sleep(3)
+        report("fast and slow workers:")
+        join(FakeFork("joined", 0.02))
+        await asyncio.sleep(3)
+        report("after a worker joined:")
+        leave("fast")
+        await asyncio.sleep(3)
+        report("after a worker left:")
+        await asyncio.gather(*cameras)
+        print("migrations", dispatcher.migrations)
+        for fork in forks.values():
+            print("  %-8s frames %d" % (fork.id, fork.frames))
+
+    asyncio.run(simulate())
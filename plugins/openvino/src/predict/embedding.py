@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import base64
+from typing import Any, Tuple
+
+import numpy as np
+
+# Base64: base64 float32 string, the ObjectDetectionResult default.
+# Buffer: raw float32 bytes, sent as rpc sideband data rather than json.
+# Float16, Int8: quantized raw bytes. int8 embeddings are prefixed with
+# their float32 scale.
+EMBEDDING_FORMATS = ["Base64", "Buffer", "Float16", "Int8"]
+DEFAULT_EMBEDDING_FORMAT = "Base64"
+
+
+def encode_embedding(embedding: np.ndarray, format: str = None) -> Tuple[Any, str]:
+    """
+    Returns the encoded embedding and the embeddingFormat that describes it,
+    which is None for float32 (base64 strings and raw buffers are told apart
+    by their type).
+    """
+    embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    if format == "Buffer":
+        return embedding.tobytes(), None
+    if format == "Float16":
+        return embedding.astype(np.float16).tobytes(), "float16"
+    if format == "Int8":
+        # symmetric, per vector scale.
+        scale = np.float32(np.abs(embedding).max() / 127 or 1)
+        quantized = np.clip(np.round(embedding / scale), -127, 127).astype(np.int8)
+        return scale.tobytes() + quantized.tobytes(), "int8"
+    return base64.b64encode(embedding.tobytes()).decode("utf-8"), None
+
+
+def decode_embedding(embedding: Any, format: str = None) -> np.ndarray:
+    # base64 strings, raw buffers in any embeddingFormat, and lists are accepted.
+    if isinstance(embedding, str):
+        embedding = base64.b64decode(embedding)
+    if not isinstance(embedding, (bytes, bytearray, memoryview)):
+        return np.asarray(embedding, dtype=np.float32).reshape(-1)
+    if format == "float16":
+        return np.frombuffer(embedding, dtype=np.float16).astype(np.float32)
+    if format == "int8":
+        scale = np.frombuffer(embedding, dtype=np.float32, count=1)[0]
+        return np.frombuffer(embedding, dtype=np.int8, offset=4).astype(np.float32) * scale
+    return np.frombuffer(embedding, dtype=np.float32)
+
+
+if __name__ == "__main__":
+    # size, speed and quantization error of each format: python -m predict.embedding
+    import time
+
+    rng = np.random.default_rng(0)
+    # face and clip embeddings are both 512 dimensional.
+    embeddings = rng.normal(size=(1000, 512)).astype(np.float32)
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    for format in EMBEDDING_FORMATS:
+        start = time.perf_counter()
+        encoded = [encode_embedding(e, format) for e in embeddings]
+        encode_time = (time.perf_counter() - start) / len(embeddings)
+        start = time.perf_counter()
+        decoded = np.stack([decode_embedding(e, f) for e, f in encoded])
+        decode_time = (time.perf_counter() - start) / len(embeddings)
+
+        error = decoded - embeddings
+        relative = np.linalg.norm(error, axis=1) / np.linalg.norm(embeddings, axis=1)
+        cosine = (decoded / np.linalg.norm(decoded, axis=1, keepdims=True) * normalized).sum(axis=1)
+        # how much the similarity between two different embeddings moves,
+        # which is what matching compares against a threshold.
+        similarity = (normalized[:-1] * normalized[1:]).sum(axis=1)
+        decoded_normalized = decoded / np.linalg.norm(decoded, axis=1, keepdims=True)
+        decoded_similarity = (decoded_normalized[:-1] * decoded_normalized[1:]).sum(axis=1)
+        print(
+            "%-8s %5d bytes  encode %5.1fus  decode %5.1fus  max abs error %.2e  relative l2 %.2e  min cosine %.6f  similarity drift %.2e"
+            % (
+                format,
+                len(encoded[0][0]),
+                encode_time * 1e6,
+                decode_time * 1e6,
+                np.abs(error).max(),
+                relative.max(),
+                cosine.min(),
+                np.abs(decoded_similarity - similarity).max(),
+            )
+        )
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import base64
+import json
+import os
+import threading
+from typing import Any, List, Mapping, Tuple
+
+import numpy as np
+
+from predict.embedding import decode_embedding
+
+# product quantization splits the embedding into this many subvectors,
+# each stored as the index of its nearest of 256 centroids.
+PQ_SUBVECTORS = 16
+PQ_CENTROIDS = 256
+PQ_ITERATIONS = 20
+# below this, quantizing saves little and the codebooks would be
+# trained on fewer vectors than they have centroids.
+PQ_MIN_VECTORS = 1024
+# quantized search candidates that are rescored exactly.
+PQ_RERANK = 32
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # returns the top k scores and indices of each row, best first.
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    top = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def kmeans(x: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    x_norms = (x**2).sum(axis=1)
+    for _ in range(iterations):
+        distances = x_norms[:, None] - 2 * x @ centroids.T + (centroids**2).sum(axis=1)[None, :]
+        assignments = distances.argmin(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        counts = np.bincount(assignments, minlength=k)
+        # empty clusters keep their previous centroid.
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class ProductQuantizer:
+    """
+    Compresses normalized embeddings to PQ_SUBVECTORS bytes each. The cosine
+    similarity of a query to every code is the sum of the query subvectors'
+    dot products with the coded centroids, which are computed once per query
+    into a small table (asymmetric distance computation).
+    """
+
+    def __init__(self, embeddings: np.ndarray, subvectors: int = PQ_SUBVECTORS, seed: int = 0):
+        dim = embeddings.shape[1]
+        if dim % subvectors:
+            raise Exception(f"embedding dimension {dim} is not divisible by {subvectors}")
+        self.subvectors = subvectors
+        self.subdim = dim // subvectors
+        rng = np.random.default_rng(seed)
+        split = self.split(embeddings)
+        self.codebooks = np.stack(
+            [kmeans(split[:, s], PQ_CENTROIDS, PQ_ITERATIONS, rng) for s in range(subvectors)]
+        )
+
+    def split(self, embeddings: np.ndarray) -> np.ndarray:
+        # (n, dim) to (n, subvectors, subdim)
+        return embeddings.reshape(len(embeddings), self.subvectors, self.subdim)
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        split = self.split(embeddings)
+        codes = np.empty((len(embeddings), self.subvectors), dtype=np.uint8)
+        for s in range(self.subvectors):
+            codebook = self.codebooks[s]
+            distances = -2 * split[:, s] @ codebook.T + (codebook**2).sum(axis=1)[None, :]
+            codes[:, s] = distances.argmin(axis=1)
+        return codes
+
+    def get_norms(self, codes: np.ndarray) -> np.ndarray:
+        # centroids are averages, so reconstructed embeddings are shorter
+        # than the unit embeddings they encode.
+        squared = (self.codebooks**2).sum(axis=2)
+        norms = np.zeros(len(codes), dtype=np.float32)
+        for s in range(self.subvectors):
+            norms += squared[s, codes[:, s]]
+        return np.sqrt(np.maximum(norms, 1e-12))
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        # (q, subvectors, centroids) table of subvector dot products.
+        table = np.einsum("qsd,scd->qsc", self.split(queries), self.codebooks)
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for s in range(self.subvectors):
+            scores += table[:, s, codes[:, s]]
+        # the cosine similarity to the reconstructed embeddings.
+        return scores / norms[None, :]
+
+
+class FaceGallery:
+    """
+    Known identities and their face embeddings, so faces are labeled in the
+    plugin. The embeddings are normalized and kept as a single float32
+    matrix, so matching every face of a frame against the gallery is one
+    matrix product followed by a top k selection.
+
+    Large galleries can be product quantized: only the codes are searched
+    in memory, and the best candidates are rescored exactly against the
+    embeddings, which stay memory mapped on disk.
+
+    The gallery is a directory with the embeddings matrix and an index of
+    the labels. Forks reload it when the index changes.
+    """
+
+    def __init__(self, path: str, quantize: bool = False):
+        self.path = path
+        self.index_path = os.path.join(path, "gallery.json")
+        self.quantize = quantize
+        self.lock = threading.Lock()
+        self.mtime: float = None
+        self.labels: np.ndarray = np.zeros((0,), dtype=str)
+        self.embeddings: np.ndarray = None
+        self.quantizer: ProductQuantizer = None
+        self.codes: np.ndarray = None
+        self.norms: np.ndarray = None
+        os.makedirs(path, exist_ok=True)
+        self.reload()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def read_index(self) -> Any:
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def load_embeddings(self, index: Any, mmap: bool = False) -> Tuple[List[str], np.ndarray]:
+        if not index:
+            return [], None
+        embeddings = np.load(
+            os.path.join(self.path, index["embeddings"]), mmap_mode="r" if mmap else None
+        )
+        return index["labels"], embeddings
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            self.mtime = mtime
+            self.set(*self.load_embeddings(self.read_index(), self.quantize))
+
+    def set(self, labels: List[str], embeddings: np.ndarray):
+        self.labels = np.array(labels, dtype=str)
+        self.embeddings = embeddings
+        self.quantizer = None
+        self.codes = None
+        self.norms = None
+        if self.quantize and embeddings is not None and len(embeddings) >= PQ_MIN_VECTORS:
+            self.quantizer = ProductQuantizer(np.asarray(embeddings))
+            self.codes = self.quantizer.encode(np.asarray(embeddings))
+            self.norms = self.quantizer.get_norms(self.codes)
+
+    def save(self, labels: List[str], embeddings: np.ndarray):
+        # the embeddings are written to a new file before the index points
+        # to it, so other processes never read a partial gallery.
+        index = self.read_index()
+        version = index["version"] + 1 if index else 1
+        name = "embeddings-%s.npy" % version
+        np.save(os.path.join(self.path, name), embeddings)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": version, "labels": list(labels), "embeddings": name}, f)
+        os.replace(tmp, self.index_path)
+        for file in os.listdir(self.path):
+            if file.startswith("embeddings-") and file != name:
+                os.remove(os.path.join(self.path, file))
+        self.mtime = os.path.getmtime(self.index_path)
+        self.set(*self.load_embeddings(self.read_index(), self.quantize))
+
+    def add(self, label: str, embeddings: List[Any], format: str = None):
+        vectors = normalize(np.stack([decode_embedding(e, format) for e in embeddings]))
+        with self.lock:
+            labels, existing = self.load_embeddings(self.read_index())
+            if existing is not None:
+                if existing.shape[1] != vectors.shape[1]:
+                    raise Exception(
+                        f"embedding dimension {vectors.shape[1]} does not match the gallery's {existing.shape[1]}"
+                    )
+                vectors = np.concatenate([existing, vectors])
+            self.save(labels + [label] * (len(vectors) - len(labels)), vectors)
+
+    def remove(self, label: str):
+        with self.lock:
+            labels, embeddings = self.load_embeddings(self.read_index())
+            if embeddings is None:
+                return
+            keep = [i for i, l in enumerate(labels) if l != label]
+            self.save([labels[i] for i in keep], embeddings[keep])
+
+    def getIdentities(self) -> Mapping[str, int]:
+        labels, counts = np.unique(self.labels, return_counts=True)
+        return {str(label): int(count) for label, count in zip(labels, counts)}
+
+    def search(self, queries: np.ndarray, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cosine similarity top k of each query embedding. Returns the (q, k)
+        scores and gallery indices, best first.
+        """
+        queries = normalize(np.atleast_2d(queries))
+        if self.codes is None:
+            return top_k(queries @ self.embeddings.T, k)
+
+        _, candidates = top_k(self.quantizer.scores(queries, self.codes, self.norms), max(k, PQ_RERANK))
+        # only the candidates' rows of the mapped embeddings are read.
+        vectors = np.asarray(self.embeddings[candidates.reshape(-1)]).reshape(
+            candidates.shape + (-1,)
+        )
+        scores, order = top_k(np.einsum("qd,qcd->qc", queries, vectors), k)
+        return scores, np.take_along_axis(candidates, order, axis=1)
+
+    def match(self, queries: np.ndarray, threshold: float) -> List[Tuple[str, float]]:
+        # the best identity of each query, or None if none is similar enough.
+        if not len(self.labels) or not len(queries):
+            return [None] * len(queries)
+        scores, indices = self.search(queries, 1)
+        return [
+            (str(self.labels[i[0]]), float(s[0])) if s[0] >= threshold else None
+            for s, i in zip(scores, indices)
+        ]
+
+
+if __name__ == "__main__":
+    # synthetic identities: python -m predict.face_gallery
+    # compares the gallery against a per embedding cosine_similarity loop,
+    # and the product quantized search against the exact search.
+    import tempfile
+    import time
+
+    def cosine_similarity(vector_a, vector_b):
+        return np.dot(vector_a, vector_b) / (np.linalg.norm(vector_a) * np.linalg.norm(vector_b))
+
+    rng = np.random.default_rng(0)
+    dim = 512
+
+    def get_identities(count: int, samples: int):
+        centers = normalize(rng.normal(size=(count, dim)))
+        embeddings = centers[:, None] + rng.normal(0, 0.03, (count, samples, dim))
+        return centers, embeddings.astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as root:
+        for identities in [100, 1000, 5000]:
+            centers, embeddings = get_identities(identities, 4)
+            path = os.path.join(root, "gallery-%s" % identities)
+            gallery = FaceGallery(path)
+            labels = ["person-%s" % i for i in range(identities) for _ in range(4)]
+            gallery.save(labels, normalize(embeddings.reshape(-1, dim)))
+
+            queries = (centers[:16] + rng.normal(0, 0.03, (16, dim))).astype(np.float32)
+            start = time.perf_counter()
+            expected = []
+            for q in queries:
+                similarities = [cosine_similarity(q, e) for e in embeddings.reshape(-1, dim)]
+                best = int(np.argmax(similarities))
+                expected.append((labels[best], similarities[best]))
+            loop_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            matches = gallery.match(queries, 0.5)
+            exact_time = time.perf_counter() - start
+            for (label, score), (expected_label, expected_score) in zip(matches, expected):
+                assert label == expected_label and abs(score - expected_score) < 1e-4
+
+            quantized = FaceGallery(path, quantize=True)
+            start = time.perf_counter()
+            quantized_matches = quantized.match(queries, 0.5)
+            quantized_time = time.perf_counter() - start
+            recall = np.mean([bool(q) and q[0] == m[0] for q, m in zip(quantized_matches, matches)])
+            if quantized.codes is not None:
+                memory = quantized.codes.nbytes + quantized.norms.nbytes
+            else:
+                memory = gallery.embeddings.nbytes
+            print(
+                "%5d identities, 16 faces: loop %7.1fms  matrix %5.2fms  pq %5.2fms (recall %.2f, %dKB vs %dKB)"
+                % (
+                    identities,
+                    loop_time * 1000,
+                    exact_time * 1000,
+                    quantized_time * 1000,
+                    recall,
+                    memory // 1024,
+                    gallery.embeddings.nbytes // 1024,
+                )
+            )
+
+        # unknown faces do not match, enrollment persists and removal.
+        gallery = FaceGallery(os.path.join(root, "enroll"))
+        centers, embeddings = get_identities(3, 2)
+        gallery.add("alice", [base64.b64encode(e.tobytes()).decode() for e in embeddings[0]])
+        gallery.add("bob", list(embeddings[1]))
+        stranger = normalize(rng.normal(size=(1, dim)))
+        print("matches:", gallery.match(np.stack([embeddings[0][0], embeddings[1][1], stranger[0]]), 0.5))
+        reloaded = FaceGallery(gallery.path)
+        reloaded.remove("alice")
+        gallery.reload()
+        print("identities after removal:", gallery.getIdentities())
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import os
+import statistics
+import sys
+import time
+from collections import deque
+from typing import Deque, List
+
+# the health of the detector is sampled at this interval.
+HEALTH_CHECK_INTERVAL = 60
+# memory and latency baselines are taken once the models are loaded and warm.
+HEALTH_WARMUP = 10 * 60
+# consecutive checks a degraded latency must persist before a restart.
+LATENCY_DEGRADED_CHECKS = 5
+# a check's latency is the median of the inferences that ran alone since the
+# previous check, if there were at least this many.
+LATENCY_MIN_SAMPLES = 8
+# the healthy latency is the median of the latencies of this many previous
+# healthy checks. degraded checks are left out so they don't become the norm.
+LATENCY_HISTORY = 60
+LATENCY_BASELINE_CHECKS = 3
+# latency increases under this are noise rather than degradation.
+LATENCY_DEGRADED_MIN = 0.05
+MAX_CONSECUTIVE_TIMEOUTS = 3
+# detection is considered idle when nothing has run for this long.
+IDLE_PERIOD = 5
+# a restart waits this long for an idle moment before draining anyway.
+IDLE_WAIT = 10 * 60
+DRAIN_TIMEOUT = 30
+
+try:
+    # plugin host module, absent on servers that predate it.
+    from plugin_gc import get_rss
+except ImportError:
+
+    def get_rss() -> int:
+        try:
+            with open("/proc/self/statm", "rb") as f:
+                pages = int(f.read().split()[1])
+            return pages * os.sysconf("SC_PAGE_SIZE")
+        except Exception:
+            pass
+
+        # not linux, fall back to peak rss, which is good enough to detect growth.
+        try:
+            import resource
+
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == "darwin":
+                return maxrss
+            return maxrss * 1024
+        except Exception:
+            return None
+
+
+class HealthMonitor:
+    """
+    Decides when the detector should restart, replacing the unconditional
+    periodic restart. A restart is needed when memory has grown well past its
+    warm baseline (a leak in the inference runtime), when the model's inference
+    time has degraded well past its recent median and stays degraded, or when
+    detections time out repeatedly (a hung device).
+
+    The monitor also tracks detections in flight so restarts can wait for an
+    idle moment and drain the remaining detections before exiting.
+    """
+
+    def __init__(self, memory_growth: float = 1, latency_growth: float = 4):
+        self.memory_growth = memory_growth
+        self.latency_growth = latency_growth
+        self.started = time.monotonic()
+        self.rss_baseline: int = None
+        self.rss: int = None
+        self.latency_baseline: float = None
+        self.latency: float = None
+        self.latency_samples: List[float] = []
+        self.latency_history: Deque[float] = deque(maxlen=LATENCY_HISTORY)
+        self.latency_degraded = 0
+        self.inferences = 0
+        self.inference_starts = 0
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.inflight = 0
+        self.last_active = 0
+        self.draining = False
+        self.restart_reasons: List[str] = None
+
+    def inference_start(self):
+        # only the latency of inferences that run alone, one frame at a time,
+        # is measured, so it does not grow with load or batching.
+        self.inferences += 1
+        self.inference_starts += 1
+        token = self.inference_starts if self.inferences == 1 else None
+        return token, time.monotonic()
+
+    def inference_done(self, started, success: bool = True):
+        self.inferences -= 1
+        token, start = started
+        # another inference started in the meantime.
+        if success and token is not None and token == self.inference_starts:
+            self.latency_samples.append(time.monotonic() - start)
+
+    def reset_memory_baseline(self):
+        # models loaded on demand grow memory legitimately, so the baseline
+        # is taken again.
+        self.rss_baseline = None
+
+    def start(self):
+        self.inflight += 1
+        self.last_active = time.monotonic()
+
+    def done(self):
+        self.inflight -= 1
+        self.last_active = time.monotonic()
+
+    def is_idle(self) -> bool:
+        return not self.inflight and time.monotonic() - self.last_active > IDLE_PERIOD
+
+    def timeout(self) -> bool:
+        self.timeouts += 1
+        self.consecutive_timeouts += 1
+        return self.consecutive_timeouts >= MAX_CONSECUTIVE_TIMEOUTS
+
+    def success(self):
+        self.consecutive_timeouts = 0
+
+    def check(self, rss: int = None) -> List[str]:
+        # returns the reasons a restart is needed, if any.
+        reasons: List[str] = []
+        warm = time.monotonic() - self.started >= HEALTH_WARMUP
+
+        self.rss = rss
+        if rss and warm:
+            if self.rss_baseline is None:
+                self.rss_baseline = rss
+            elif self.memory_growth and rss > self.rss_baseline * (1 + self.memory_growth):
+                reasons.append(
+                    "memory grew from %sMB to %sMB"
+                    % (self.rss_baseline // (1024 * 1024), rss // (1024 * 1024))
+                )
+
+        samples = self.latency_samples
+        self.latency_samples = []
+        if len(samples) < LATENCY_MIN_SAMPLES or not warm:
+            return reasons
+        latency = self.latency = statistics.median(samples)
+        if len(self.latency_history) < LATENCY_BASELINE_CHECKS:
+            self.latency_history.append(latency)
+            self.latency_baseline = statistics.median(self.latency_history)
+            return reasons
+
+        if (
+            self.latency_growth
+            and latency > self.latency_baseline * self.latency_growth
+            and latency - self.latency_baseline > LATENCY_DEGRADED_MIN
+        ):
+            self.latency_degraded += 1
+        else:
+            self.latency_degraded = 0
+            self.latency_history.append(latency)
+            self.latency_baseline = statistics.median(self.latency_history)
+        if self.latency_degraded >= LATENCY_DEGRADED_CHECKS:
+            reasons.append(
+                "inference latency degraded from %sms to %sms"
+                % (int(self.latency_baseline * 1000), int(latency * 1000))
+            )
+
+        return reasons
+
+    def getStats(self):
+        return {
+            "uptime": time.monotonic() - self.started,
+            "rss": self.rss,
+            "rssBaseline": self.rss_baseline,
+            "latency": self.latency,
+            "latencyBaseline": self.latency_baseline,
+            "timeouts": self.timeouts,
+            "consecutiveTimeouts": self.consecutive_timeouts,
+            "inflight": self.inflight,
+            "draining": self.draining,
+            "restartReasons": self.restart_reasons,
+        }
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Mapping, Tuple
+
+import numpy as np
+
+from common.nms import box_iou
+
+# the thumbnail used as an appearance signature of untracked detections.
+SIGNATURE_SIZE = 8
+
+
+def get_detection_box(detection: Any) -> Tuple[float, float, float, float]:
+    x, y, w, h = detection["boundingBox"]
+    return x, y, x + w, y + h
+
+
+class RecognitionEntry:
+    def __init__(self, box, value: Mapping[str, Any], signature: np.ndarray, now: float):
+        self.box = box
+        self.value = value
+        self.signature = signature
+        self.created = now
+
+
+class RecognitionCache:
+    """
+    LRU cache of second stage results (face embeddings, text labels) so an
+    object that stays in view isn't recognized again every frame.
+
+    Tracked detections are keyed by their track id. Untracked detections are
+    matched spatially, to an entry of the same source with an overlapping box
+    and, when signatures are provided, a similar appearance signature (a tiny
+    grayscale thumbnail). In both
+    cases, the result is only reused while the box still overlaps the box it
+    was computed for and the entry is younger than the ttl, so objects that
+    move, or change, are recognized again.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        capacity: int = 512,
+        iou_threshold: float = 0.7,
+        signature_threshold: float = 12,
+    ):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.iou_threshold = iou_threshold
+        self.signature_threshold = signature_threshold
+        self.entries: OrderedDict[Any, RecognitionEntry] = OrderedDict()
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_candidates(self, source: str, detection: Any):
+        id = detection.get("id")
+        if id:
+            key = (source, id)
+            entry = self.entries.get(key)
+            return [(key, entry)] if entry else []
+        return [
+            (key, entry)
+            for key, entry in self.entries.items()
+            if key[0] == source and key[1] is None
+        ]
+
+    def is_match(self, entry: RecognitionEntry, iou: float, signature: np.ndarray, now: float) -> bool:
+        # the age is not checked when replacing an entry.
+        if now is not None and now - entry.created > self.ttl:
+            return False
+        if iou < self.iou_threshold:
+            return False
+        if signature is not None and entry.signature is not None:
+            if np.abs(signature - entry.signature).mean() > self.signature_threshold:
+                return False
+        return True
+
+    def find(self, source: str, detection: Any, signature: np.ndarray, now: float):
+        candidates = self.get_candidates(source, detection)
+        if not candidates:
+            return None
+        box = get_detection_box(detection)
+        ious = box_iou([box], [entry.box for _, entry in candidates])[0]
+        best = None
+        best_iou = 0
+        for (key, entry), iou in zip(candidates, ious):
+            if iou > best_iou and self.is_match(entry, iou, signature, now):
+                best = key
+                best_iou = iou
+        return best
+
+    def lookup(self, source: str, detection: Any, signature: np.ndarray = None) -> Mapping[str, Any]:
+        now = time.monotonic()
+        key = self.find(source, detection, signature, now)
+        if key is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key].value
+
+    def peek(self, source: str, detection: Any) -> Mapping[str, Any]:
+        # the last result of a tracked object, regardless of its age or box.
+        id = detection.get("id")
+        entry = id and self.entries.get((source, id))
+        return entry.value if entry else None
+
+    def store(self, source: str, detection: Any, value: Mapping[str, Any], signature: np.ndarray = None):
+        now = time.monotonic()
+        id = detection.get("id")
+        if id:
+            key = (source, id)
+        else:
+            # replace the stale result of the same untracked object.
+            key = self.find(source, detection, signature, None)
+            if key is None:
+                key = (source, None, self.next_key)
+                self.next_key += 1
+        self.entries.pop(key, None)
+        self.entries[key] = RecognitionEntry(get_detection_box(detection), value, signature, now)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def getStats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -15,6 +15,8 @@ import traceback
 customDetectPrepare, customDetectPredict = async_infer.create_executors("Segment")
 
 class Segmentation(PredictPlugin):
+    lazy_models = True
+
     def __init__(self, plugin, nativeId: str):
         super().__init__(plugin=plugin, nativeId=nativeId)
 
@@ -27,8 +29,11 @@ class Segmentation(PredictPlugin):
             2: "animal",
         }
 
+        self.model = None
+
+    def load_models(self):
         try:
-            self.model = self.loadModel('scrypted_yolov9t_seg_relu')
+            return {"model": self.loadModel('scrypted_yolov9t_seg_relu')}
         except:
             traceback.print_exc()
             raise
@@ -68,13 +73,13 @@ class Segmentation(PredictPlugin):
             segments = yolov9_seg.masks2segments_numpy(masks)
             # Create Prediction instances
             for i in range(len(det)):
-                # Convert all contours for this detection to list of [x, y] tuples
+                # Keep the contours for this detection as (n, 2) arrays, they are
+                # mapped to the source image and converted to lists in create_detection_result
                 mask_contours = segments[i]
                 clip_paths = []
                 for contour in mask_contours:
                     if len(contour) > 0 and contour.shape[1] == 2:
-                        single_path = [(float(contour[j, 0]), float(contour[j, 1])) for j in range(len(contour))]
-                        clip_paths.append(single_path)
+                        clip_paths.append(contour.astype(np.float32))
 
                 prediction = Prediction(
                     id=int(det[i, 5]),  # class_id
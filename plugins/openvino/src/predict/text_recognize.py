@@ -3,7 +3,6 @@ from __future__ import annotations
 import asyncio
 import concurrent.futures
 import traceback
-from asyncio import Future
 from typing import Any, List, Tuple
 
 import numpy as np
@@ -11,7 +10,10 @@ import scrypted_sdk
 from PIL import Image
 from scrypted_sdk import ObjectDetectionResult, ObjectDetectionSession, ObjectsDetected
 
-from common.text import prepare_text_result, process_text_result
+from common.colors import to_thread
+from common.text import (TEXT_WIDTH, crop_texts, deskew_text_image, get_text_width,
+                         pad_text_images, prepare_text_result, process_text_result,
+                         process_text_results)
 from predict import Prediction, PredictPlugin
 from predict.craft_utils import normalizeMeanVariance
 from predict.rectangle import Rectangle
@@ -21,8 +23,13 @@ from .craft_utils import adjustResultCoordinates, getDetBoxes
 
 predictExecutor = concurrent.futures.ThreadPoolExecutor(1, "TextDetect")
 
+# lines beyond this are recognized in multiple inferences.
+MAX_TEXT_BATCH = 16
+
 
 class TextRecognition(PredictPlugin):
+    lazy_models = True
+
     def __init__(self, plugin: PredictPlugin, nativeId: str):
         super().__init__(plugin=plugin, nativeId=nativeId)
 
@@ -35,8 +42,14 @@ class TextRecognition(PredictPlugin):
         self.loop = asyncio.get_event_loop()
         self.minThreshold = 0.1
 
-        self.detectModel = self.downloadModel("craft")
-        self.textModel = self.downloadModel("vgg_english_g2")
+        self.detectModel = None
+        self.textModel = None
+
+    def load_models(self):
+        return {
+            "detectModel": self.downloadModel("craft"),
+            "textModel": self.downloadModel("vgg_english_g2"),
+        }
 
     def downloadModel(self, model: str):
         pass
@@ -47,6 +60,19 @@ class TextRecognition(PredictPlugin):
     async def predictTextModel(self, input: np.ndarray):
         pass
 
+    async def predictTextBatch(self, input: np.ndarray) -> np.ndarray:
+        # returns the (n, steps, classes) predictions. runtimes without a
+        # batched text model recognize the lines one at a time.
+        outputs = await asyncio.gather(
+            *[self.predictTextModel(input[i : i + 1]) for i in range(len(input))]
+        )
+        return np.concatenate(outputs)
+
+    def get_text_width_buckets(self) -> List[int]:
+        # the widths a line may be padded to, the model's input width
+        # unless it is dynamic.
+        return [TEXT_WIDTH]
+
     async def detect_once(
         self, input: Image.Image, settings: Any, src_size, cvss
     ) -> scrypted_sdk.ObjectsDetected:
@@ -113,15 +139,15 @@ class TextRecognition(PredictPlugin):
 
         return self.create_detection_result(preds, src_size, cvss)
 
-    async def run_detection_image(
+    async def run_detection_image_models(
         self, image: scrypted_sdk.Image, detection_session: ObjectDetectionSession
     ) -> ObjectsDetected:
-        ret = await super().run_detection_image(image, detection_session)
+        # the embeddings and labels need the models too, so this runs
+        # while they are held loaded.
+        ret = await super().run_detection_image_models(image, detection_session)
 
         detections = ret["detections"]
 
-        futures: List[Future] = []
-
         boundingBoxes, scores = [d["boundingBox"] for d in detections], [d["score"] for d in detections]
         if not len(boundingBoxes):
             return ret
@@ -129,6 +155,7 @@ class TextRecognition(PredictPlugin):
         text_groups = find_adjacent_groups(boundingBoxes, scores)
 
         detections = []
+        groups = {}
         for group in text_groups:
             boundingBox = group["union"]
             score = group["score"]
@@ -137,21 +164,61 @@ class TextRecognition(PredictPlugin):
                 "score": score,
                 "className": "text",
             }
-            futures.append(
-                asyncio.ensure_future(self.setLabel(d, image, group["skew_angle"], group['deskew_height']))
-            )
+            groups[id(d)] = group
             detections.append(d)
 
         ret["detections"] = detections
 
-        if len(futures):
-            await asyncio.wait(futures)
+        async def setLabels(pending: List[ObjectDetectionResult]):
+            await self.setLabels(
+                pending,
+                image,
+                [groups[id(d)]["skew_angle"] for d in pending],
+                [groups[id(d)]["deskew_height"] for d in pending],
+            )
+
+        await self.recognize_cached(image, detection_session, detections, ["label"], setLabels)
 
         # filter empty labels
         ret["detections"] = [d for d in detections if d.get("label")]
 
         return ret
 
+    async def setLabels(
+        self,
+        detections: List[ObjectDetectionResult],
+        image: scrypted_sdk.Image,
+        skew_angles: List[float],
+        deskew_heights: List[float],
+    ):
+        if not detections:
+            return
+        try:
+            textImages = await crop_texts(detections, image)
+            textImages = await to_thread(
+                lambda: [
+                    deskew_text_image(textImage, d, skew_angle, deskew_height)
+                    for textImage, d, skew_angle, deskew_height in zip(
+                        textImages, detections, skew_angles, deskew_heights
+                    )
+                ]
+            )
+            # lines of similar widths are batched together, so each batch is
+            # padded to the narrowest width that fits it.
+            order = sorted(range(len(textImages)), key=lambda i: textImages[i].width)
+            buckets = self.get_text_width_buckets()
+            for start in range(0, len(order), MAX_TEXT_BATCH):
+                batch = order[start : start + MAX_TEXT_BATCH]
+                batchImages = [textImages[i] for i in batch]
+                width = get_text_width(batchImages, buckets)
+                input = pad_text_images(batchImages, width)
+                preds = await self.predictTextBatch(input)
+                for i, label in zip(batch, process_text_results(preds)):
+                    detections[i]["label"] = label
+        except Exception as e:
+            traceback.print_exc()
+            pass
+
     async def setLabel(
         self, d: ObjectDetectionResult, image: scrypted_sdk.Image, skew_angle: float, deskew_height: float
     ):
@@ -173,3 +240,105 @@ class TextRecognition(PredictPlugin):
 
     def get_input_format(self) -> str:
         return "rgb"
+
+
+if __name__ == "__main__":
+    # per line vs batched recognition: python -m predict.text_recognize
+    # the image host and the text model are simulated: crops cost an rpc round
+    # trip, and an inference has a fixed overhead plus a cost per padded column.
+    import time
+
+    from common.text import TEXT_WIDTH_BUCKETS, character
+
+    RPC_LATENCY = 0.002
+    INFERENCE_OVERHEAD = 0.003
+    INFERENCE_PER_COLUMN = 0.000005
+    modelExecutor = concurrent.futures.ThreadPoolExecutor(1, "TextModel")
+
+    class SimulatedImage:
+        format = "rgb"
+
+        def __init__(self, frame: Image.Image):
+            self.frame = frame
+            self.width = frame.width
+            self.height = frame.height
+            self.requests = 0
+
+        async def toBuffer(self, options):
+            self.requests += 1
+            await asyncio.sleep(RPC_LATENCY)
+            crop = options["crop"]
+            l, t = crop["left"], crop["top"]
+            return self.frame.crop((l, t, l + crop["width"], t + crop["height"])).tobytes()
+
+    class SimulatedTextRecognition(TextRecognition):
+        def __init__(self, batched: bool):
+            self.batched = batched
+            self.inferences = 0
+
+        def infer(self, input: np.ndarray):
+            self.inferences += 1
+            time.sleep(INFERENCE_OVERHEAD + INFERENCE_PER_COLUMN * input.shape[0] * input.shape[3])
+            # a class per 4 columns, from the column brightness.
+            columns = input.mean(axis=(1, 2)).reshape(len(input), -1, 4).mean(axis=2)
+            classes = ((columns + 1) * 20).astype(int) % len(character)
+            return np.eye(len(character), dtype=np.float32)[classes]
+
+        async def predictTextModel(self, input: np.ndarray):
+            return await asyncio.get_event_loop().run_in_executor(
+                modelExecutor, lambda: self.infer(input)
+            )
+
+        async def predictTextBatch(self, input: np.ndarray):
+            if not self.batched:
+                return await super().predictTextBatch(input)
+            return await self.predictTextModel(input)
+
+        def get_text_width_buckets(self):
+            return TEXT_WIDTH_BUCKETS if self.batched else super().get_text_width_buckets()
+
+    async def benchmark():
+        rng = np.random.default_rng(0)
+        frame = Image.fromarray(rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8))
+
+        def get_lines(count: int, spread: bool):
+            # lines of a sign or plate are close together, unlike lines
+            # spread across the frame.
+            lines = []
+            x, y = rng.uniform(0, 1400), rng.uniform(0, 600)
+            for i in range(count):
+                w, h = rng.uniform(40, 400), rng.uniform(14, 40)
+                if spread:
+                    l = rng.uniform(0, 1920 - w)
+                    t = rng.uniform(0, 1080 - h)
+                else:
+                    l, t = x + rng.uniform(0, 100), y + i * 12
+                lines.append({"className": "text", "score": 1, "boundingBox": (l, t, w, h)})
+            return lines
+
+        for count, spread in [(1, False), (4, False), (16, False), (32, False), (16, True), (32, True)]:
+            results = []
+            lines = get_lines(count, spread)
+            skew_angles = [0.0] * count
+            deskew_heights = [int(d["boundingBox"][3]) for d in lines]
+            for batched in [False, True]:
+                image = SimulatedImage(frame)
+                model = SimulatedTextRecognition(batched)
+                iterations = 5
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    if batched:
+                        await model.setLabels(lines, image, skew_angles, deskew_heights)
+                    else:
+                        await asyncio.gather(
+                            *[model.setLabel(d, image, 0.0, h) for d, h in zip(lines, deskew_heights)]
+                        )
+                elapsed = (time.perf_counter() - start) / iterations
+                results.append((elapsed, image.requests // iterations, model.inferences // iterations))
+            (single, sr, si), (batch, br, bi) = results
+            print(
+                "%2d %s lines: per line %6.1fms (%2d crops, %2d inferences)  batched %6.1fms (%d crops, %d inferences)  %.1fx"
+                % (count, "spread" if spread else "nearby", single * 1000, sr, si, batch * 1000, br, bi, single / batch)
+            )
+
+    asyncio.run(benchmark())
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from typing import Tuple
+
+import numpy as np
+
+
+class SourceTransform:
+    """
+    Maps points in model input coordinates back to the source image:
+    source = (point - offset) / scale + origin
+
+    scale is the resize from the source (or crop) to the model input, offset
+    is where the resized image was placed in the model input (padding), and
+    origin is the top left of the crop within the source image.
+
+    Instances are callable with a single point, like the convert_to_src_size
+    functions they replace, and apply maps an (n, 2) array of points at once.
+    """
+
+    def __init__(
+        self,
+        scale: Tuple[float, float] = (1, 1),
+        offset: Tuple[float, float] = (0, 0),
+        origin: Tuple[float, float] = (0, 0),
+    ):
+        self.sx, self.sy = float(scale[0]), float(scale[1])
+        self.ox, self.oy = float(offset[0]), float(offset[1])
+        self.cx, self.cy = float(origin[0]), float(origin[1])
+        self.scale = np.array(scale, dtype=np.float64)
+        self.offset = np.array(offset, dtype=np.float64)
+        self.origin = np.array(origin, dtype=np.float64)
+
+    def __call__(self, point):
+        return (
+            (point[0] - self.ox) / self.sx + self.cx,
+            (point[1] - self.oy) / self.sy + self.cy,
+        )
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return (points - self.offset) / self.scale + self.origin
+
+    def apply_boxes(self, boxes: np.ndarray) -> np.ndarray:
+        # (n, 4) xmin, ymin, xmax, ymax
+        return self.apply(boxes).reshape(-1, 4)
+
+
+if __name__ == "__main__":
+    # clip path mapping benchmark: python -m predict.transform
+    # compares per point convert_to_src_size calls with a single transform.
+    import time
+
+    from predict import Prediction, PredictPlugin
+    from predict.rectangle import Rectangle
+    # the class PredictPlugin checks for, not this __main__ copy.
+    from predict.transform import SourceTransform
+
+    class Plugin:
+        labels = {}
+        create_detection_result = PredictPlugin.create_detection_result
+        convert_detection_result = PredictPlugin.convert_detection_result
+
+    plugin = Plugin()
+    xs = 320 / 1920
+    ys = 320 / 1080
+    transform = SourceTransform((xs, ys))
+
+    # the previous run_detection_image conversion function.
+    def cvss(point):
+        return point[0] / xs, point[1] / ys
+
+    rng = np.random.default_rng(0)
+    for masks in [10, 50, 200]:
+        objs = []
+        for _ in range(masks):
+            x, y = rng.uniform(0, 280, 2)
+            paths = [rng.uniform(0, 40, (100, 2)) + (x, y) for _ in range(2)]
+            objs.append(Prediction(0, 0.5, Rectangle(x, y, x + 40, y + 40), clipPaths=paths))
+
+        def benchmark(name, convert, iterations=20):
+            plugin.create_detection_result(objs, (1920, 1080), convert)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                ret = plugin.create_detection_result(objs, (1920, 1080), convert)
+            print("%-28s %8.3f ms" % (name, (time.perf_counter() - start) / iterations * 1000))
+            return ret
+
+        print("%s masks, %s points" % (masks, masks * 200))
+        a = benchmark("per point", cvss)
+        b = benchmark("single transform", transform)
+        for da, db in zip(a["detections"], b["detections"]):
+            assert np.allclose(da["boundingBox"], db["boundingBox"])
+            for pa, pb in zip(da["clipPaths"], db["clipPaths"]):
+                assert np.allclose(pa, pb)
@@ -249,6 +249,12 @@ class TextRecognition(TextRecognition):
 
         return self.create_detection_result(predictions, src_size, cvss)
 
+    async def setLabels(
+        self, detections: List[ObjectDetectionResult], image: scrypted_sdk.Image, skew_angles: List[float], deskew_heights: List[float]
+    ):
+        # the rknn recognition model has its own preprocessing and is run per line.
+        await asyncio.gather(*[self.setLabel(d, image, skew_angle) for d, skew_angle in zip(detections, skew_angles)])
+
     async def setLabel(
         self, d: ObjectDetectionResult, image: scrypted_sdk.Image, skew_angle: float
     ):
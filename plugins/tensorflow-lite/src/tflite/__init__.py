@@ -28,6 +28,7 @@ from .yolo_separate_outputs import *
 from scrypted_sdk.types import Setting, SettingValue
 
 from common import yolo
+from common.preprocess import TensorWriter
 from predict import PredictPlugin
 
 prepareExecutor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="TFLite-Prepare")
@@ -132,6 +133,10 @@ class TensorFlowLitePlugin(
         self.interpreters = {}
         available_interpreters = []
         self.interpreter_count = 0
+        self.max_batch_size = 1
+        # cpu interpreters resized to each batch size, by thread and size.
+        self.batch_interpreters = {}
+        self.input_writer: TensorWriter = None
 
         def downloadModel():
             tflite_model = "best_full_integer_quant" if self.scrypted_model else model
@@ -178,6 +183,12 @@ class TensorFlowLitePlugin(
             self.input_details = int(width), int(height), int(channels)
             available_interpreters.append(interpreter)
             self.interpreter_count = self.interpreter_count + 1
+            # cpu models with a dynamic batch dimension can be resized to run
+            # frames from multiple cameras in a single inference.
+            shape_signature = self.image_input_details.get("shape_signature", None)
+            if self.yolo and shape_signature is not None and shape_signature[0] == -1:
+                self.max_batch_size = 16
+                self.model_file = modelFile
 
         print(modelFile, labelsFile)
 
@@ -215,7 +226,7 @@ class TensorFlowLitePlugin(
                 "choices": availableModels,
                 "value": model,
             },
-        ]
+        ] + self.getPipelineSettings()
 
     # width, height, channels
     def get_input_details(self) -> Tuple[int, int, int]:
@@ -224,102 +235,153 @@ class TensorFlowLitePlugin(
     def get_input_size(self) -> Tuple[int, int]:
         return self.input_details[0:2]
 
-    async def detect_once(self, input: Image.Image, settings: Any, src_size, cvss):
-        def prepare():
-            if not self.yolo:
-                return input
+    def get_max_batch_size(self) -> int:
+        return self.max_batch_size
 
-            im = np.stack([input])
-            # this non-quantized code path is unused but here for reference.
-            if self.image_input_details["dtype"] != np.int8 and self.image_input_details["dtype"] != np.int16:
-                im = im.astype(np.float32) / 255.0
-                return im
-
-            scale, zero_point = self.image_input_details["quantization"]
-            if scale == 0.003986024297773838 and zero_point == -128:
-                # fast path for quantization 1/255 = 0.003986024297773838
-                im = im.view(np.int8)
-                im -= 128
-            else:
-                im = im.astype(np.float32) / (255.0 * scale)
-                im = (im + zero_point).astype(np.int8)  # de-scale
-
-            return im
-
-        def predict(im):
-            interpreter = self.interpreters[threading.current_thread().name]
-            if not self.yolo:
-                tflite_common.set_input(interpreter, im)
-                interpreter.invoke()
-                objs = detect.get_objects(
-                    interpreter, score_threshold=0.2, image_scale=(1, 1)
-                )
-                return objs
+    def get_batch_concurrency(self) -> int:
+        return self.interpreter_count
 
-            tensor_index = input_details(interpreter, "index")
-            interpreter.set_tensor(tensor_index, im)
+    def predict(self, im):
+        interpreter = self.interpreters[threading.current_thread().name]
+        if not self.yolo:
+            tflite_common.set_input(interpreter, im)
             interpreter.invoke()
-            output_details = interpreter.get_output_details()
-            output_tensors = [(interpreter.get_tensor(output["index"]), output) for output in output_details]
+            objs = detect.get_objects(
+                interpreter, score_threshold=0.2, image_scale=(1, 1)
+            )
+            return objs
 
+        tensor_index = input_details(interpreter, "index")
+        if input_details(interpreter, "shape")[0] != im.shape[0]:
+            interpreter = self.get_batch_interpreter(im.shape)
+        interpreter.set_tensor(tensor_index, im)
+        interpreter.invoke()
+        output_details = interpreter.get_output_details()
+        output_tensors = [(interpreter.get_tensor(output["index"]), output) for output in output_details]
+
+        return output_tensors
+
+    def get_batch_interpreter(self, shape):
+        # resizing and reallocating an interpreter is far more expensive than
+        # an inference, so each batch size gets its own interpreter.
+        key = (threading.current_thread().name, shape[0])
+        interpreter = self.batch_interpreters.get(key)
+        if not interpreter:
+            interpreter = tflite.Interpreter(model_path=self.model_file)
+            interpreter.resize_tensor_input(input_details(interpreter, "index"), shape)
+            interpreter.allocate_tensors()
+            self.batch_interpreters[key] = interpreter
+        return interpreter
+
+    def get_padded_batch_size(self, count: int) -> int:
+        # batches are padded to a power of two, so at most a handful of
+        # batch interpreters are ever created.
+        size = 1
+        while size < count:
+            size *= 2
+        return min(size, self.max_batch_size)
+
+    def post_process(self, output_tensors):
+        if not self.yolo:
             return output_tensors
 
-        def post_process(output_tensors):
-            if not self.yolo:
-                return output_tensors
-
-            # handle separate outputs for quantization accuracy
-            if self.scrypted_yolo_sep:
-                outputs = []
-                for ot, output in output_tensors:
-                    o = ot.astype(np.float32)
-                    scale, zero_point = output["quantization"]
-                    o -= zero_point
-                    o *= scale
-                    outputs.append(o)
-
-                output = yolo_separate_outputs.decode_bbox(outputs, [input.width, input.height])
-                if self.scrypted_yolov10:
-                    objs = yolo.parse_yolov10(output[0])
-                else:
-                    objs = yolo.parse_yolov9(output[0])
-                return objs
-
-            # this scale stuff can probably be optimized to dequantize ahead of time...
-            x, output = output_tensors[0]
-            input_scale = self.get_input_details()[0]
+        # handle separate outputs for quantization accuracy
+        if self.scrypted_yolo_sep:
+            outputs = []
+            for ot, output in output_tensors:
+                o = ot.astype(np.float32)
+                scale, zero_point = output["quantization"]
+                o -= zero_point
+                o *= scale
+                outputs.append(o)
+
+            output = yolo_separate_outputs.decode_bbox(outputs, self.get_input_size())
+            if self.scrypted_yolov10:
+                objs = yolo.parse_yolov10(output[0])
+            else:
+                objs = yolo.parse_yolov9(output[0])
+            return objs
 
-            # this non-quantized code path is unused but here for reference.
-            if x.dtype != np.int8 and x.dtype != np.int16:
-                if self.scrypted_yolov10:
-                    objs = yolo.parse_yolov10(x[0], scale=lambda v: v * input_scale)
-                else:
-                    objs = yolo.parse_yolov9(x[0], scale=lambda v: v * input_scale)
-                return objs
-
-            # this scale stuff can probably be optimized to dequantize ahead of time...
-            scale, zero_point = output["quantization"]
-            combined_scale = scale * input_scale
+        # this scale stuff can probably be optimized to dequantize ahead of time...
+        x, output = output_tensors[0]
+        input_scale = self.get_input_details()[0]
+
+        # this non-quantized code path is unused but here for reference.
+        if x.dtype != np.int8 and x.dtype != np.int16:
             if self.scrypted_yolov10:
-                objs = yolo.parse_yolov10(
-                    x[0],
-                    scale=lambda v: (v - zero_point) * combined_scale,
-                    confidence_scale=lambda v: (v - zero_point) * scale,
-                    threshold_scale=lambda v: (v - zero_point) * scale,
-                )
+                objs = yolo.parse_yolov10(x[0], scale=lambda v: v * input_scale)
             else:
-                objs = yolo.parse_yolov9(
-                    x[0],
-                    scale=lambda v: (v - zero_point) * combined_scale,
-                    confidence_scale=lambda v: (v - zero_point) * scale,
-                    threshold_scale=lambda v: (v - zero_point) * scale,
-                )
+                objs = yolo.parse_yolov9(x[0], scale=lambda v: v * input_scale)
             return objs
 
+        # this scale stuff can probably be optimized to dequantize ahead of time...
+        scale, zero_point = output["quantization"]
+        combined_scale = scale * input_scale
+        if self.scrypted_yolov10:
+            objs = yolo.parse_yolov10(
+                x[0],
+                scale=lambda v: (v - zero_point) * combined_scale,
+                confidence_scale=lambda v: (v - zero_point) * scale,
+                threshold_scale=lambda v: (v - zero_point) * scale,
+            )
+        else:
+            objs = yolo.parse_yolov9(
+                x[0],
+                scale=lambda v: (v - zero_point) * combined_scale,
+                confidence_scale=lambda v: (v - zero_point) * scale,
+                threshold_scale=lambda v: (v - zero_point) * scale,
+            )
+        return objs
 
-        im = await asyncio.get_event_loop().run_in_executor(prepareExecutor, prepare)
-        output_tensors = await asyncio.get_event_loop().run_in_executor(self.executor, lambda: predict(im))
-        objs = await asyncio.get_event_loop().run_in_executor(prepareExecutor, lambda: post_process(output_tensors))
+    async def detect_batch(self, inputs: list[np.ndarray]) -> list[Any]:
+        size = self.get_padded_batch_size(len(inputs))
+        if size == len(inputs):
+            im = np.concatenate(inputs)
+        else:
+            im = np.zeros((size,) + inputs[0].shape[1:], dtype=inputs[0].dtype)
+            np.concatenate(inputs, out=im[: len(inputs)])
+        output_tensors = await asyncio.get_event_loop().run_in_executor(self.executor, lambda: self.predict(im))
+
+        def post_process_batch():
+            # split the batched outputs back into per frame outputs.
+            return [
+                self.post_process([(ot[i : i + 1], output) for ot, output in output_tensors])
+                for i in range(len(inputs))
+            ]
+
+        return await asyncio.get_event_loop().run_in_executor(prepareExecutor, post_process_batch)
+
+    def get_input_writer(self) -> TensorWriter:
+        if not self.input_writer:
+            dtype = self.image_input_details["dtype"]
+            # this non-quantized code path is unused but here for reference.
+            if dtype != np.int8 and dtype != np.int16:
+                self.input_writer = TensorWriter(self.get_input_size(), "nhwc", np.float32)
+            else:
+                self.input_writer = TensorWriter(
+                    self.get_input_size(),
+                    "nhwc",
+                    np.int8,
+                    self.image_input_details["quantization"],
+                )
+        return self.input_writer
+
+    async def detect_once(self, input: Image.Image, settings: Any, src_size, cvss):
+        if not self.yolo:
+            output_tensors = await asyncio.get_event_loop().run_in_executor(self.executor, lambda: self.predict(input))
+            objs = self.post_process(output_tensors)
+            return self.create_detection_result(objs, src_size, cvss)
+
+        input_writer = self.get_input_writer()
+        im = await asyncio.get_event_loop().run_in_executor(prepareExecutor, lambda: input_writer.prepare(input))
+        try:
+            if self.get_batch_size() > 1:
+                objs = await self.queue_batch(im)
+            else:
+                output_tensors = await asyncio.get_event_loop().run_in_executor(self.executor, lambda: self.predict(im))
+                objs = await asyncio.get_event_loop().run_in_executor(prepareExecutor, lambda: self.post_process(output_tensors))
+        finally:
+            input_writer.release(im)
 
         ret = self.create_detection_result(objs, src_size, cvss)
         return ret
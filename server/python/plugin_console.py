@@ -1,4 +1,14 @@
+import asyncio
+import os
+import threading
+import time
 import typing
+from asyncio.events import AbstractEventLoop
+from asyncio.streams import StreamWriter
+
+DEFAULT_FLUSH_INTERVAL = 0.25
+DEFAULT_FLUSH_BYTES = 64 * 1024
+DEFAULT_MAX_LINES_PER_SECOND = 100
 
 
 async def writeWorkerGenerator(gen, out: typing.TextIO):
@@ -7,3 +17,128 @@ async def writeWorkerGenerator(gen, out: typing.TextIO):
             out.buffer.write(item)
     except Exception as e:
         pass
+
+
+class BufferedConsoleWriter:
+    """
+    Batches console output for a single nativeId and writes it to the
+    console socket once per flush interval (or sooner if the buffer is full).
+    Output beyond the line rate limit is dropped and summarized, so a chatty
+    plugin can never stall the event loop or the thread that is logging.
+    write may be called from any thread.
+    """
+
+    def __init__(
+        self,
+        loop: AbstractEventLoop,
+        connect: typing.Callable[[], typing.Awaitable[StreamWriter]],
+        flushInterval: float = None,
+        flushBytes: int = None,
+        maxLinesPerSecond: int = None,
+    ):
+        self.loop = loop
+        self.connect = connect
+        self.flushInterval = flushInterval or float(
+            os.getenv("SCRYPTED_CONSOLE_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+        )
+        self.flushBytes = flushBytes or int(
+            os.getenv("SCRYPTED_CONSOLE_FLUSH_BYTES", DEFAULT_FLUSH_BYTES)
+        )
+        self.maxLinesPerSecond = maxLinesPerSecond or int(
+            os.getenv("SCRYPTED_CONSOLE_MAX_LINES_PER_SECOND", DEFAULT_MAX_LINES_PER_SECOND)
+        )
+        self.lock = threading.Lock()
+        self.pending: typing.List[str] = []
+        self.pendingBytes = 0
+        self.flushScheduled = False
+        self.writer: asyncio.Future[StreamWriter] = None
+        self.windowStart = time.monotonic()
+        self.windowLines = 0
+        self.windowDropped = 0
+        self.writtenLines = 0
+        self.droppedLines = 0
+
+    def write(self, s: str):
+        lines = s.count("\n") or 1
+        with self.lock:
+            now = time.monotonic()
+            if now - self.windowStart >= 1:
+                self.rollWindow(now)
+            if self.windowLines + lines > self.maxLinesPerSecond:
+                self.windowDropped += lines
+                self.droppedLines += lines
+                if self.flushScheduled:
+                    return
+                # make sure the drop summary goes out when the window closes.
+                delay = max(self.flushInterval, self.windowStart + 1 - now)
+                self.flushScheduled = True
+                self.loop.call_soon_threadsafe(self.scheduleFlush, delay)
+                return
+            self.windowLines += lines
+            self.writtenLines += lines
+            self.pending.append(s)
+            self.pendingBytes += len(s)
+            if self.flushScheduled:
+                if self.pendingBytes < self.flushBytes:
+                    return
+                delay = 0
+            else:
+                delay = self.flushInterval
+            self.flushScheduled = True
+            self.loop.call_soon_threadsafe(self.scheduleFlush, delay)
+
+    def rollWindow(self, now: float):
+        # must be called with the lock held.
+        if self.windowDropped:
+            summary = f"[console] {self.windowDropped} lines dropped (rate limited to {self.maxLinesPerSecond}/s)\n"
+            self.pending.append(summary)
+            self.pendingBytes += len(summary)
+        self.windowStart = now
+        self.windowLines = 0
+        self.windowDropped = 0
+
+    def scheduleFlush(self, delay: float):
+        if delay:
+            self.loop.call_later(delay, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.windowDropped and now - self.windowStart >= 1:
+                self.rollWindow(now)
+            pending = self.pending
+            self.pending = []
+            self.pendingBytes = 0
+            self.flushScheduled = bool(self.windowDropped)
+            if self.flushScheduled:
+                # drops are still being counted, summarize them when the window closes.
+                self.loop.call_later(self.windowStart + 1 - now, self.flush)
+        if not pending:
+            return
+        asyncio.ensure_future(self.writePending("".join(pending)), loop=self.loop)
+
+    async def writePending(self, data: str):
+        if not self.writer:
+            self.writer = asyncio.ensure_future(self.connect(), loop=self.loop)
+        connecting = self.writer
+        try:
+            writer = await connecting
+            writer.write(data.encode("utf8"))
+        except Exception:
+            # reconnect on the next flush rather than awaiting the failed
+            # connection forever. this output is lost, and can't be logged
+            # without writing back into this console.
+            if self.writer is connecting:
+                self.writer = None
+            with self.lock:
+                self.droppedLines += data.count("\n") or 1
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "writtenLines": self.writtenLines,
+                "droppedLines": self.droppedLines,
+                "pendingBytes": self.pendingBytes,
+            }
@@ -0,0 +1,190 @@
+import gc
+import os
+import sys
+import time
+from asyncio.events import AbstractEventLoop
+from typing import List, Optional
+
+# the previous behavior was an unconditional full collection every 10 seconds.
+# memory is now sampled at that interval instead, and a full collection is
+# only run once the process has grown past the threshold since the last one.
+# the max interval is a backstop for cycles that never show up as rss growth.
+DEFAULT_CHECK_INTERVAL = 10
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_GROWTH_BYTES = 32 * 1024 * 1024
+RECENT_PAUSES = 64
+
+
+def parse_thresholds(value: str) -> Optional[List[int]]:
+    if not value:
+        return None
+    try:
+        thresholds = [int(t) for t in value.split(",") if t.strip()]
+    except ValueError:
+        print("invalid SCRYPTED_GC_THRESHOLDS: %s" % value)
+        return None
+    if not thresholds or len(thresholds) > 3:
+        print("invalid SCRYPTED_GC_THRESHOLDS: %s" % value)
+        return None
+    return thresholds
+
+
+def get_rss() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+
+    # not linux, fall back to peak rss, which is good enough to detect growth.
+    try:
+        import resource
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return maxrss
+        return maxrss * 1024
+    except Exception:
+        return None
+
+
+class GCPauseStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.collected = 0
+        self.recent: List[float] = []
+
+    def add(self, duration: float, collected: int):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.collected += collected
+        self.recent.append(duration)
+        if len(self.recent) > RECENT_PAUSES:
+            self.recent.pop(0)
+
+    def toJSON(self):
+        recent = sorted(self.recent)
+        p99 = recent[min(len(recent) - 1, int(len(recent) * 0.99))] if recent else 0
+        return {
+            "count": self.count,
+            "collected": self.collected,
+            "totalMs": self.total * 1000,
+            "averageMs": (self.total / self.count * 1000) if self.count else 0,
+            "maxMs": self.max * 1000,
+            "recentP99Ms": p99 * 1000,
+        }
+
+
+class GCManager:
+    def __init__(
+        self,
+        loop: AbstractEventLoop,
+        checkInterval: float = None,
+        maxInterval: float = None,
+        growthBytes: int = None,
+        thresholds: List[int] = None,
+    ):
+        self.loop = loop
+        self.checkInterval = checkInterval or float(
+            os.getenv("SCRYPTED_GC_CHECK_INTERVAL", DEFAULT_CHECK_INTERVAL)
+        )
+        self.maxInterval = maxInterval or float(
+            os.getenv("SCRYPTED_GC_MAX_INTERVAL", DEFAULT_MAX_INTERVAL)
+        )
+        self.growthBytes = growthBytes or int(
+            os.getenv("SCRYPTED_GC_GROWTH_BYTES", DEFAULT_GROWTH_BYTES)
+        )
+        thresholds = thresholds or parse_thresholds(
+            os.getenv("SCRYPTED_GC_THRESHOLDS", None)
+        )
+        if thresholds:
+            gc.set_threshold(*thresholds)
+
+        self.frozen = False
+        self.fullCollections = 0
+        self.lastFullCollection = time.monotonic()
+        self.baselineRss = get_rss()
+        self.pauses = [GCPauseStats() for _ in range(3)]
+        self.pauseStart = None
+
+    def start(self):
+        gc.callbacks.append(self.onGC)
+        self.schedule()
+
+    def stop(self):
+        try:
+            gc.callbacks.remove(self.onGC)
+        except ValueError:
+            pass
+
+    def onGC(self, phase: str, info: dict):
+        if phase == "start":
+            self.pauseStart = time.perf_counter()
+            return
+        if self.pauseStart is None:
+            return
+        duration = time.perf_counter() - self.pauseStart
+        self.pauseStart = None
+        self.pauses[info.get("generation", 2)].add(duration, info.get("collected", 0))
+
+    def schedule(self):
+        self.loop.call_later(self.checkInterval, self.check)
+
+    def check(self):
+        try:
+            rss = get_rss()
+            now = time.monotonic()
+            grown = (
+                rss is not None
+                and self.baselineRss is not None
+                and rss - self.baselineRss >= self.growthBytes
+            )
+            if grown or now - self.lastFullCollection >= self.maxInterval:
+                self.collect()
+        finally:
+            self.schedule()
+
+    def collect(self):
+        gc.collect()
+        self.fullCollections += 1
+        self.lastFullCollection = time.monotonic()
+        self.baselineRss = get_rss()
+
+    def freeze(self):
+        # called once the plugin has finished loading. everything allocated
+        # during startup (modules, models, device instances) is long lived
+        # and is moved to the permanent generation so full collections
+        # no longer need to traverse it.
+        if self.frozen:
+            return
+        self.frozen = True
+        gc.collect()
+        gc.freeze()
+        self.baselineRss = get_rss()
+
+    def getStats(self):
+        return {
+            "thresholds": list(gc.get_threshold()),
+            "counts": list(gc.get_count()),
+            "frozen": gc.get_freeze_count(),
+            "rss": get_rss(),
+            "baselineRss": self.baselineRss,
+            "growthBytes": self.growthBytes,
+            "fullCollections": self.fullCollections,
+            "secondsSinceFullCollection": time.monotonic() - self.lastFullCollection,
+            "generations": [p.toJSON() for p in self.pauses],
+        }
+
+
+gc_manager: GCManager = None
+
+
+def start_gc_manager(loop: AbstractEventLoop) -> GCManager:
+    global gc_manager
+    gc_manager = GCManager(loop)
+    gc_manager.start()
+    return gc_manager
@@ -1,8 +1,18 @@
+import hashlib
+import json
 import os
+import re
+import shutil
 import subprocess
 import sys
-from typing import Any
-import shutil
+import sysconfig
+import tempfile
+import urllib.parse
+import urllib.request
+import zipfile
+from typing import Any, Dict, List, Set, Tuple
+
+import plugin_volume as pv
 
 
 def get_requirements_files(requirements: str):
@@ -11,21 +21,247 @@ def get_requirements_files(requirements: str):
     return want_requirements, installed_requirementstxt
 
 
-def need_requirements(requirements_basename: str, requirements_str: str):
+def read_installed_requirements(requirements_basename: str) -> str:
     _, installed_requirementstxt = get_requirements_files(requirements_basename)
-    if not os.path.exists(installed_requirementstxt):
-        return True
     try:
         f = open(installed_requirementstxt, "rb")
         installed_requirements = f.read().decode("utf8")
-        return requirements_str != installed_requirements
+        f.close()
+        return installed_requirements
     except:
+        return None
+
+
+def need_requirements(requirements_basename: str, requirements_str: str):
+    installed_requirements = read_installed_requirements(requirements_basename)
+    if installed_requirements is None:
         return True
+    return requirements_str != installed_requirements
+
+
+def normalize_package_name(name: str):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parse_requirements(requirements_str: str) -> Tuple[List[str], Dict[str, str]]:
+    # returns the pip options (--extra-index-url, etc) and the requirements
+    # keyed by normalized package name and environment marker, since the
+    # same package may be listed multiple times for different platforms.
+    # returns None if the requirements can not be diffed, ie, url requirements.
+    options: List[str] = []
+    packages: Dict[str, str] = {}
+    for line in requirements_str.splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+        if not line:
+            continue
+        if line.startswith("-"):
+            options.append(line)
+            continue
+        match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*)", line)
+        if not match or "://" in line:
+            return None
+        name = normalize_package_name(match.group(1))
+        marker = line.split(";", 1)[1].strip() if ";" in line else ""
+        packages[f"{name};{marker}"] = line
+    return options, packages
+
+
+def diff_requirements(
+    old: Dict[str, str], new: Dict[str, str]
+) -> Tuple[List[str], Set[str]]:
+    # a package may be listed once per environment marker, and only pip
+    # knows which of those lines apply. so if any line of a package changes
+    # or goes away, the package is removed and every one of its new lines
+    # is installed again, letting pip pick the one for this platform.
+    remove: Set[str] = set()
+    for key, line in old.items():
+        if new.get(key) != line:
+            remove.add(key.split(";")[0])
+    install: List[str] = []
+    for key, line in new.items():
+        if old.get(key) != line or key.split(";")[0] in remove:
+            install.append(line)
+    return install, remove
+
+
+def get_dist_infos(directory: str) -> Dict[str, str]:
+    dist_infos: Dict[str, str] = {}
+    try:
+        for de in os.listdir(directory):
+            if de.endswith(".dist-info"):
+                name = de[: -len(".dist-info")].split("-")[0]
+                dist_infos[normalize_package_name(name)] = de
+    except FileNotFoundError:
+        pass
+    return dist_infos
+
+
+def remove_package(python_prefix: str, name: str):
+    dist_info = get_dist_infos(python_prefix).get(normalize_package_name(name))
+    if not dist_info:
+        return
+    print("Removing package: %s" % dist_info)
+    root = os.path.realpath(python_prefix)
+    dirs: Set[str] = set()
+    try:
+        with open(os.path.join(python_prefix, dist_info, "RECORD"), "r") as f:
+            for line in f.read().splitlines():
+                path = line.split(",")[0]
+                if not path:
+                    continue
+                path = os.path.realpath(os.path.join(python_prefix, path))
+                # RECORD may reference scripts outside of the target.
+                if not path.startswith(root + os.sep):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                dirs.add(os.path.dirname(path))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(os.path.join(python_prefix, dist_info), ignore_errors=True)
+    # remove any directories left empty, deepest first.
+    for d in sorted(dirs, key=len, reverse=True):
+        while d.startswith(root + os.sep):
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+
+
+def clone_tree(src: str, dst: str):
+    # hardlink copy. pip replaces files rather than writing into them,
+    # so the source is not modified by an install into the clone.
+    for root, _, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for file in files:
+            try:
+                os.link(os.path.join(root, file), os.path.join(dst_root, file))
+            except OSError:
+                shutil.copy2(os.path.join(root, file), os.path.join(dst_root, file))
+
+
+def can_update_incrementally(
+    python_prefix: str, requirements: List[Tuple[str, str, bool]]
+):
+    if not os.path.exists(python_prefix):
+        return False
+    found_installed = False
+    for requirements_str, requirements_basename, _ in requirements:
+        installed_requirements = read_installed_requirements(requirements_basename)
+        if installed_requirements is None:
+            continue
+        found_installed = True
+        old = parse_requirements(installed_requirements)
+        new = parse_requirements(requirements_str)
+        if not old or not new or old[0] != new[0]:
+            return False
+    return found_installed
+
+
+def update_with_pip(
+    python_prefix: str,
+    packageJson: Any,
+    requirements_str: str,
+    requirements_basename: str,
+    ignore_error: bool = False,
+):
+    installed_requirements = read_installed_requirements(requirements_basename) or ""
+    if installed_requirements == requirements_str:
+        return True
+
+    _, old = parse_requirements(installed_requirements)
+    _, new = parse_requirements(requirements_str)
+    install, remove = diff_requirements(old, new)
+
+    print(f"{os.path.basename(requirements_basename)}.txt (updating)")
+    for name in remove:
+        remove_package(python_prefix, name)
+
+    if install:
+        options, _ = parse_requirements(requirements_str)
+        update_str = "\n".join(options + install)
+        if not install_with_pip(
+            python_prefix,
+            packageJson,
+            update_str,
+            requirements_basename + ".update",
+            ignore_error=ignore_error,
+            upgrade=True,
+        ):
+            return False
+
+    requirementstxt, installed_requirementstxt = get_requirements_files(
+        requirements_basename
+    )
+    for filename in [requirementstxt, installed_requirementstxt]:
+        f = open(filename, "wb")
+        f.write(requirements_str.encode())
+        f.close()
+    return True
+
+
+def install_requirements(
+    plugin_volume: str,
+    python_prefix: str,
+    packageJson: Any,
+    requirements: List[Tuple[str, str, bool]],
+):
+    # requirements is a list of (requirements_str, requirements_basename, ignore_error).
+    # dependencies are installed into a staging directory that replaces the
+    # existing one only after every install succeeds. if the previous
+    # requirements are known, only the packages that changed are updated.
+    remove_pip_dirs(plugin_volume, exclude=python_prefix)
+
+    staging = python_prefix + ".staging"
+    shutil.rmtree(staging, ignore_errors=True)
+    incremental = can_update_incrementally(python_prefix, requirements)
+    if incremental:
+        clone_tree(python_prefix, staging)
+    os.makedirs(staging, exist_ok=True)
+
+    try:
+        for requirements_str, requirements_basename, ignore_error in requirements:
+            staging_basename = os.path.join(
+                staging, os.path.basename(requirements_basename)
+            )
+            if incremental:
+                update_with_pip(
+                    staging,
+                    packageJson,
+                    requirements_str,
+                    staging_basename,
+                    ignore_error=ignore_error,
+                )
+            else:
+                install_with_pip(
+                    staging,
+                    packageJson,
+                    requirements_str,
+                    staging_basename,
+                    ignore_error=ignore_error,
+                )
+    except:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    old = python_prefix + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(python_prefix):
+        os.rename(python_prefix, old)
+    os.rename(staging, python_prefix)
+    shutil.rmtree(old, ignore_errors=True)
 
 
-def remove_pip_dirs(plugin_volume: str):
+def remove_pip_dirs(plugin_volume: str, exclude: str = None):
     try:
         for de in os.listdir(plugin_volume):
+            filePath = os.path.join(plugin_volume, de)
+            if exclude and os.path.abspath(filePath) == os.path.abspath(exclude):
+                continue
             if (
                 de.startswith("linux")
                 or de.startswith("darwin")
@@ -33,7 +269,6 @@ def remove_pip_dirs(plugin_volume: str):
                 or de.startswith("python")
                 or de.startswith("node")
             ):
-                filePath = os.path.join(plugin_volume, de)
                 print("Removing old dependencies: %s" % filePath)
                 try:
                     shutil.rmtree(filePath)
@@ -50,6 +285,7 @@ def install_with_pip(
     requirements_basename: str,
     ignore_error: bool = False,
     site_packages: str = None,
+    upgrade: bool = False,
 ):
     requirementstxt, installed_requirementstxt = get_requirements_files(
         requirements_basename
@@ -79,6 +315,9 @@ def install_with_pip(
         "--target",
         python_prefix,
     ]
+    if upgrade:
+        # replace existing packages in the target directory.
+        pipArgs.append("--upgrade")
     if pythonVersion:
         print("Specific Python version requested. Forcing reinstall.")
         # prevent uninstalling system packages.
@@ -93,6 +332,34 @@ def install_with_pip(
         PYTHONPATH += ":" + site_packages
         env["PYTHONPATH"] = PYTHONPATH
         print("PYTHONPATH", env["PYTHONPATH"])
+
+    installed = False
+    # the store can't honor the ignore/force reinstall of a specific python version.
+    if requirements_str and not pythonVersion and get_pip_store():
+        try:
+            installed = install_with_store(
+                python_prefix, requirementstxt, requirements_str, env
+            )
+        except Exception as e:
+            print("pip store install failed, falling back to pip install: %s" % e)
+
+    if not installed:
+        result = run_pip(pipArgs, env)
+        print("pip install result %s" % result)
+        if result:
+            if not ignore_error:
+                raise Exception("non-zero result from pip %s" % result)
+            else:
+                print("ignoring non-zero result from pip %s" % result)
+                return False
+
+    f = open(installed_requirementstxt, "wb")
+    f.write(requirements_str.encode())
+    f.close()
+    return True
+
+
+def run_pip(pipArgs: List[str], env: dict = None):
     p = subprocess.Popen(
         pipArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env
     )
@@ -106,14 +373,276 @@ def install_with_pip(
         except UnicodeDecodeError:
             line = line.decode("latin-1").rstrip("\r\n")  # Fallback to Latin
         print(line)
-    result = p.wait()
-    print("pip install result %s" % result)
-    if result:
-        if not ignore_error:
-            raise Exception("non-zero result from pip %s" % result)
+    return p.wait()
+
+
+# The pip store is shared by all plugins in the scrypted volume:
+#   wheels/           downloaded or built wheels, used as a local package index.
+#   packages/<sha>/   wheels unpacked by content hash.
+#   locks/<tag>/      resolved wheel sets per python and platform, keyed by
+#                     the requirements hash.
+# A plugin's pip target is assembled by hardlinking unpacked packages, so
+# numpy, opencv, etc. are only downloaded and unpacked once per volume, and
+# reinstalling a previously resolved requirements.txt does not run pip at all.
+# The store is opt in: set SCRYPTED_PIP_STORE to 1 for the default location,
+# or to a directory. Unpacking a wheel does not generate console script entry
+# points or rewrite the INSTALLER and RECORD metadata as pip install does.
+def get_pip_store():
+    store = os.environ.get("SCRYPTED_PIP_STORE", None)
+    if not store or store in ["0", "false"]:
+        return None
+    if store in ["1", "true"]:
+        return os.path.join(pv.get_scrypted_volume(), "pip-store")
+    return store
+
+
+def get_find_links(store: str):
+    find_links = [os.path.join(store, "wheels")]
+    # a local wheelhouse can be provided to seed the store, or to
+    # install without network access.
+    wheelhouse = os.environ.get("SCRYPTED_PIP_WHEELHOUSE", None)
+    if wheelhouse:
+        find_links.append(wheelhouse)
+    return find_links
+
+
+def hash_file(filename: str):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_url_to_path(url: str) -> str:
+    # pip reports percent-encoded file urls, ie, spaces are %20.
+    return urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+
+
+def resolve_local_wheels(
+    store: str, requirementstxt: str, env: dict = None
+) -> List[str]:
+    # resolve the requirements using only the wheels in the store.
+    # this fails if any requirement is not available locally.
+    with tempfile.TemporaryDirectory(dir=store) as tmp:
+        report = os.path.join(tmp, "report.json")
+        pipArgs = [
+            sys.executable,
+            "-m",
+            "pip",
+            "install",
+            "--dry-run",
+            "--quiet",
+            "--ignore-installed",
+            "--no-index",
+            "--only-binary",
+            ":all:",
+            "--report",
+            report,
+            "-r",
+            requirementstxt,
+        ]
+        for find_links in get_find_links(store):
+            pipArgs.extend(["--find-links", find_links])
+        p = subprocess.run(
+            pipArgs, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env
+        )
+        if p.returncode:
+            return None
+        with open(report, "r") as f:
+            report = json.load(f)
+
+    wheels = []
+    for item in report["install"]:
+        url: str = item["download_info"]["url"]
+        if not url.startswith("file://"):
+            return None
+        wheels.append(file_url_to_path(url))
+    return wheels
+
+
+def populate_wheels(store: str, requirementstxt: str, env: dict = None):
+    wheels_dir = os.path.join(store, "wheels")
+    # build into a private directory and move the results into the store
+    # so concurrent installs never see partially written wheels.
+    with tempfile.TemporaryDirectory(dir=store) as tmp:
+        pipArgs = [
+            sys.executable,
+            "-m",
+            "pip",
+            "wheel",
+            "-r",
+            requirementstxt,
+            "--wheel-dir",
+            tmp,
+        ]
+        for find_links in get_find_links(store):
+            pipArgs.extend(["--find-links", find_links])
+        result = run_pip(pipArgs, env)
+        if result:
+            raise Exception("non-zero result from pip wheel %s" % result)
+        for de in os.listdir(tmp):
+            os.replace(os.path.join(tmp, de), os.path.join(wheels_dir, de))
+
+
+def unpack_wheel(store: str, wheel: str):
+    package_dir = os.path.join(store, "packages", hash_file(wheel))
+    if os.path.exists(package_dir):
+        return package_dir
+
+    tmp = tempfile.mkdtemp(dir=os.path.join(store, "packages"))
+    try:
+        with zipfile.ZipFile(wheel) as z:
+            for info in z.infolist():
+                name = info.filename
+                # mirror pip install --target: purelib/platlib are merged into the
+                # root, scripts go into bin, headers and data are not installed.
+                parts = name.split("/")
+                if parts[0].endswith(".data") and len(parts) > 2:
+                    if parts[1] in ["purelib", "platlib"]:
+                        name = "/".join(parts[2:])
+                    elif parts[1] == "scripts":
+                        name = "/".join(["bin"] + parts[2:])
+                    else:
+                        continue
+                if name.endswith("/"):
+                    continue
+                path = os.path.join(tmp, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with z.open(info) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(path, mode)
+        try:
+            os.rename(tmp, package_dir)
+        except OSError:
+            # another plugin unpacked the same wheel concurrently.
+            if not os.path.exists(package_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return package_dir
+
+
+def link_package(package_dir: str, python_prefix: str):
+    for root, _, files in os.walk(package_dir):
+        target_root = os.path.join(python_prefix, os.path.relpath(root, package_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            src = os.path.join(root, file)
+            dst = os.path.join(target_root, file)
+            try:
+                os.remove(dst)
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(src, dst)
+            except OSError:
+                # cross device or unsupported filesystem
+                shutil.copy2(src, dst)
+
+
+def get_lock_tag():
+    # wheels are resolved for the interpreter and platform, not the target
+    # directory, which is a staging directory shared by every plugin.
+    tag = "%s-%s" % (sys.implementation.cache_tag, sysconfig.get_platform())
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", tag)
+
+
+def install_with_store(
+    python_prefix: str, requirementstxt: str, requirements_str: str, env: dict = None
+):
+    store = get_pip_store()
+    for d in ["wheels", "packages", "locks"]:
+        os.makedirs(os.path.join(store, d), exist_ok=True)
+
+    locks_dir = os.path.join(store, "locks", get_lock_tag())
+    os.makedirs(locks_dir, exist_ok=True)
+    lock_file = os.path.join(
+        locks_dir, hashlib.sha256(requirements_str.encode()).hexdigest() + ".json"
+    )
+
+    packages: List[str] = None
+    try:
+        with open(lock_file, "r") as f:
+            packages = json.load(f)
+        packages = [os.path.join(store, "packages", p) for p in packages]
+        if not all(os.path.exists(p) for p in packages):
+            packages = None
         else:
-            print("ignoring non-zero result from pip %s" % result)
-    else:
-        f = open(installed_requirementstxt, "wb")
-        f.write(requirements_str.encode())
-        f.close()
+            print("pip store: using previously resolved requirements")
+    except Exception:
+        pass
+
+    if packages is None:
+        wheels = resolve_local_wheels(store, requirementstxt, env)
+        if wheels is None:
+            print("pip store: fetching wheels")
+            populate_wheels(store, requirementstxt, env)
+            wheels = resolve_local_wheels(store, requirementstxt, env)
+            if wheels is None:
+                raise Exception("unable to resolve requirements from the pip store")
+        else:
+            print("pip store: requirements resolved from local wheels")
+        packages = []
+        for wheel in wheels:
+            print("pip store: %s" % os.path.basename(wheel))
+            packages.append(unpack_wheel(store, wheel))
+
+    for package_dir in packages:
+        # remove other versions of the same package already in the target.
+        installed = get_dist_infos(python_prefix)
+        for name, dist_info in get_dist_infos(package_dir).items():
+            if installed.get(name, dist_info) != dist_info:
+                remove_package(python_prefix, name)
+        link_package(package_dir, python_prefix)
+
+    lock_tmp = lock_file + ".tmp"
+    with open(lock_tmp, "w") as f:
+        json.dump([os.path.basename(p) for p in packages], f)
+    os.replace(lock_tmp, lock_file)
+    return True
+
+
+if __name__ == "__main__":
+    # checks the incremental requirements diff: python3 plugin_pip.py
+    def check(old_str: str, new_str: str, install: List[str], remove: Set[str]):
+        _, old = parse_requirements(old_str)
+        _, new = parse_requirements(new_str)
+        result = diff_requirements(old, new)
+        assert result == (install, remove), result
+
+    check("numpy==1\n", "numpy==1\n", [], set())
+    check("numpy==1\n", "numpy==2\n", ["numpy==2"], {"numpy"})
+    check("numpy==1\n", "numpy==1\nopencv-python==4\n", ["opencv-python==4"], set())
+    check("numpy==1\nPillow==10\n", "numpy==1\n", [], {"pillow"})
+    # only the darwin line changes, but numpy is removed on every platform,
+    # so the linux line must be installed again too.
+    check(
+        "numpy==1; sys_platform=='darwin'\nnumpy==1; sys_platform=='linux'\n",
+        "numpy==2; sys_platform=='darwin'\nnumpy==1; sys_platform=='linux'\n",
+        ["numpy==2; sys_platform=='darwin'", "numpy==1; sys_platform=='linux'"],
+        {"numpy"},
+    )
+    # a platform line going away also removes the package.
+    check(
+        "numpy==1; sys_platform=='darwin'\nnumpy==1; sys_platform=='linux'\n",
+        "numpy==1; sys_platform=='linux'\n",
+        ["numpy==1; sys_platform=='linux'"],
+        {"numpy"},
+    )
+    # a new platform line leaves the installed package alone.
+    check(
+        "numpy==1; sys_platform=='linux'\n",
+        "numpy==1; sys_platform=='darwin'\nnumpy==1; sys_platform=='linux'\n",
+        ["numpy==1; sys_platform=='darwin'"],
+        set(),
+    )
+    assert parse_requirements("foo @ https://example.com/foo.whl\n") is None
+
+    if sys.platform != "win32":
+        url = "file:///tmp/wheel%20house/numpy-2.0-cp312-cp312-linux_x86_64.whl"
+        path = file_url_to_path(url)
+        assert path == "/tmp/wheel house/numpy-2.0-cp312-cp312-linux_x86_64.whl", path
+    print("ok")
@@ -0,0 +1,135 @@
+import builtins
+import importlib
+import importlib.util
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+
+class StartupProfiler:
+    """
+    Records a timeline of plugin startup: zip load, pip, sdk setup, module
+    imports (similar to python -X importtime), plugin creation, and the first
+    onDevicesChanged.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.marks: List[Tuple[str, float]] = []
+        # (module, self seconds, cumulative seconds, depth)
+        self.imports: List[Tuple[str, float, float, int]] = []
+        self.importStacks = threading.local()
+        self.originalImport = None
+        self.originalImportModule = None
+
+    def now(self):
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def span(self, name: str):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.addSpan(name, start)
+
+    def addSpan(self, name: str, start: float):
+        self.spans.append((name, start, self.now()))
+
+    def mark(self, name: str, once: bool = True):
+        if once and any(m[0] == name for m in self.marks):
+            return False
+        self.marks.append((name, self.now()))
+        return True
+
+    def timeImport(self, name: str, doImport):
+        stack: List[List[float]] = getattr(self.importStacks, "stack", None)
+        if stack is None:
+            stack = self.importStacks.stack = []
+        # [start, time spent in nested imports]
+        frame = [time.perf_counter(), 0.0]
+        stack.append(frame)
+        try:
+            return doImport()
+        finally:
+            stack.pop()
+            cumulative = time.perf_counter() - frame[0]
+            if stack:
+                stack[-1][1] += cumulative
+            self.imports.append((name, cumulative - frame[1], cumulative, len(stack)))
+
+    def startImportTracking(self):
+        # both import statements (builtins.__import__) and importlib.import_module
+        # are timed. import_module references bound before tracking starts
+        # (from importlib import import_module), and imports made by native
+        # extensions, are not seen.
+        if self.originalImport:
+            return
+        self.originalImport = builtins.__import__
+        self.originalImportModule = importlib.import_module
+        originalImport = self.originalImport
+        originalImportModule = self.originalImportModule
+
+        def timedImport(name, globals=None, locals=None, fromlist=(), level=0):
+            # only time the first import of absolute module names,
+            # subsequent imports are dictionary lookups.
+            if level or name in sys.modules:
+                return originalImport(name, globals, locals, fromlist, level)
+            return self.timeImport(
+                name, lambda: originalImport(name, globals, locals, fromlist, level)
+            )
+
+        def timedImportModule(name, package=None):
+            try:
+                resolved = importlib.util.resolve_name(name, package)
+            except Exception:
+                resolved = None
+            if not resolved or resolved in sys.modules:
+                return originalImportModule(name, package)
+            return self.timeImport(
+                resolved, lambda: originalImportModule(name, package)
+            )
+
+        builtins.__import__ = timedImport
+        importlib.import_module = timedImportModule
+
+    def stopImportTracking(self):
+        if not self.originalImport:
+            return
+        builtins.__import__ = self.originalImport
+        importlib.import_module = self.originalImportModule
+        self.originalImport = None
+        self.originalImportModule = None
+
+    def getTimeline(self, maxImports: int = 20):
+        imports = sorted(self.imports, key=lambda i: i[2], reverse=True)
+        return {
+            "spans": [
+                {"name": name, "start": start, "duration": end - start}
+                for name, start, end in self.spans
+            ],
+            "marks": [{"name": name, "time": t} for name, t in self.marks],
+            "importTotal": sum(i[2] for i in self.imports if not i[3]),
+            "imports": [
+                {"module": module, "self": s, "cumulative": c}
+                for module, s, c, _ in imports[:maxImports]
+            ],
+        }
+
+    def printTimeline(self, maxImports: int = 20):
+        timeline = self.getTimeline(maxImports)
+        print("startup timeline:")
+        for span in timeline["spans"]:
+            print(
+                "  %8.3fs %-24s %8.3fs"
+                % (span["start"], span["name"], span["duration"])
+            )
+        for mark in timeline["marks"]:
+            print("  %8.3fs %s" % (mark["time"], mark["name"]))
+        print("imports: %.3fs" % timeline["importTotal"])
+        print("  %10s %10s  module" % ("self", "cumulative"))
+        for i in timeline["imports"]:
+            print("  %9.3fs %9.3fs  %s" % (i["self"], i["cumulative"], i["module"]))
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import asyncio
-import gc
 import inspect
 import multiprocessing
 import multiprocessing.connection
@@ -9,16 +8,17 @@ import os
 import platform
 import random
 import sys
+import threading
 import time
 import traceback
 import zipfile
 from asyncio.events import AbstractEventLoop
 from asyncio.futures import Future
-from asyncio.streams import StreamReader, StreamWriter
+from asyncio.streams import StreamWriter
 from collections.abc import Mapping
 from io import StringIO
 from pathlib import Path
-from typing import Any, Callable, Coroutine, Optional, Set, Tuple, TypedDict
+from typing import Any, Callable, Coroutine, Optional, Set, TypedDict
 
 import rpc
 import rpc_reader
@@ -586,6 +586,7 @@ class DeviceManager(scrypted_python.scrypted_sdk.types.DeviceManager):
         super().__init__()
         self.nativeIds = nativeIds
         self.systemManager = systemManager
+        self.startupProfiler = None
 
     def getDeviceState(self, nativeId: str) -> DeviceState:
         id = self.nativeIds[nativeId].id
@@ -597,6 +598,11 @@ class DeviceManager(scrypted_python.scrypted_sdk.types.DeviceManager):
         await self.systemManager.api.onDeviceEvent(nativeId, eventInterface, eventData)
 
     async def onDevicesChanged(self, devices: DeviceManifest) -> None:
+        if self.startupProfiler and self.startupProfiler.mark("first onDevicesChanged"):
+            print(
+                "startup timeline: first onDevicesChanged %.3fs"
+                % self.startupProfiler.now()
+            )
         return await self.systemManager.api.onDevicesChanged(devices)
 
     async def onDeviceDiscovered(self, devices: Device) -> str:
@@ -648,7 +654,9 @@ class PluginRemote:
         self.systemManager: SystemManager = None
         self.mediaManager: MediaManager
         self.clusterManager: ClusterManager
-        self.consoles: Mapping[str, Future[Tuple[StreamReader, StreamWriter]]] = {}
+        self.consoles: Mapping[str, Any] = {}
+        # consoles are created from whichever thread prints first.
+        self.consolesLock = threading.Lock()
         self.peer = clusterSetup.peer
         self.clusterSetup = clusterSetup
         self.api = api
@@ -656,6 +664,7 @@ class PluginRemote:
         self.hostInfo = hostInfo
         self.loop = loop
         self.replPort = None
+        self.startupProfiler = None
         self.__dict__["__proxy_oneway_methods"] = [
             "notify",
             "updateDeviceState",
@@ -665,6 +674,36 @@ class PluginRemote:
         ]
         self.peer.params["createMediaManager"] = lambda: api.getMediaManager()
 
+    async def connectConsole(self, nativeId: str) -> StreamWriter:
+        plugins = await self.api.getComponent("plugins")
+        port, hostname = await plugins.getRemoteServicePort(
+            self.pluginId, "console-writer"
+        )
+        _, writer = await asyncio.open_connection(host=hostname, port=port)
+        if not nativeId:
+            nid = "undefined"
+        else:
+            nid = nativeId
+        nid += "\n"
+        writer.write(nid.encode("utf8"))
+        return writer
+
+    def getConsole(self, nativeId: str):
+        # plugin host module, unused when consumed by a client via the scrypted-sdk package
+        from plugin_console import BufferedConsoleWriter
+
+        console = self.consoles.get(nativeId)
+        if console:
+            return console
+        with self.consolesLock:
+            console = self.consoles.get(nativeId)
+            if not console:
+                console = BufferedConsoleWriter(
+                    self.loop, lambda: self.connectConsole(nativeId)
+                )
+                self.consoles[nativeId] = console
+        return console
+
     async def print_async(
         self,
         nativeId: str,
@@ -673,29 +712,7 @@ class PluginRemote:
         end: Optional[str] = "\n",
         flush: bool = False,
     ):
-        consoleFuture = self.consoles.get(nativeId)
-        if not consoleFuture:
-            consoleFuture = Future()
-            self.consoles[nativeId] = consoleFuture
-            plugins = await self.api.getComponent("plugins")
-            port, hostname = await plugins.getRemoteServicePort(
-                self.pluginId, "console-writer"
-            )
-            connection = await asyncio.open_connection(host=hostname, port=port)
-            _, writer = connection
-            if not nativeId:
-                nid = "undefined"
-            else:
-                nid = nativeId
-            nid += "\n"
-            writer.write(nid.encode("utf8"))
-            consoleFuture.set_result(connection)
-        _, writer = await consoleFuture
-        strio = StringIO()
-        print(*values, sep=sep, end=end, flush=flush, file=strio)
-        strio.seek(0)
-        b = strio.read().encode("utf8")
-        writer.write(b)
+        self.print(nativeId, *values, sep=sep, end=end, flush=flush)
 
     def print(
         self,
@@ -705,10 +722,17 @@ class PluginRemote:
         end: Optional[str] = "\n",
         flush: bool = False,
     ):
-        asyncio.run_coroutine_threadsafe(
-            self.print_async(nativeId, *values, sep=sep, end=end, flush=flush),
-            self.loop,
-        )
+        # output is batched and written to the console socket on an interval,
+        # flush is not honored, as that would mean a socket write per line.
+        strio = StringIO()
+        print(*values, sep=sep, end=end, file=strio)
+        self.getConsole(nativeId).write(strio.getvalue())
+
+    async def getConsoleStats(self):
+        return {
+            nativeId or "undefined": console.getStats()
+            for nativeId, console in list(self.consoles.items())
+        }
 
     async def loadZip(self, packageJson, zipAPI: Any, options: dict):
         try:
@@ -723,11 +747,20 @@ class PluginRemote:
         # consumed by a client via the scrypted-sdk package
         import cluster_labels
         import plugin_console
+        import plugin_gc
         import plugin_volume as pv
-        from plugin_pip import install_with_pip, need_requirements, remove_pip_dirs
+        from plugin_pip import install_requirements, need_requirements
+        from plugin_profiler import StartupProfiler
+
+        profiler = StartupProfiler()
+        self.startupProfiler = profiler
 
         await self.clusterSetup.initializeCluster(zipOptions)
 
+        def freeze_gc():
+            if plugin_gc.gc_manager:
+                plugin_gc.gc_manager.freeze()
+
         sdk = ScryptedStatic()
 
         sdk.connectRPCObject = lambda v: self.clusterSetup.connectRPCObject(v)
@@ -747,19 +780,20 @@ class PluginRemote:
         else:
             zipPath = plugin_zip_paths.get("zip_file")
 
-        if not os.path.exists(zipPath) or debug:
-            os.makedirs(os.path.dirname(zipPath), exist_ok=True)
-            zipData = await zipAPI.getZip()
-            zipPathTmp = zipPath + ".tmp"
-            with open(zipPathTmp, "wb") as f:
-                f.write(zipData)
-            try:
-                os.remove(zipPath)
-            except:
-                pass
-            os.rename(zipPathTmp, zipPath)
-
-        zip = zipfile.ZipFile(zipPath)
+        with profiler.span("zip"):
+            if not os.path.exists(zipPath) or debug:
+                os.makedirs(os.path.dirname(zipPath), exist_ok=True)
+                zipData = await zipAPI.getZip()
+                zipPathTmp = zipPath + ".tmp"
+                with open(zipPathTmp, "wb") as f:
+                    f.write(zipData)
+                try:
+                    os.remove(zipPath)
+                except:
+                    pass
+                os.rename(zipPathTmp, zipPath)
+
+            zip = zipfile.ZipFile(zipPath)
 
         if not forkMain:
             multiprocessing.set_start_method("spawn")
@@ -828,48 +862,51 @@ class PluginRemote:
                 pip_target, "requirements.optional"
             )
 
-            need_pip = False
-            # pip is needed if there's a requirements.txt file that has changed.
-            if str_requirements:
-                need_pip = need_requirements(requirements_basename, str_requirements)
-            # pip is needed if the base scrypted requirements have changed.
-            if not need_pip:
-                need_pip = need_requirements(
-                    scrypted_requirements_basename, SCRYPTED_REQUIREMENTS
-                )
+            with profiler.span("pip"):
+                need_pip = False
+                # pip is needed if there's a requirements.txt file that has changed.
+                if str_requirements:
+                    need_pip = need_requirements(
+                        requirements_basename, str_requirements
+                    )
+                # pip is needed if the base scrypted requirements have changed.
+                if not need_pip:
+                    need_pip = need_requirements(
+                        scrypted_requirements_basename, SCRYPTED_REQUIREMENTS
+                    )
 
-            if need_pip:
-                remove_pip_dirs(plugin_volume)
-                install_with_pip(
-                    pip_target,
-                    packageJson,
-                    SCRYPTED_REQUIREMENTS,
-                    scrypted_requirements_basename,
-                    ignore_error=True,
-                )
-                install_with_pip(
-                    pip_target,
-                    packageJson,
-                    str_requirements,
-                    requirements_basename,
-                    ignore_error=False,
-                )
-                install_with_pip(
-                    pip_target,
-                    packageJson,
-                    str_optional_requirements,
-                    optional_requirements_basename,
-                    ignore_error=True,
-                )
-            else:
-                print("requirements.txt (up to date)")
-                print(str_requirements)
+                if need_pip:
+                    install_requirements(
+                        plugin_volume,
+                        pip_target,
+                        packageJson,
+                        [
+                            (
+                                SCRYPTED_REQUIREMENTS,
+                                scrypted_requirements_basename,
+                                True,
+                            ),
+                            (str_requirements, requirements_basename, False),
+                            (
+                                str_optional_requirements,
+                                optional_requirements_basename,
+                                True,
+                            ),
+                        ],
+                    )
+                else:
+                    print("requirements.txt (up to date)")
+                    print(str_requirements)
 
             sys.path.append(plugin_zip_paths.get("unzipped_path"))
             sys.path.append(pip_target)
 
+        profiler.startImportTracking()
+        sdkStart = profiler.now()
+
         self.systemManager = SystemManager(self.api, self.systemState)
         self.deviceManager = DeviceManager(self.nativeIds, self.systemManager)
+        self.deviceManager.startupProfiler = profiler
         self.mediaManager = MediaManager(await self.api.getMediaManager())
         self.clusterManager = ClusterManager(self)
 
@@ -1069,15 +1106,27 @@ class PluginRemote:
                 zip, self, self.systemManager, self.deviceManager, self.mediaManager
             )
 
+        profiler.addSpan("sdk", sdkStart)
+
         # plugin embedded files are treated as the working directory, chdir to that.
         fsPath = os.path.join(plugin_zip_paths.get("unzipped_path"), "fs")
         os.makedirs(fsPath, exist_ok=True)
         os.chdir(fsPath)
 
+        def finish_startup():
+            profiler.stopImportTracking()
+            profiler.printTimeline()
+            freeze_gc()
+
         if not forkMain:
-            from main import create_scrypted_plugin  # type: ignore
+            try:
+                with profiler.span("import main"):
+                    from main import create_scrypted_plugin  # type: ignore
 
-            pluginInstance = await rpc.maybe_await(create_scrypted_plugin())
+                with profiler.span("create_scrypted_plugin"):
+                    pluginInstance = await rpc.maybe_await(create_scrypted_plugin())
+            finally:
+                finish_startup()
             try:
                 from plugin_repl import createREPLServer
 
@@ -1087,9 +1136,14 @@ class PluginRemote:
                 self.replPort = 0
             return pluginInstance
 
-        from main import fork  # type: ignore
+        try:
+            with profiler.span("import main"):
+                from main import fork  # type: ignore
 
-        forked = await rpc.maybe_await(fork())
+            with profiler.span("fork"):
+                forked = await rpc.maybe_await(fork())
+        finally:
+            finish_startup()
         if type(forked) == dict:
             forked[rpc.RpcPeer.PROPERTY_JSON_COPY_SERIALIZE_CHILDREN] = True
         return forked
@@ -1136,6 +1190,18 @@ class PluginRemote:
     async def createDeviceState(self, id, setState):
         return WritableDeviceState(id, setState)
 
+    async def getStartupTimeline(self):
+        if not self.startupProfiler:
+            raise Exception("Startup timeline unavailable: Plugin not loaded.")
+        return self.startupProfiler.getTimeline()
+
+    async def getGCStats(self):
+        import plugin_gc
+
+        if not plugin_gc.gc_manager:
+            raise Exception("GC stats unavailable: GC manager not started.")
+        return plugin_gc.gc_manager.getStats()
+
     async def getServicePort(self, name):
         if name == "repl":
             if self.replPort is None:
@@ -1175,11 +1241,10 @@ async def plugin_async_main(
 def main(rpcTransport: rpc_reader.RpcTransport):
     loop = asyncio.new_event_loop()
 
-    def gc_runner():
-        gc.collect()
-        loop.call_later(10, gc_runner)
+    # plugin host module, unused when consumed by a client via the scrypted-sdk package
+    import plugin_gc
 
-    gc_runner()
+    plugin_gc.start_gc_manager(loop)
 
     loop.run_until_complete(plugin_async_main(loop, rpcTransport))
     loop.close()